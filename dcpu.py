@@ -1,5 +1,9 @@
+from array import array
+from collections import namedtuple
 from enum import Enum
 from functools import partial
+from operator import mul
+import random
 
 class Opcode(Enum):
     NONBASIC = 0x0
@@ -22,6 +26,58 @@ class Opcode(Enum):
 class NonBasicOpcode(Enum):
     JSR = 0x01
 
+# the IFx opcodes, with their condition as Python source over the operand
+# values a and b
+CONDITIONS = {
+    Opcode.IFE: '{a} == {b}',
+    Opcode.IFN: '{a} != {b}',
+    Opcode.IFG: '{a} > {b}',
+    Opcode.IFB: '{a} & {b}',
+}
+
+CYCLES = {
+    Opcode.SET: 1,
+    Opcode.ADD: 2,
+    Opcode.SUB: 2,
+    Opcode.MUL: 2,
+    Opcode.DIV: 3,
+    Opcode.MOD: 3,
+    Opcode.SHL: 2,
+    Opcode.SHR: 2,
+    Opcode.AND: 1,
+    Opcode.BOR: 1,
+    Opcode.XOR: 1,
+    Opcode.IFE: 2,
+    Opcode.IFN: 2,
+    Opcode.IFG: 2,
+    Opcode.IFB: 2,
+    NonBasicOpcode.JSR: 2,
+}
+
+class Operand(Enum):
+    REGISTER = 0            # 0x00-0x07: register
+    REGISTER_INDIRECT = 1   # 0x08-0x0f: [register]
+    NEXT_WORD_REGISTER = 2  # 0x10-0x17: [next word + register]
+    POP = 3                 # 0x18: [SP++]
+    PEEK = 4                # 0x19: [SP]
+    PUSH = 5                # 0x1a: [--SP]
+    SP = 6                  # 0x1b
+    PC = 7                  # 0x1c
+    O = 8                   # 0x1d
+    NEXT_WORD_INDIRECT = 9  # 0x1e: [next word]
+    NEXT_WORD_LITERAL = 10  # 0x1f: next word (literal)
+    LITERAL = 11            # 0x20-0x3f: literal value 0x00-0x1f
+
+def operand_kind(code):
+    if code < 0x18:
+        return Operand(code >> 3)
+    elif code < 0x20:
+        return Operand(code - 0x18 + Operand.POP.value)
+    return Operand.LITERAL
+
+def needs_next_word(code):
+    return (0x10 <= code <= 0x17) or code in (0x1e, 0x1f)
+
 def sanitized_value(value, word_length):
     if not isinstance(value, int):
         value = int(value)
@@ -36,110 +92,692 @@ def compile_word(b, a, o):
 def decompile_word(word):
     return word >> 10, (word >> 4) & 0b000000111111, word & 0b0000000000001111
 
+PAGE_SHIFT = 8
+PAGE_SIZE = 1 << PAGE_SHIFT
+
+def pages_in_range(start, stop):
+    return range(start >> PAGE_SHIFT, ((stop - 1) >> PAGE_SHIFT) + 1)
+
+# smallest array typecode that holds a word, or None to fall back to a list
+def word_typecode(word_length):
+    for typecode in 'BHIQ':
+        if array(typecode).itemsize * 8 >= word_length:
+            return typecode
+    return None
+
 class RAM():
-    # initial_contents must be a list of words!
+    # initial_contents must be a sequence of words!
     def __init__(self, word_length, size, initial_contents=None):
         self.word_length = word_length
-        self.contents = [0x0000 for _ in range(size)]
+        typecode = word_typecode(word_length)
+        if typecode:
+            self.contents = array(typecode, [0x0000]) * size
+        else:
+            self.contents = [0x0000] * size
         if initial_contents:
             assert len(initial_contents) <= len(self.contents)
+            if typecode and not isinstance(initial_contents, array):
+                initial_contents = array(typecode, initial_contents)
             self.contents[:len(initial_contents)] = initial_contents
+        # page number -> hooks called as hook(start, stop) after any write
+        # into that page changes the words in [start, stop)
+        self.write_hooks = {}
+        # page number -> hooks called as hook(pos) before peek reads a word
+        # in that page
+        self.read_hooks = {}
+        self.rebind()
+
+    # peek and poke are the unchecked accessors: poke takes values that are
+    # already masked to the word length.  They are bound straight to the
+    # contents while nothing is hooked; once any write (or read) hook is
+    # installed, every poke (or peek) goes through the notify variant,
+    # whatever page it touches.  read and write never call hooks.  The
+    # execution engines look up each access's page in read_pages or
+    # write_pages instead, bitmaps with a 1 for every page that has hooks,
+    # and only take the notify variant for those, so accesses to all other
+    # pages stay direct.  pages limits the update to the pages whose hooks
+    # changed.
+    def rebind(self, pages=None):
+        if pages is None:
+            self.read, self.write = self.direct()
+            self.read_pages = bytearray(len(pages_in_range(0, self.size)))
+            self.write_pages = bytearray(len(self.read_pages))
+            pages = range(len(self.read_pages))
+        self.peek = self.peek_and_notify if self.read_hooks else self.read
+        self.poke = self.poke_and_notify if self.write_hooks else self.write
+        for page in pages:
+            self.read_pages[page] = page in self.read_hooks
+            self.write_pages[page] = page in self.write_hooks
+
+    def direct(self):
+        return self.contents.__getitem__, self.contents.__setitem__
+
+    # RAM over an existing writable (or read-only) buffer, such as an mmap,
+    # whose words are in native byte order; nothing is copied
+    @classmethod
+    def from_buffer(cls, word_length, buffer):
+        ram = object.__new__(cls)
+        ram.word_length = word_length
+        ram.contents = memoryview(buffer).cast('B').cast(word_typecode(word_length))
+        ram.write_hooks = {}
+        ram.read_hooks = {}
+        ram.rebind()
+        return ram
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('peek', 'poke', 'read', 'write', 'read_pages', 'write_pages'):
+            del state[name]
+        state['write_hooks'] = {}
+        state['read_hooks'] = {}
+        if isinstance(self.contents, memoryview):
+            state['contents'] = self.snapshot()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rebind()
 
     @property
     def size(self):
         return len(self.contents)
 
+    # zero-copy view of the words, for bulk access
+    @property
+    def view(self):
+        return memoryview(self.contents)
+
     def get(self, pos):
         return self.contents[pos]
 
     def set(self, pos, value):
-        value = sanitized_value(value, self.word_length)
+        self.poke(pos, sanitized_value(value, self.word_length))
+
+    def poke_and_notify(self, pos, value):
         self.contents[pos] = value
+        hooks = self.write_hooks.get(pos >> PAGE_SHIFT)
+        if hooks:
+            for hook in tuple(hooks):
+                hook(pos, pos + 1)
+
+    def peek_and_notify(self, pos):
+        hooks = self.read_hooks.get(pos >> PAGE_SHIFT)
+        if hooks:
+            for hook in tuple(hooks):
+                hook(pos)
+        return self.contents[pos]
+
+    def _add_hook(self, table, hook, start, stop):
+        pages = pages_in_range(start, self.size if stop is None else stop)
+        for page in pages:
+            table.setdefault(page, []).append(hook)
+        self.rebind(pages)
+
+    def _remove_hook(self, table, hook, start, stop):
+        pages = pages_in_range(start, self.size if stop is None else stop)
+        for page in pages:
+            hooks = table.get(page)
+            if hooks and hook in hooks:
+                hooks.remove(hook)
+                if not hooks:
+                    del table[page]
+        self.rebind(pages)
+
+    # hooks fire for every write to a page overlapping [start, stop), so
+    # they must do their own filtering if they care about exact addresses
+    def add_write_hook(self, hook, start=0, stop=None):
+        self._add_hook(self.write_hooks, hook, start, stop)
+
+    def remove_write_hook(self, hook, start=0, stop=None):
+        self._remove_hook(self.write_hooks, hook, start, stop)
+
+    # read hooks slow down every read of their pages, and see all of them,
+    # including instruction fetches
+    def add_read_hook(self, hook, start=0, stop=None):
+        self._add_hook(self.read_hooks, hook, start, stop)
+
+    def remove_read_hook(self, hook, start=0, stop=None):
+        self._remove_hook(self.read_hooks, hook, start, stop)
+
+    # bulk copy of the words, for restore()
+    def snapshot(self):
+        if isinstance(self.contents, memoryview):
+            return array(self.contents.format, self.contents.tobytes())
+        return self.contents[:]
+
+    # True when the words equal a snapshot()'s, compared without copying
+    # them
+    def equals(self, words):
+        return self.contents == words
+
+    # writes words from start on without calling hooks
+    def load(self, start, words):
+        assert start + len(words) <= self.size
+        typecode = word_typecode(self.word_length)
+        if typecode and not isinstance(words, array):
+            words = array(typecode, words)
+        self.contents[start:start + len(words)] = words
+
+    # writes words from start on, then notifies hooks once for the range
+    def store(self, start, words):
+        self.load(start, words)
+        if words and self.write_hooks:
+            self.notify_write(start, start + len(words))
+
+    # overwrites every word from a snapshot; hooks are notified once per
+    # page whose contents actually changed
+    def restore(self, words):
+        contents = self.contents
+        assert len(words) == len(contents)
+        if not self.write_hooks:
+            contents[:] = words
+            return
+        changed = [page for page in self.write_hooks
+                   if contents[page << PAGE_SHIFT:(page + 1) << PAGE_SHIFT] != words[page << PAGE_SHIFT:(page + 1) << PAGE_SHIFT]]
+        contents[:] = words
+        for page in changed:
+            self.notify_write(page << PAGE_SHIFT, min((page + 1) << PAGE_SHIFT, len(contents)))
+
+    # independent copy of the words, without hooks
+    def copy(self):
+        ram = object.__new__(type(self))
+        state = self.__getstate__()
+        if state['contents'] is self.contents:
+            state['contents'] = self.snapshot()
+        ram.__setstate__(state)
+        return ram
+
+    def notify_write(self, start, stop):
+        if start >> PAGE_SHIFT == (stop - 1) >> PAGE_SHIFT:
+            hooks = tuple(self.write_hooks.get(start >> PAGE_SHIFT, ()))
+        else:
+            hooks = []
+            for page in pages_in_range(start, stop):
+                hooks.extend(hook for hook in self.write_hooks.get(page, ()) if hook not in hooks)
+        for hook in hooks:
+            hook(start, stop)
+
+    # starts recording writes to [start, stop); see DirtyTracker
+    def track_dirty(self, start=0, stop=None, shift=0):
+        return DirtyTracker(self, start, self.size if stop is None else stop, shift)
+
+class DirtyTracker():
+    # Records which words of [start, stop) have been written, in units of
+    # 1 << shift words (0 for single words, PAGE_SHIFT for pages).  A
+    # bitmap dedupes the units and a list keeps them in order, so take()
+    # costs O(changed units) rather than O(range).
+    def __init__(self, ram, start, stop, shift=0):
+        self.ram = ram
+        self.start = start
+        self.stop = stop
+        self.shift = shift
+        self.bitmap = bytearray(((ram.size - 1) >> shift) + 1)
+        self.changed = []
+        ram.add_write_hook(self.hook, start, stop)
+
+    def hook(self, start, stop):
+        start = max(start, self.start)
+        stop = min(stop, self.stop)
+        if start >= stop:
+            return
+        bitmap = self.bitmap
+        for unit in range(start >> self.shift, ((stop - 1) >> self.shift) + 1):
+            if not bitmap[unit]:
+                bitmap[unit] = 1
+                self.changed.append(unit)
+
+    # returns the first address of every unit written since the last call,
+    # in ascending order, and forgets them
+    def take(self):
+        changed, self.changed = self.changed, []
+        bitmap = self.bitmap
+        for unit in changed:
+            bitmap[unit] = 0
+        changed.sort()
+        return [unit << self.shift for unit in changed]
+
+    def close(self):
+        self.ram.remove_write_hook(self.hook, self.start, self.stop)
+
+HASH_MASK = 2**64 - 1
+
+# fixed random 64-bit keys, so that hashes agree across processes; RAM keys
+# are generated 0x10000 at a time on first use
+_ram_hash_keys = array('Q')
+_register_generator = random.Random('registers')
+REGISTER_HASH_KEYS = tuple(_register_generator.getrandbits(64) for _ in range(11))
+
+def ram_hash_keys(size):
+    keys = _ram_hash_keys
+    while len(keys) < size:
+        generator = random.Random('ram %d' % len(keys))
+        keys.extend(generator.getrandbits(64) for _ in range(0x10000))
+    return keys
+
+class StateHash():
+    # Additive Zobrist-style digest of a RAM: the sum of every word times a
+    # fixed random key for its address, mod 2**64.  A write hook and a
+    # shadow copy of the words keep it current at O(1) per written word, so
+    # words must be written through poke, set or restore.  Writes straight
+    # into ram.contents leave it stale until notify_write() is called for
+    # them.
+    def __init__(self, ram):
+        self.ram = ram
+        self.keys = ram_hash_keys(ram.size)
+        self.shadow = ram.snapshot()
+        self.value = sum(map(mul, self.shadow, self.keys)) & HASH_MASK
+        ram.add_write_hook(self.hook)
+
+    def hook(self, start, stop):
+        get = self.ram.get
+        shadow = self.shadow
+        keys = self.keys
+        value = self.value
+        for pos in range(start, stop):
+            new = get(pos)
+            old = shadow[pos]
+            if new != old:
+                value += (new - old) * keys[pos]
+                shadow[pos] = new
+        self.value = value & HASH_MASK
+
+    def close(self):
+        self.ram.remove_write_hook(self.hook)
+
+# register indices into DCPURegisterBank.values
+A, B, C, X, Y, Z, I, J, PC, SP, O = range(11)
+
+# set_by_address/get_by_address see registers as addresses past the end of RAM
+REGISTER_BASE = 0x10000
 
 class DCPURegisterBank():
+    # Registers are stored by index in a list; the named attributes and
+    # item access are a compatibility view over it.
+    __slots__ = ('word_length', 'values')
 
     all_regs = ('a', 'b', 'c', 'x', 'y', 'z', 'i', 'j', 'pc', 'sp', 'o')
     regs = all_regs[:8]
+    indices = {name: index for index, name in enumerate(all_regs)}
 
-    def __init__(self, word_length, values):
+    # values=None starts every register at 0
+    def __init__(self, word_length, values=None):
         self.word_length = word_length
-        for reg in self.all_regs:
-            self[reg] = values[reg]
+        self.values = [0x0000] * len(self.all_regs)
+        if values is not None:
+            for reg in self.all_regs:
+                self[reg] = values[reg]
 
     def __getitem__(self, key):
-        if key in self.all_regs:
-            return getattr(self, key)
-        else:
-            raise KeyError
+        return self.values[self.indices[key]]
 
     def __setitem__(self, key, value):
-        if key in self.all_regs:
-            setattr(self, key, value)
-        else:
-            raise KeyError
+        self.values[self.indices[key]] = sanitized_value(value, self.word_length)
 
     def __iter__(self):
         return iter(self.all_regs)
 
-    def __setattr__(self, name, value):
-        if name in self.all_regs:
-            value = sanitized_value(value, self.word_length)
-        super().__setattr__(name, value)
+def _register_property(index):
+    def get(self):
+        return self.values[index]
+
+    def set(self, value):
+        self.values[index] = sanitized_value(value, self.word_length)
+
+    return property(get, set)
+
+for _index, _name in enumerate(DCPURegisterBank.all_regs):
+    setattr(DCPURegisterBank, _name, _register_property(_index))
+
+# Operand resolvers take a CPU and return (value, address), consuming next
+# words and adjusting SP the same way address_for_operand does.  Literals
+# resolve to a None address, so writes to them are silently dropped.
+def _register_operand(index):
+    address = REGISTER_BASE + index
+    def resolve(cpu):
+        return cpu.reg.values[index], address
+    return resolve
+
+def _register_indirect_operand(index):
+    def resolve(cpu):
+        address = cpu.reg.values[index]
+        ram = cpu.ram
+        return (ram.peek_and_notify if ram.read_pages[address >> PAGE_SHIFT] else ram.read)(address), address
+    return resolve
+
+def _next_word_register_operand(index):
+    def resolve(cpu):
+        address = (cpu.next_word() + cpu.reg.values[index]) & 0xffff
+        ram = cpu.ram
+        return (ram.peek_and_notify if ram.read_pages[address >> PAGE_SHIFT] else ram.read)(address), address
+    return resolve
+
+def _pop_operand(cpu):
+    address = cpu.pop_addr()
+    ram = cpu.ram
+    return (ram.peek_and_notify if ram.read_pages[address >> PAGE_SHIFT] else ram.read)(address), address
+
+def _peek_operand(cpu):
+    address = cpu.peek_addr()
+    ram = cpu.ram
+    return (ram.peek_and_notify if ram.read_pages[address >> PAGE_SHIFT] else ram.read)(address), address
+
+def _push_operand(cpu):
+    address = cpu.push_addr()
+    ram = cpu.ram
+    return (ram.peek_and_notify if ram.read_pages[address >> PAGE_SHIFT] else ram.read)(address), address
+
+def _next_word_indirect_operand(cpu):
+    address = cpu.next_word()
+    ram = cpu.ram
+    return (ram.peek_and_notify if ram.read_pages[address >> PAGE_SHIFT] else ram.read)(address), address
+
+def _next_word_literal_operand(cpu):
+    return cpu.next_word(), None
+
+def _literal_operand(value):
+    def resolve(cpu):
+        return value, None
+    return resolve
+
+def _no_operand(cpu):
+    return None, None
+
+OPERAND_RESOLVERS = tuple(
+    [_register_operand(index) for index in range(A, J + 1)] +
+    [_register_indirect_operand(index) for index in range(A, J + 1)] +
+    [_next_word_register_operand(index) for index in range(A, J + 1)] +
+    [_pop_operand, _peek_operand, _push_operand,
+     _register_operand(SP), _register_operand(PC), _register_operand(O),
+     _next_word_indirect_operand, _next_word_literal_operand] +
+    [_literal_operand(value) for value in range(0x20)])
+
+# (kind, literal value, resolver, next word count) for each operand code
+OPERANDS = tuple(
+    (operand_kind(code), code - 0x20 if code >= 0x20 else None,
+     OPERAND_RESOLVERS[code], int(needs_next_word(code)))
+    for code in range(0x40))
+
+class Instruction():
+    # A fully decoded instruction word.  For non-basic instructions the
+    # single operand is stored as a, and b is None.
+    __slots__ = ('word', 'opcode', 'handler', 'a', 'b', 'a_kind', 'b_kind',
+                 'a_literal', 'b_literal', 'a_resolve', 'b_resolve',
+                 'next_words', 'cycles')
+
+    def __init__(self, word, opcode, handler, a, b):
+        self.word = word
+        self.opcode = opcode
+        self.handler = handler
+        self.a = a
+        self.b = b
+        self.a_kind, self.a_literal, self.a_resolve, a_words = OPERANDS[a] if a is not None else (None, None, _no_operand, 0)
+        self.b_kind, self.b_literal, self.b_resolve, b_words = OPERANDS[b] if b is not None else (None, None, _no_operand, 0)
+        self.next_words = a_words + b_words
+        self.cycles = CYCLES[opcode] + self.next_words if opcode else 0
+
+    def __repr__(self):
+        return '<Instruction 0x%04x %s>' % (self.word, self.opcode.name if self.opcode else 'invalid')
+
+def _invalid_instruction(cpu, a, b, addr):
+    address = (cpu.reg.values[PC] - 1) & 0xffff
+    raise ValueError('invalid instruction 0x%04x at 0x%04x' % (cpu.ram.peek(address), address))
+
+def decode(word):
+    b, a, o = decompile_word(word)
+    if o:
+        opcode = _BASIC_OPCODES[o]
+        return Instruction(word, opcode, HANDLERS[opcode], a, b)
+    if a in _NONBASIC_OPCODES:
+        opcode = _NONBASIC_OPCODES[a]
+        return Instruction(word, opcode, HANDLERS[opcode], b, None)
+    instruction = Instruction(word, None, _invalid_instruction, None, None)
+    # skip_next_and_cycle still has to step over an invalid word's next words
+    instruction.next_words = needs_next_word(a) + needs_next_word(b)
+    return instruction
+
+class StopReason(Enum):
+    MAX_CYCLES = 'max_cycles'
+    MAX_INSTRUCTIONS = 'max_instructions'
+    UNTIL_PC = 'until_pc'
+    STOP = 'stop'
+    TIMEOUT = 'timeout'
+    HALTED = 'halted'
+    BREAKPOINT = 'breakpoint'
+    WATCHPOINT = 'watchpoint'
+
+# returned by CPU.run: instructions executed, cycles consumed and why it stopped
+RunResult = namedtuple('RunResult', ('instructions', 'cycles', 'reason'))
+
+# returned by CPU.snapshot: register values, cycle and a copy of the RAM words
+Snapshot = namedtuple('Snapshot', ('registers', 'cycle', 'ram'))
+
+class Loop():
+    # CPU.fast_forward's record of one backward jump within a run
+    def __init__(self, target):
+        self.target = target
+        # registers after the jump last time it was taken
+        self.registers = None
+        # while armed: the RAM words, cycle and instruction count when the
+        # registers last repeated, and whether a write hook has fired since
+        self.words = None
+        self.cycle = self.executed = 0
+        self.tripped = False
+        self.ram = None
+        self.pages = ()
+        # jumps to ignore before looking again
+        self.wait = 0
+        self.backoff = 1
+
+    def arm(self, ram, cycle, executed):
+        self.words = ram.snapshot()
+        self.cycle, self.executed = cycle, executed
+        self.tripped = False
+        if ram.write_hooks:
+            self.ram = ram
+            self.pages = list(ram.write_hooks)
+            for page in self.pages:
+                ram.add_write_hook(self.trip, page << PAGE_SHIFT, (page + 1) << PAGE_SHIFT)
+
+    def disarm(self):
+        self.words = None
+        if self.ram is not None:
+            for page in self.pages:
+                self.ram.remove_write_hook(self.trip, page << PAGE_SHIFT, (page + 1) << PAGE_SHIFT)
+            self.ram = None
+            self.pages = ()
+
+    def trip(self, start, stop):
+        self.tripped = True
+
+class SpinCheck():
+    # Busy-wait detection across runs, for drivers that run a machine in
+    # slices (fast_forward forgets its loops when run returns).  check() is
+    # called after each slice and returns True once the registers and RAM
+    # equal those at an earlier slice end, which proves the machine repeats
+    # forever.  Register tuples are cheap to remember, so the RAM is only
+    # copied once one of them repeats, and compared when it comes round
+    # again; limit bounds the tuples remembered.  Like fast_forward it gives
+    # up while the RAM has read hooks, and also while the engine has a
+    # pending event (DeviceBus.next_event).  A loop whose writes reach a
+    # write hook is doing something each time round even if it repeats, so
+    # it watches every hooked page and starts over from the current slice
+    # end when one is written; close() removes its hooks.  Given the
+    # instructions executed so far, it also measures one repeat: cycles and
+    # instructions hold its length once check() has returned True.
+    def __init__(self, limit=64):
+        self.limit = limit
+        self.ram = None
+        self.pages = set()
+        self.reset()
+
+    def reset(self):
+        self.ends = set()
+        self.origin = self.words = None
+        self.tripped = False
+        # cycle and instruction count when the RAM was last copied
+        self.start = None
+        self.cycles = self.instructions = None
+
+    def trip(self, start, stop):
+        self.tripped = True
+
+    # the pages of ram with write hooks other than trip
+    def hooked(self, ram):
+        pages = self.pages if ram is self.ram else ()
+        return {page for page, hooks in ram.write_hooks.items() if len(hooks) > (page in pages)}
+
+    def watch(self, ram, pages):
+        if ram is not self.ram:
+            self.close()
+            self.ram = ram
+        for page in pages - self.pages:
+            ram.add_write_hook(self.trip, page << PAGE_SHIFT, (page + 1) << PAGE_SHIFT)
+        for page in self.pages - pages:
+            ram.remove_write_hook(self.trip, page << PAGE_SHIFT, (page + 1) << PAGE_SHIFT)
+        self.pages = pages
+
+    def close(self):
+        if self.ram is not None:
+            for page in self.pages:
+                self.ram.remove_write_hook(self.trip, page << PAGE_SHIFT, (page + 1) << PAGE_SHIFT)
+        self.ram = None
+        self.pages = set()
+
+    def check(self, cpu, engine=None, executed=0):
+        ram = cpu.ram
+        next_event = getattr(engine, 'next_event', None)
+        if ram.read_hooks or (next_event is not None and next_event() is not None):
+            self.reset()
+            return False
+        if ram.write_hooks or self.pages:
+            pages = self.hooked(ram)
+            if self.tripped or pages != self.pages or ram is not self.ram:
+                self.reset()
+                self.watch(ram, pages)
+        registers = tuple(cpu.reg.values)
+        ends = self.ends
+        if self.words is None:
+            if registers in ends:
+                ends.clear()
+                self.origin = registers
+                self.words = ram.snapshot()
+                self.start = cpu.cycle, executed
+                return False
+        elif registers == self.origin:
+            if ram.equals(self.words):
+                self.cycles, self.instructions = cpu.cycle - self.start[0], executed - self.start[1]
+                return True
+            self.words = ram.snapshot()
+            self.start = cpu.cycle, executed
+            ends.clear()
+            return False
+        if len(ends) >= self.limit:
+            self.reset()
+        self.ends.add(registers)
+        return False
+
+_BASIC_OPCODES = {opcode.value: opcode for opcode in Opcode}
+_NONBASIC_OPCODES = {opcode.value: opcode for opcode in NonBasicOpcode}
 
 class CPU():
+    __slots__ = ('reg', 'ram', 'cycle', 'hasher')
+
+    # address_for_operand's dispatch table, shared by every instance:
+    # operand code -> function(cpu, code) returning the operand's address
+    operands = {}
+    operands.update({x: lambda cpu, code: REGISTER_BASE + code for x in range(0x00, 0x08)})
+    operands.update({x + 0x08: lambda cpu, code: cpu.reg.values[code - 0x08] for x in range(0x00, 0x08)})
+    operands.update({x + 0x10: lambda cpu, code: (cpu.next_word() + cpu.reg.values[code - 0x10]) & 0xffff for x in range(0x00, 0x08)})
+
+    operands.update({
+        0x18: lambda cpu, code: cpu.pop_addr(),
+        0x19: lambda cpu, code: cpu.peek_addr(),
+        0x1a: lambda cpu, code: cpu.push_addr(),
+        0x1b: lambda cpu, code: REGISTER_BASE + SP,
+        0x1c: lambda cpu, code: REGISTER_BASE + PC,
+        0x1d: lambda cpu, code: REGISTER_BASE + O,
+        0x1e: lambda cpu, code: cpu.next_word(),
+    })
+
     # initial_registers must be a dictionary with a, b, c, x, y, z, i, j, pc, sp, o.
     def __init__(self, initial_registers=None, initial_ram=None, initial_cycle=0):
         if not initial_ram:
             initial_ram = RAM(word_length=16, size=2**16)
 
-        if not initial_registers:
-            initial_registers = {key: 0x0000 for key in DCPURegisterBank.all_regs}
-
-        self.reg = DCPURegisterBank(word_length=16, values=initial_registers)
+        self.reg = DCPURegisterBank(word_length=16, values=initial_registers or None)
         self.ram = initial_ram
         self.cycle = initial_cycle
+        # the RAM's StateHash, once state_hash() has been called
+        self.hasher = None
+
+    def snapshot(self):
+        return Snapshot(tuple(self.reg.values), self.cycle, self.ram.snapshot())
+
+    # registers are restored in place so that engines holding on to
+    # reg.values keep seeing the live registers
+    def restore(self, snap):
+        self.reg.values[:] = snap.registers
+        self.cycle = snap.cycle
+        self.ram.restore(snap.ram)
+
+    def fork(self):
+        registers = dict(zip(DCPURegisterBank.all_regs, self.reg.values))
+        return type(self)(initial_registers=registers, initial_ram=self.ram.copy(), initial_cycle=self.cycle)
+
+    # 64-bit digest of the registers and RAM (not the cycle), for memoizing
+    # visited states.  The first call starts a StateHash on the RAM, which
+    # costs one pass over it and a hook call per later write; after that
+    # each call is O(1).
+    def state_hash(self):
+        if self.hasher is None:
+            self.hasher = StateHash(self.ram)
+        return (self.hasher.value + sum(map(mul, self.reg.values, REGISTER_HASH_KEYS))) & HASH_MASK
 
-        self.operands = {}
-        self.operands.update({x: lambda code: self.reg.regs[code] for x in range(0x00, 0x08)})
-        self.operands.update({x + 0x08: lambda code: self.reg[self.reg.regs[code - 0x08]] for x in range(0x00, 0x08)})
-        self.operands.update({x + 0x10: lambda code: self.next_word() + self.reg[self.reg.regs[code - 0x10]] for x in range(0x00, 0x08)})
-
-        self.operands.update({
-            0x18: lambda code: self.pop_addr(),
-            0x19: lambda code: self.peek_addr(),
-            0x1a: lambda code: self.push_addr(),
-            0x1b: lambda code: 'sp',
-            0x1c: lambda code: 'pc',
-            0x1d: lambda code: 'o',
-            0x1e: lambda code: self.next_word(),
-        })
+    # True when the instruction at PC jumps to itself (SET PC, <its own
+    # address> or a one-word SUB PC, 1), so the machine can never leave it
+    def is_halted(self):
+        pc = self.reg.values[PC]
+        instruction = DECODE_TABLE[self.ram.get(pc)]
+        if instruction.a != 0x1c:
+            return False
+        if instruction.opcode is Opcode.SUB:
+            return instruction.b_literal == 1
+        if instruction.opcode is not Opcode.SET:
+            return False
+        if instruction.b == 0x1f:
+            return self.ram.get((pc + 1) & 0xffff) == pc
+        return instruction.b_literal == pc
 
     def next_word(self):
-        word = self.ram.get(self.reg.pc)
-        self.reg.pc += 1
-        return word
+        values = self.reg.values
+        pc = values[PC]
+        values[PC] = (pc + 1) & 0xffff
+        ram = self.ram
+        return (ram.peek_and_notify if ram.read_pages[pc >> PAGE_SHIFT] else ram.read)(pc)
 
     def pop_addr(self):
-        address = self.reg.sp
-        self.reg.sp += 1
+        values = self.reg.values
+        address = values[SP]
+        values[SP] = (address + 1) & 0xffff
         return address
 
     def push_addr(self):
-        self.reg.sp -= 1
-        return self.reg.sp
+        values = self.reg.values
+        values[SP] = address = (values[SP] - 1) & 0xffff
+        return address
 
     def peek_addr(self):
-        return self.reg.sp
+        return self.reg.values[SP]
 
     def needs_next_word(self, operand):
-        return (0x10 <= operand <= 0x17) or operand in [0x1e, 0x1f]
+        return needs_next_word(operand)
 
     # This has side effects (it can increment PC or affect SP)
     def address_for_operand(self, operand):
         if self.needs_next_word(operand):
             self.cycle += 1
         try:
-            return self.operands[operand](operand)
+            return self.operands[operand](self, operand)
         except KeyError:
             return None
 
@@ -150,16 +788,20 @@ class CPU():
                 return self.next_word()
             elif 0x20 <= code <= 0x3f:
                 return code - 0x20
-        elif isinstance(address, int):
-            return self.ram.get(address)
+        elif address < REGISTER_BASE:
+            ram = self.ram
+            return (ram.peek_and_notify if ram.read_pages[address >> PAGE_SHIFT] else ram.read)(address)
         else:
-            return self.reg[address]
+            return self.reg.values[address - REGISTER_BASE]
 
     def set_by_address(self, address, value):
-        if isinstance(address, int):
-            self.ram.set(address, value)
+        if address is None:
+            return
+        if address < REGISTER_BASE:
+            ram = self.ram
+            (ram.poke_and_notify if ram.write_pages[address >> PAGE_SHIFT] else ram.write)(address, value & 0xffff)
         else:
-            self.reg[address] = value
+            self.reg.values[address - REGISTER_BASE] = value & 0xffff
 
     def get_by_code(self, code, return_addr=False):
         addr = self.address_for_operand(code)
@@ -174,119 +816,240 @@ class CPU():
             pass
 
     def step(self):
-        word = self.next_word()
-        b, a, o = decompile_word(word)
-
-        opcode = Opcode(o)
-        if opcode == Opcode.NONBASIC:
-            opcode = NonBasicOpcode(a)
-            a, b = b, None
-
-        a_val, addr = self.get_by_code(a, return_addr=True)
-        operation = getattr(self, opcode.name)
-        if not isinstance(opcode, NonBasicOpcode):
-            b_val = self.get_by_code(b)
-            operation(a_val, b_val, addr)
+        values = self.reg.values
+        pc = values[PC]
+        values[PC] = (pc + 1) & 0xffff
+        ram = self.ram
+        instruction = DECODE_TABLE[(ram.peek_and_notify if ram.read_pages[pc >> PAGE_SHIFT] else ram.read)(pc)]
+        self.cycle += instruction.cycles
+        a_val, addr = instruction.a_resolve(self)
+        b_val = instruction.b_resolve(self)[0]
+        instruction.handler(self, a_val, b_val, addr)
+
+    # Runs until a limit is reached.  Limits are checked before each
+    # instruction: max_cycles may be overshot by the last instruction's cost,
+    # until_pc stops before executing the instruction at that address and
+    # stop(cpu) is called before every instruction if given.  Without stop,
+    # loops that provably repeat forever are skipped over (see fast_forward),
+    # and a run without limits stops with StopReason.HALTED on one.
+    def run(self, max_cycles=None, max_instructions=None, until_pc=None, stop=None):
+        values = self.reg.values
+        ram = self.ram
+        read, read_pages = ram.read, ram.read_pages
+        table = DECODE_TABLE
+        start_cycle = self.cycle
+        cycle_limit = start_cycle + max_cycles if max_cycles is not None else float('inf')
+        instruction_limit = max_instructions if max_instructions is not None else float('inf')
+        if until_pc is None:
+            until_pc = -1
+        executed = 0
+        loops = {}
+        try:
+            while self.cycle < cycle_limit and executed < instruction_limit:
+                pc = values[PC]
+                if pc == until_pc:
+                    return RunResult(executed, self.cycle - start_cycle, StopReason.UNTIL_PC)
+                if stop is not None and stop(self):
+                    return RunResult(executed, self.cycle - start_cycle, StopReason.STOP)
+                values[PC] = (pc + 1) & 0xffff
+                instruction = table[(ram.peek_and_notify if read_pages[pc >> PAGE_SHIFT] else read)(pc)]
+                self.cycle += instruction.cycles
+                a_val, addr = instruction.a_resolve(self)
+                instruction.handler(self, a_val, instruction.b_resolve(self)[0], addr)
+                executed += 1
+                if values[PC] <= pc and stop is None:
+                    skipped = self.fast_forward(loops, pc, executed, cycle_limit, instruction_limit)
+                    if skipped is None:
+                        return RunResult(executed, self.cycle - start_cycle, StopReason.HALTED)
+                    executed += skipped
+        finally:
+            for loop in loops.values():
+                loop.disarm()
+        reason = StopReason.MAX_CYCLES if self.cycle >= cycle_limit else StopReason.MAX_INSTRUCTIONS
+        return RunResult(executed, self.cycle - start_cycle, reason)
+
+    # Busy-wait detection, called by run engines after an instruction (or
+    # block) at key has jumped backwards, with the run's instruction count
+    # so far and its limits.  A jump that lands on the same registers twice
+    # in a row with RAM unchanged in between, and without calling any write
+    # hook, has put the machine in a state it has been in before, so it will
+    # repeat the same iteration forever.  The whole iterations that fit
+    # inside the limits are then skipped by adding their cycles at once,
+    # which leaves exactly the state stepping them would have.  Returns the
+    # number of instructions skipped, or None when the loop never ends and
+    # there are no limits.  Read hooks disable the detection, since reads
+    # can have effects.
+    def fast_forward(self, loops, key, executed, cycle_limit, instruction_limit):
+        ram = self.ram
+        if ram.read_hooks:
+            return 0
+        values = self.reg.values
+        loop = loops.get(key)
+        if loop is None or loop.target != values[PC]:
+            loop = loops[key] = Loop(values[PC])
+        elif loop.wait:
+            loop.wait -= 1
+            return 0
+        registers = tuple(values)
+        if registers != loop.registers or (
+                loop.words is not None and (loop.tripped or not ram.equals(loop.words))):
+            # Not a repeat: look again after a while, and less often each
+            # time.  A loop that does repeat still does when looked at
+            # every few iterations.
+            loop.disarm()
+            loop.registers = registers
+            loop.wait = loop.backoff
+            loop.backoff = min(loop.backoff * 2, 1024)
+            return 0
+        if loop.words is None:
+            loop.arm(ram, self.cycle, executed)
+            return 0
+        cycles, instructions = self.cycle - loop.cycle, executed - loop.executed
+        loop.disarm()
+        loop.registers = None
+        if cycle_limit == float('inf') and instruction_limit == float('inf'):
+            return None
+        if instruction_limit == float('inf'):
+            repeats = (cycle_limit - self.cycle) // cycles
+        elif cycle_limit == float('inf'):
+            repeats = (instruction_limit - executed) // instructions
         else:
-            operation(a_val, addr)
+            repeats = min((cycle_limit - self.cycle) // cycles, (instruction_limit - executed) // instructions)
+        self.cycle += repeats * cycles
+        return repeats * instructions
 
     def SET(self, a, b, addr):
-        self.cycle += 1
         self.set_by_address(addr, b)
 
     def ADD(self, a, b, addr):
-        self.cycle += 2
         value = a + b
         self.set_by_address(addr, value)
-        self.reg.o = 0 if value < 2**16 else 0x0001
+        self.reg.values[O] = 0 if value < 2**16 else 0x0001
 
     def SUB(self, a, b, addr):
-        self.cycle += 2
         value = a - b
         self.set_by_address(addr, value)
-        self.reg.o = 0 if value >= 0 else 0xffff
+        self.reg.values[O] = 0 if value >= 0 else 0xffff
 
     def MUL(self, a, b, addr):
-        self.cycle += 2
         self.set_by_address(addr, a*b)
-        self.reg.o = ((a*b)>>16)&0xffff
+        self.reg.values[O] = ((a*b)>>16)&0xffff
 
     def DIV(self, a, b, addr):
-        self.cycle += 3
         try:
             self.set_by_address(addr, a // b)
-            self.reg.o = ((a<<16)//b)&0xffff
+            self.reg.values[O] = ((a<<16)//b)&0xffff
         except ZeroDivisionError:
             self.set_by_address(addr, 0)
 
     def MOD(self, a, b, addr):
-        self.cycle += 3
         try:
             self.set_by_address(addr, a % b)
         except ZeroDivisionError:
             self.set_by_address(addr, 0)
 
     def SHL(self, a, b, addr):
-        self.cycle += 2
         self.set_by_address(addr, a<<b)
-        self.reg.o = ((a<<b)>>16)&0xffff
+        self.reg.values[O] = ((a<<b)>>16)&0xffff
 
     def SHR(self, a, b, addr):
-        self.cycle += 2
         self.set_by_address(addr, a>>b)
-        self.reg.o = ((a<<16)>>b)&0xffff
+        self.reg.values[O] = ((a<<16)>>b)&0xffff
 
     def AND(self, a, b, addr):
-        self.cycle += 1
         self.set_by_address(addr, a & b)
 
     def BOR(self, a, b, addr):
-        self.cycle += 1
         self.set_by_address(addr, a | b)
 
     def XOR(self, a, b, addr):
-        self.cycle += 1
         self.set_by_address(addr, a ^ b)
 
     def IFE(self, a, b, addr):
-        self.cycle += 2
         if a == b:
             pass
         else:
             self.skip_next_and_cycle()
 
     def IFN(self, a, b, addr):
-        self.cycle += 2
         if a != b:
             pass
         else:
             self.skip_next_and_cycle()
 
     def IFG(self, a, b, addr):
-        self.cycle += 2
         if a > b:
             pass
         else:
             self.skip_next_and_cycle()
 
     def IFB(self, a, b, addr):
-        self.cycle += 2
         if a & b != 0:
             pass
         else:
             self.skip_next_and_cycle()
 
     def skip_next_and_cycle(self):
-        word = self.next_word() # this increments PC!
-        b, a, o = decompile_word(word)
-        if self.needs_next_word(a):
-            self.next_word()
-        if self.needs_next_word(b):
-            self.next_word()
+        instruction = DECODE_TABLE[self.next_word()] # this increments PC!
+        values = self.reg.values
+        values[PC] = (values[PC] + instruction.next_words) & 0xffff
         self.cycle += 1
 
-    def JSR(self, a, addr):
-        self.cycle += 2
+    def JSR(self, a, b, addr):
         addr = self.push_addr()
-        self.set_by_address(addr, self.reg.pc)
-        self.reg.pc = a
+        self.set_by_address(addr, self.reg.values[PC])
+        self.reg.values[PC] = a
+
+HANDLERS = {opcode: getattr(CPU, opcode.name) for opcode in CYCLES}
+
+# Every possible instruction word, decoded once per process.
+DECODE_TABLE = tuple(decode(word) for word in range(0x10000))
+
+# Raised by a run_steps step to end the run with reason, counting executed
+# more instructions than the step had returned before
+class StopRun(Exception):
+    def __init__(self, reason, executed=0):
+        super().__init__(reason)
+        self.reason = reason
+        self.executed = executed
+
+# The run loop of the engines that instrument or replace CPU.run's dispatch:
+# same arguments, limits and result as CPU.run.  step(pc, cycle_limit,
+# instructions_left) runs the instruction (or instructions) at PC, which is
+# pc, and returns how many it ran, or raises StopRun.  With skip_loops,
+# busy waits are fast-forwarded as in CPU.run.  Without it every
+# instruction is stepped, and a run without limits or stop only ends with
+# StopReason.HALTED on an instruction that jumps to itself (see is_halted).
+def run_steps(cpu, step, max_cycles=None, max_instructions=None, until_pc=None, stop=None, skip_loops=True):
+    values = cpu.reg.values
+    start_cycle = cpu.cycle
+    cycle_limit = start_cycle + max_cycles if max_cycles is not None else float('inf')
+    instruction_limit = max_instructions if max_instructions is not None else float('inf')
+    if until_pc is None:
+        until_pc = -1
+    unlimited = cycle_limit == float('inf') and instruction_limit == float('inf')
+    executed = 0
+    loops = {}
+    try:
+        while cpu.cycle < cycle_limit and executed < instruction_limit:
+            pc = values[PC]
+            if pc == until_pc:
+                return RunResult(executed, cpu.cycle - start_cycle, StopReason.UNTIL_PC)
+            if stop is not None and stop(cpu):
+                return RunResult(executed, cpu.cycle - start_cycle, StopReason.STOP)
+            executed += step(pc, cycle_limit, instruction_limit - executed)
+            if values[PC] <= pc and stop is None:
+                if skip_loops:
+                    skipped = cpu.fast_forward(loops, pc, executed, cycle_limit, instruction_limit)
+                    if skipped is None:
+                        return RunResult(executed, cpu.cycle - start_cycle, StopReason.HALTED)
+                    executed += skipped
+                elif unlimited and values[PC] == pc and cpu.is_halted():
+                    return RunResult(executed, cpu.cycle - start_cycle, StopReason.HALTED)
+    except StopRun as stopped:
+        return RunResult(executed + stopped.executed, cpu.cycle - start_cycle, stopped.reason)
+    finally:
+        for loop in loops.values():
+            loop.disarm()
+    reason = StopReason.MAX_CYCLES if cpu.cycle >= cycle_limit else StopReason.MAX_INSTRUCTIONS
+    return RunResult(executed, cpu.cycle - start_cycle, reason)
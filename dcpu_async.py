@@ -0,0 +1,150 @@
+import asyncio
+
+from dcpu import DirtyTracker, RunResult, SpinCheck, StopReason
+
+# asyncio driver: each machine runs in cycle-budgeted slices and sleeps
+# between them so that its cycle counter tracks the event loop's clock at
+# the given frequency.  Every slice ends with an await, so other machines
+# and I/O get to run in between.  A machine that halts, hits until_pc or is
+# stopped finishes its run() coroutine.  A machine that SpinCheck proves is
+# busy-waiting is parked: it awaits a write to its RAM (or request_stop())
+# without running.  With a frequency, it is then credited with the whole
+# repeats of its loop that the clock says it would have run, which leaves
+# the state stepping them would, so its cycle counter keeps pace with the
+# clock and a max_cycles run still ends on time.  Unthrottled machines have
+# no clock to keep pace with, and their cycle counter stops while parked.
+
+DEFAULT_FREQUENCY = 100000 # DCPU-16 cycles per second
+
+class WriteWatch(DirtyTracker):
+    # a DirtyTracker whose wait() blocks until something has been written
+    def __init__(self, ram, start, stop, shift=0):
+        self.written = asyncio.Event()
+        super().__init__(ram, start, stop, shift)
+
+    def hook(self, start, stop):
+        super().hook(start, stop)
+        if self.changed:
+            self.written.set()
+
+    async def wait(self):
+        await self.written.wait()
+        self.written.clear()
+        return self.take()
+
+class AsyncMachine():
+    # engine is anything with CPU.run's signature (CPU, BlockCompiler,
+    # DeviceBus, ...); frequency=None runs unthrottled but still yields
+    # after every slice
+    def __init__(self, cpu, engine=None, frequency=DEFAULT_FREQUENCY, slice_cycles=None, max_lag=0.1):
+        self.cpu = cpu
+        self.engine = engine if engine is not None else cpu
+        self.frequency = frequency
+        if slice_cycles is None:
+            slice_cycles = frequency // 100 if frequency else 10000
+        self.slice_cycles = slice_cycles
+        # a machine that falls further behind the clock than this many
+        # seconds gives up on catching up rather than running unthrottled
+        self.max_lag = max_lag
+        self.halted = asyncio.Event()
+        # set by RAM writes and request_stop() while parked
+        self.woken = asyncio.Event()
+        self.parked = False
+        self.stopping = False
+        self.result = None
+        self.error = None
+
+    def watch_writes(self, start, stop, shift=0):
+        return WriteWatch(self.cpu.ram, start, stop, shift)
+
+    # makes run() return with StopReason.STOP after the current slice
+    def request_stop(self):
+        self.stopping = True
+        self.woken.set()
+
+    def wake(self, start=None, stop=None):
+        self.woken.set()
+
+    # waits without running until the RAM is written, a stop is requested
+    # or timeout seconds have passed
+    async def park(self, timeout=None):
+        ram = self.cpu.ram
+        self.woken.clear()
+        self.parked = True
+        ram.add_write_hook(self.wake)
+        try:
+            await asyncio.wait_for(self.woken.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            ram.remove_write_hook(self.wake)
+            self.parked = False
+
+    # Runs until max_cycles, until_pc, stop(cpu) (checked as in the engine),
+    # request_stop() or a halt; halted is set when it returns.  A ValueError
+    # from an invalid instruction is stored in error and re-raised.
+    async def run(self, max_cycles=None, until_pc=None, stop=None):
+        cpu = self.cpu
+        loop = asyncio.get_running_loop()
+        self.halted.clear()
+        self.stopping = False
+        self.error = None
+        start_cycle = cpu.cycle
+        cycle_limit = start_cycle + max_cycles if max_cycles is not None else None
+        base_time, base_cycle = loop.time(), cpu.cycle
+        executed = 0
+        reason = None
+        spin = SpinCheck()
+        try:
+            while reason is None:
+                cycles = self.slice_cycles
+                if cycle_limit is not None:
+                    cycles = min(cycles, cycle_limit - cpu.cycle)
+                result = self.engine.run(max_cycles=cycles, until_pc=until_pc, stop=stop)
+                executed += result.instructions
+                if result.reason in (StopReason.UNTIL_PC, StopReason.STOP):
+                    reason = result.reason
+                elif cycle_limit is not None and cpu.cycle >= cycle_limit:
+                    reason = StopReason.MAX_CYCLES
+                elif self.stopping:
+                    reason = StopReason.STOP
+                elif cpu.is_halted():
+                    reason = StopReason.HALTED
+                elif stop is None and spin.check(cpu, self.engine, executed):
+                    timeout = None
+                    if self.frequency and cycle_limit is not None:
+                        timeout = base_time + (cycle_limit - base_cycle) / self.frequency - loop.time()
+                    await self.park(timeout)
+                    if self.frequency:
+                        target = base_cycle + int((loop.time() - base_time) * self.frequency)
+                        if cycle_limit is not None:
+                            target = min(target, cycle_limit)
+                        repeats = max(target - cpu.cycle, 0) // spin.cycles
+                        cpu.cycle += repeats * spin.cycles
+                        executed += repeats * spin.instructions
+                    else:
+                        base_time, base_cycle = loop.time(), cpu.cycle
+                    spin.reset()
+                    if self.stopping:
+                        reason = StopReason.STOP
+                    continue
+
+                delay = 0
+                if self.frequency:
+                    delay = base_time + (cpu.cycle - base_cycle) / self.frequency - loop.time()
+                    if delay < -self.max_lag:
+                        base_time, base_cycle = loop.time(), cpu.cycle
+                        delay = 0
+                if reason is None or delay > 0:
+                    await asyncio.sleep(max(delay, 0))
+        except ValueError as error:
+            self.error = error
+            raise
+        finally:
+            spin.close()
+            self.result = RunResult(executed, cpu.cycle - start_cycle, reason)
+            self.halted.set()
+        return self.result
+
+async def run_machines(machines, **kwargs):
+    return await asyncio.gather(*(machine.run(**kwargs) for machine in machines))
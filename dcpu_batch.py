@@ -0,0 +1,219 @@
+import numpy as np
+
+from dcpu import (CPU, DECODE_TABLE, DCPURegisterBank, RAM, REGISTER_BASE,
+                  Opcode, NonBasicOpcode, PC, SP, O, needs_next_word)
+
+# Lockstep engine: N machines stepped together with numpy.  Each row of
+# `state` holds one machine's RAM followed by its registers, laid out in the
+# same address space that set_by_address uses, plus a sink word that
+# absorbs writes to literals.  Instances may diverge freely; every step
+# decodes each instance's own instruction and applies each opcode's
+# semantics to the instances currently executing it.
+
+SINK = REGISTER_BASE + len(DCPURegisterBank.all_regs)
+STATE_WORDS = SINK + 1
+
+JSR = 0x10 # opcode number used for JSR in OPCODES, after the basic opcodes
+
+def _instruction_tables():
+    opcodes = np.zeros(0x10000, dtype=np.int8)
+    a_codes = np.full(0x10000, 0x20, dtype=np.int64)
+    b_codes = np.full(0x10000, 0x20, dtype=np.int64)
+    cycles = np.zeros(0x10000, dtype=np.int64)
+    next_words = np.zeros(0x10000, dtype=np.int64)
+    for word, instruction in enumerate(DECODE_TABLE):
+        next_words[word] = instruction.next_words
+        if instruction.opcode is None:
+            continue
+        # operands of invalid instructions stay as literal 0 so that
+        # resolving them has no side effects
+        opcodes[word] = JSR if instruction.opcode is NonBasicOpcode.JSR else instruction.opcode.value
+        a_codes[word] = instruction.a
+        if instruction.b is not None:
+            b_codes[word] = instruction.b
+        cycles[word] = instruction.cycles
+    return opcodes, a_codes, b_codes, cycles, next_words
+
+OPCODES, A_CODES, B_CODES, CYCLES, NEXT_WORDS = _instruction_tables()
+NEEDS_NEXT_WORD = np.array([needs_next_word(code) for code in range(0x40)])
+
+class BatchCPU():
+    def __init__(self, count, initial_contents=None, initial_cycle=0):
+        self.count = count
+        self.state = np.zeros((count, STATE_WORDS), dtype=np.uint16)
+        self.ram = self.state[:, :0x10000]
+        self.registers = self.state[:, REGISTER_BASE:SINK]
+        self.cycles = np.full(count, initial_cycle, dtype=np.int64)
+        # instances that hit an invalid instruction stop running; the scalar
+        # CPU raises ValueError at the same point
+        self.faulted = np.zeros(count, dtype=bool)
+        if initial_contents is not None:
+            self.ram[:, :len(initial_contents)] = initial_contents
+
+    @classmethod
+    def from_cpus(cpu_class, cpus):
+        batch = cpu_class(len(cpus))
+        for index, cpu in enumerate(cpus):
+            batch.load(index, cpu)
+        return batch
+
+    def load(self, index, cpu):
+        assert cpu.ram.size == 0x10000 and cpu.ram.word_length == 16
+        self.ram[index] = np.frombuffer(cpu.ram.view, dtype=np.uint16)
+        self.registers[index] = cpu.reg.values
+        self.cycles[index] = cpu.cycle
+        self.faulted[index] = False
+
+    def cpu(self, index):
+        ram = RAM(word_length=16, size=0x10000)
+        np.frombuffer(ram.view, dtype=np.uint16)[:] = self.ram[index]
+        registers = dict(zip(DCPURegisterBank.all_regs, self.registers[index].tolist()))
+        return CPU(initial_registers=registers, initial_ram=ram, initial_cycle=int(self.cycles[index]))
+
+    # Resolves one operand code per row.  pc and sp are updated in place as
+    # next words are consumed and the stack is popped or pushed.  Returns
+    # (location, value) where location indexes into the state rows.
+    def resolve(self, rows, codes, pc, sp):
+        state = self.state
+        needs = NEEDS_NEXT_WORD[codes]
+        next_word = state[rows, pc].astype(np.int64)
+        pc[needs] = (pc[needs] + 1) & 0xffff
+        location = np.full(len(rows), SINK, dtype=np.int64)
+
+        mask = codes < 0x08
+        location[mask] = REGISTER_BASE + codes[mask]
+        mask = (codes >= 0x08) & (codes < 0x10)
+        location[mask] = state[rows[mask], REGISTER_BASE + codes[mask] - 0x08]
+        mask = (codes >= 0x10) & (codes < 0x18)
+        location[mask] = (next_word[mask] + state[rows[mask], REGISTER_BASE + codes[mask] - 0x10]) & 0xffff
+        mask = codes == 0x18
+        location[mask] = sp[mask]
+        sp[mask] = (sp[mask] + 1) & 0xffff
+        mask = codes == 0x19
+        location[mask] = sp[mask]
+        mask = codes == 0x1a
+        sp[mask] = (sp[mask] - 1) & 0xffff
+        location[mask] = sp[mask]
+        location[codes == 0x1b] = REGISTER_BASE + SP
+        location[codes == 0x1c] = REGISTER_BASE + PC
+        location[codes == 0x1d] = REGISTER_BASE + O
+        mask = codes == 0x1e
+        location[mask] = next_word[mask]
+
+        value = state[rows, location].astype(np.int64)
+        # PC and SP are tracked in pc/sp until the operands are resolved
+        mask = codes == 0x1b
+        value[mask] = sp[mask]
+        mask = codes == 0x1c
+        value[mask] = pc[mask]
+        mask = codes == 0x1f
+        value[mask] = next_word[mask]
+        mask = codes >= 0x20
+        value[mask] = codes[mask] - 0x20
+        return location, value
+
+    # Executes one instruction on every instance in rows (default: all
+    # instances that have not faulted).
+    def step(self, rows=None):
+        if rows is None:
+            rows = np.flatnonzero(~self.faulted)
+        if not len(rows):
+            return
+        state = self.state
+        pc = state[rows, REGISTER_BASE + PC].astype(np.int64)
+        sp = state[rows, REGISTER_BASE + SP].astype(np.int64)
+        word = state[rows, pc]
+        pc = (pc + 1) & 0xffff
+        opcodes = OPCODES[word]
+        self.cycles[rows] += CYCLES[word]
+
+        location, a = self.resolve(rows, A_CODES[word], pc, sp)
+        _, b = self.resolve(rows, B_CODES[word], pc, sp)
+        state[rows, REGISTER_BASE + PC] = pc
+        state[rows, REGISTER_BASE + SP] = sp
+
+        for opcode in np.unique(opcodes):
+            mask = opcodes == opcode
+            self.execute(int(opcode), rows[mask], a[mask], b[mask], location[mask])
+
+    def store(self, rows, location, value, o=None):
+        self.state[rows, location] = value
+        if o is not None:
+            self.state[rows, REGISTER_BASE + O] = o
+
+    def skip(self, rows):
+        pc = self.state[rows, REGISTER_BASE + PC].astype(np.int64)
+        skipped = self.state[rows, pc]
+        self.state[rows, REGISTER_BASE + PC] = (pc + 1 + NEXT_WORDS[skipped]) & 0xffff
+        self.cycles[rows] += 1
+
+    def execute(self, opcode, rows, a, b, location):
+        if opcode == 0:
+            self.faulted[rows] = True
+            return
+        if opcode == JSR:
+            sp = (self.state[rows, REGISTER_BASE + SP].astype(np.int64) - 1) & 0xffff
+            self.state[rows, REGISTER_BASE + SP] = sp
+            self.state[rows, sp] = self.state[rows, REGISTER_BASE + PC]
+            self.state[rows, REGISTER_BASE + PC] = a
+            return
+
+        opcode = Opcode(opcode)
+        if opcode is Opcode.SET:
+            self.store(rows, location, b)
+        elif opcode is Opcode.ADD:
+            value = a + b
+            self.store(rows, location, value & 0xffff, value >> 16)
+        elif opcode is Opcode.SUB:
+            value = a - b
+            self.store(rows, location, value & 0xffff, np.where(value < 0, 0xffff, 0))
+        elif opcode is Opcode.MUL:
+            value = a * b
+            self.store(rows, location, value & 0xffff, (value >> 16) & 0xffff)
+        elif opcode is Opcode.DIV:
+            zero = b == 0
+            self.store(rows[zero], location[zero], 0)
+            rows, a, b, location = rows[~zero], a[~zero], b[~zero], location[~zero]
+            self.store(rows, location, a // b, ((a << 16) // b) & 0xffff)
+        elif opcode is Opcode.MOD:
+            zero = b == 0
+            self.store(rows, location, np.where(zero, 0, a % np.where(zero, 1, b)))
+        elif opcode is Opcode.SHL:
+            # shifting by 32 or more clears both words, as it does in Python
+            value = a << np.minimum(b, 32)
+            self.store(rows, location, value & 0xffff, (value >> 16) & 0xffff)
+        elif opcode is Opcode.SHR:
+            shift = np.minimum(b, 32)
+            self.store(rows, location, a >> shift, ((a << 16) >> shift) & 0xffff)
+        elif opcode is Opcode.AND:
+            self.store(rows, location, a & b)
+        elif opcode is Opcode.BOR:
+            self.store(rows, location, a | b)
+        elif opcode is Opcode.XOR:
+            self.store(rows, location, a ^ b)
+        elif opcode is Opcode.IFE:
+            self.skip(rows[a != b])
+        elif opcode is Opcode.IFN:
+            self.skip(rows[a == b])
+        elif opcode is Opcode.IFG:
+            self.skip(rows[a <= b])
+        elif opcode is Opcode.IFB:
+            self.skip(rows[(a & b) == 0])
+
+    # Steps every instance until it has consumed max_cycles or executed
+    # max_instructions, with the same limit semantics as CPU.run.  Returns
+    # the number of instructions each instance executed.
+    def run(self, max_cycles=None, max_instructions=None):
+        cycle_limit = self.cycles + max_cycles if max_cycles is not None else None
+        executed = np.zeros(self.count, dtype=np.int64)
+        while True:
+            active = ~self.faulted
+            if cycle_limit is not None:
+                active &= self.cycles < cycle_limit
+            if max_instructions is not None:
+                active &= executed < max_instructions
+            rows = np.flatnonzero(active)
+            if not len(rows):
+                return executed
+            self.step(rows)
+            executed[rows] += 1
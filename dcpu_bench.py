@@ -0,0 +1,173 @@
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from dcpu import CPU, RAM, Opcode
+from dcpu_compiler import BlockCompiler
+from dcpu_fusion import Fuser
+from dcpu_testing import ARITHMETIC, EXAMPLE, MEMCPY, RECURSION, A, B, C, X, PC, literal, op
+
+# Benchmark suite: runs a fixed set of programs on each engine and reports
+# instructions and emulated cycles per second, plus CPU() construction time
+# and memory.  Results are written as JSON; given a baseline, any metric
+# worse than the baseline by more than the threshold fails the run.
+#
+#     python dcpu_bench.py --output before.json
+#     python dcpu_bench.py --baseline before.json --threshold 0.1
+
+BRANCHES = [op(Opcode.ADD, A, literal(1)),
+            op(Opcode.IFG, A, literal(31)),
+            op(Opcode.SET, A, literal(0)),
+            op(Opcode.IFE, A, literal(7)),
+            op(Opcode.ADD, B, literal(1)),
+            op(Opcode.IFB, A, literal(1)),
+            op(Opcode.ADD, C, literal(1)),
+            op(Opcode.IFN, A, B),
+            op(Opcode.XOR, X, A),
+            op(Opcode.SET, PC, literal(0))]
+
+WORKLOADS = {
+    'example': EXAMPLE,
+    'arithmetic': ARITHMETIC,
+    'memcpy': MEMCPY,
+    'recursion': RECURSION,
+    'branches': BRANCHES,
+}
+
+def run_interpreter(cpu, cycles):
+    return cpu.run(max_cycles=cycles)
+
+def run_blocks(cpu, cycles):
+    return BlockCompiler(cpu).run(max_cycles=cycles)
+
+def run_fused(cpu, cycles):
+    return Fuser(cpu).run(max_cycles=cycles)
+
+ENGINES = {
+    'run': run_interpreter,
+    'blocks': run_blocks,
+    'fused': run_fused,
+}
+
+# Busy-wait fast-forwarding turned off, so that workloads ending in a loop
+# (example) or repeating exactly (memcpy) measure emulation speed rather
+# than skipped cycles
+class BenchCPU(CPU):
+    __slots__ = ()
+
+    def fast_forward(self, loops, key, executed, cycle_limit, instruction_limit):
+        return 0
+
+def bench_workload(words, engine, cycles, repeat=3):
+    best = None
+    for _ in range(repeat):
+        cpu = BenchCPU(initial_ram=RAM(word_length=16, size=0x10000, initial_contents=words))
+        start = time.perf_counter()
+        result = ENGINES[engine](cpu, cycles)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = elapsed, result
+    elapsed, result = best
+    return {
+        'instructions_per_second': result.instructions / elapsed,
+        'cycles_per_second': result.cycles / elapsed,
+    }
+
+# seconds and bytes per CPU(), and the number of objects the garbage
+# collector has to free after count machines are dropped (0 when they are
+# freed by reference counting alone)
+def bench_construction(count=2000, repeat=3):
+    gc.collect()
+    for _ in range(count):
+        CPU()
+    garbage = gc.collect()
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(count):
+            CPU()
+        elapsed = (time.perf_counter() - start) / count
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        # held until it is measured, since a dropped CPU would be freed first
+        cpu = CPU()
+        size = tracemalloc.get_traced_memory()[0] - before
+        del cpu
+    finally:
+        tracemalloc.stop()
+    return {'seconds': best, 'bytes': size, 'garbage': garbage}
+
+def run_benchmarks(engines=tuple(ENGINES), workloads=tuple(WORKLOADS), cycles=200000, repeat=3):
+    results = {}
+    for name in workloads:
+        for engine in engines:
+            results['%s.%s' % (name, engine)] = bench_workload(WORKLOADS[name], engine, cycles, repeat)
+    results['construction'] = bench_construction(repeat=repeat)
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'cycles': cycles,
+        'results': results,
+    }
+
+def higher_is_better(metric):
+    return metric.endswith('_per_second')
+
+# Returns (benchmark, metric, baseline, current) for every metric that is
+# worse than the baseline by more than threshold, as a fraction.
+def compare(report, baseline, threshold=0.1):
+    regressions = []
+    for name, metrics in report['results'].items():
+        for metric, value in metrics.items():
+            old = baseline['results'].get(name, {}).get(metric)
+            if old is None:
+                continue
+            if higher_is_better(metric):
+                worse = value < old * (1 - threshold)
+            else:
+                worse = value > old * (1 + threshold)
+            if worse:
+                regressions.append((name, metric, old, value))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the DCPU-16 emulator.')
+    parser.add_argument('--engine', action='append', choices=sorted(ENGINES))
+    parser.add_argument('--workload', action='append', choices=sorted(WORKLOADS))
+    parser.add_argument('--cycles', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.engine or tuple(ENGINES), args.workload or tuple(WORKLOADS),
+                            args.cycles, args.repeat)
+    for name, metrics in report['results'].items():
+        if 'cycles_per_second' in metrics:
+            print('%-22s %8.3f MHz %12.0f instr/s' % (
+                name, metrics['cycles_per_second'] / 1e6, metrics['instructions_per_second']))
+        else:
+            print('%-22s %8.1f us %12d bytes %6d garbage' % (
+                name, metrics['seconds'] * 1e6, metrics['bytes'], metrics['garbage']))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(report, json.load(baseline), args.threshold)
+        for name, metric, old, new in regressions:
+            print('REGRESSION %s %s: %g -> %g' % (name, metric, old, new))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,436 @@
+from dcpu import (CONDITIONS, DECODE_TABLE, Opcode, NonBasicOpcode, PAGE_SHIFT, PC,
+                  SP, O, RunResult, StopReason, needs_next_word, pages_in_range)
+
+# Block execution engine: straight-line runs of instructions are translated
+# into Python functions specialized for their operands and cached by start
+# address.  Registers live in locals while a block runs and are written back
+# at every exit, so device hooks fired from inside a block see register
+# values as of the start of the block.  cpu.cycle is brought up to date
+# before every RAM write, so hooks see the cycle count CPU.run would give
+# them: the end of the writing instruction.
+
+REGISTER_LOCALS = ('ra', 'rb', 'rc', 'rx', 'ry', 'rz', 'ri', 'rj')
+LOCAL_INDICES = dict(zip(REGISTER_LOCALS, range(8)), rsp=SP, ro=O)
+
+PLAIN, IF, CONDITIONAL, TERMINAL_IF = range(4)
+
+def writes_pc(instruction):
+    return (instruction.opcode is NonBasicOpcode.JSR or
+            (instruction.a == 0x1c and instruction.opcode not in CONDITIONS))
+
+class Block():
+    __slots__ = ('start', 'end', 'length', 'max_cycles', 'function', 'source')
+
+    def __init__(self, start, end, length, max_cycles, function, source):
+        self.start = start
+        self.end = end
+        self.length = length
+        self.max_cycles = max_cycles
+        self.function = function
+        self.source = source
+
+    def __repr__(self):
+        return '<Block 0x%04x-0x%04x>' % (self.start, self.end)
+
+# Index into the RAM's read_pages or write_pages for an address, an int or
+# an expression: the notify variants are only called for pages with hooks
+def _page(address):
+    if isinstance(address, int):
+        return str(address >> PAGE_SHIFT)
+    return '%s >> %d' % (address, PAGE_SHIFT)
+
+class _Generator():
+    # Emits the body of one block.  It runs twice: once to find out which
+    # registers are written, and again to emit exits that write them back.
+    def __init__(self, start, end, written):
+        self.start = start
+        self.end = end
+        self.written = written
+        self.used = set()
+        self.lines = []
+        self.depth = 1
+        self.cycles = 0
+        self.count = 0
+
+    def emit(self, line):
+        self.lines.append('    ' * self.depth + line)
+
+    def flush(self):
+        if self.cycles:
+            self.emit('cy += %d' % self.cycles)
+        if self.count:
+            self.emit('n += %d' % self.count)
+        self.cycles = self.count = 0
+
+    def exit(self, pc):
+        if isinstance(pc, int):
+            pc &= 0xffff
+        for local in sorted(self.written or ()):
+            self.emit('r[%d] = %s' % (LOCAL_INDICES[local], local))
+        self.emit('r[%d] = %s' % (PC, pc))
+        self.emit('cpu.cycle = c0 + cy + %d' % self.cycles)
+        self.emit('return n + %d' % self.count)
+
+    def write(self, address, value):
+        self.emit('cpu.cycle = c0 + cy + %d' % self.cycles)
+        self.emit('(ram.poke_and_notify if wp[%s] else write)(%s, %s)' % (_page(address), address, value))
+
+    def write_register(self, local):
+        self.used.add(local)
+        if self.written is None:
+            self.collected.add(local)
+
+    def read(self, role, address, need_value):
+        if not need_value:
+            return None
+        self.emit('%sv = (ram.peek_and_notify if rp[%s] else read)(%s)' % (role, _page(address), address))
+        return role + 'v'
+
+    # Returns (value expression, target), where target is ('reg', local),
+    # ('pc',), ('ram', address expression, static address or None) or None
+    # for literals.
+    def operand(self, role, code, words, pc, need_value, snapshot_sp):
+        if code < 0x08:
+            local = REGISTER_LOCALS[code]
+            self.used.add(local)
+            return local, ('reg', local)
+        if code < 0x10:
+            local = REGISTER_LOCALS[code - 0x08]
+            self.used.add(local)
+            return self.read(role, local, need_value), ('ram', local, None)
+        if code < 0x18:
+            local = REGISTER_LOCALS[code - 0x10]
+            self.used.add(local)
+            address = role + 'a'
+            self.emit('%s = (%d + %s) & 0xffff' % (address, next(words), local))
+            return self.read(role, address, need_value), ('ram', address, None)
+        if code in (0x18, 0x19, 0x1a):
+            address = role + 'a'
+            if code == 0x1a:
+                self.write_register('rsp')
+                self.emit('rsp = (rsp - 1) & 0xffff')
+            self.used.add('rsp')
+            self.emit('%s = rsp' % address)
+            if code == 0x18:
+                self.write_register('rsp')
+                self.emit('rsp = (rsp + 1) & 0xffff')
+            return self.read(role, address, need_value), ('ram', address, None)
+        if code == 0x1b:
+            self.used.add('rsp')
+            if snapshot_sp and need_value:
+                self.emit('%sv = rsp' % role)
+                return role + 'v', ('reg', 'rsp')
+            return 'rsp', ('reg', 'rsp')
+        if code == 0x1c:
+            return str(pc), ('pc',)
+        if code == 0x1d:
+            self.used.add('ro')
+            return 'ro', ('reg', 'ro')
+        if code == 0x1e:
+            address = next(words)
+            return self.read(role, address, need_value), ('ram', str(address), address)
+        if code == 0x1f:
+            return str(next(words)), None
+        return str(code - 0x20), None
+
+    def store(self, target, value):
+        if target is None:
+            return
+        if target[0] == 'reg':
+            self.write_register(target[1])
+            self.emit('%s = %s' % (target[1], value))
+        elif target[0] == 'pc':
+            self.emit('npc = %s' % value)
+        else:
+            self.write(target[1] if target[2] is None else target[2], value)
+
+    def set_o(self, value):
+        self.write_register('ro')
+        self.emit('ro = %s' % value)
+
+    # Emits one instruction.  Returns the condition expression for IFx,
+    # True if the instruction always leaves the block, False otherwise.
+    def instruction(self, pc, instruction, words):
+        self.cycles += instruction.cycles
+        self.count += 1
+        opcode = instruction.opcode
+        next_pc = pc + 1 + instruction.next_words
+        words = iter(words)
+        snapshot_sp = instruction.b in (0x18, 0x1a)
+        a, target = self.operand('a', instruction.a, words, pc + 1,
+                                 opcode is not Opcode.SET, snapshot_sp)
+        if instruction.b is not None:
+            b, _ = self.operand('b', instruction.b, words, pc + 1 + needs_next_word(instruction.a), True, False)
+
+        if opcode in CONDITIONS:
+            return CONDITIONS[opcode].format(a=a, b=b)
+        if opcode is NonBasicOpcode.JSR:
+            if a == 'rsp':
+                self.emit('av = rsp')
+                a = 'av'
+            self.write_register('rsp')
+            self.emit('rsp = (rsp - 1) & 0xffff')
+            self.write('rsp', next_pc)
+            self.exit(a)
+            return True
+
+        if opcode is Opcode.SET:
+            self.store(target, b)
+        elif opcode is Opcode.ADD:
+            self.emit('v = %s + %s' % (a, b))
+            self.store(target, 'v & 0xffff')
+            self.set_o('v >> 16')
+        elif opcode is Opcode.SUB:
+            self.emit('v = %s - %s' % (a, b))
+            self.store(target, 'v & 0xffff')
+            self.set_o('0xffff if v < 0 else 0')
+        elif opcode is Opcode.MUL:
+            self.emit('v = %s * %s' % (a, b))
+            self.store(target, 'v & 0xffff')
+            self.set_o('(v >> 16) & 0xffff')
+        elif opcode is Opcode.DIV:
+            # (a << 16) // b holds both a // b and the overflow word
+            if b != '0':
+                if not b.isdigit():
+                    self.emit('if %s:' % b)
+                    self.depth += 1
+                self.emit('v = (%s << 16) // %s' % (a, b))
+                self.store(target, 'v >> 16')
+                self.set_o('v & 0xffff')
+                if not b.isdigit():
+                    self.depth -= 1
+                    self.emit('else:')
+                    self.depth += 1
+                    self.store(target, '0')
+                    if target is None:
+                        self.emit('pass')
+                    self.depth -= 1
+            else:
+                self.store(target, '0')
+        elif opcode is Opcode.MOD:
+            if b.isdigit():
+                self.store(target, '%s %% %s' % (a, b) if b != '0' else '0')
+            else:
+                self.store(target, '%s %% %s if %s else 0' % (a, b, b))
+        elif opcode is Opcode.SHL:
+            self.emit('v = %s << %s' % (a, b))
+            self.store(target, 'v & 0xffff')
+            self.set_o('(v >> 16) & 0xffff')
+        elif opcode is Opcode.SHR:
+            # (a << 16) >> b holds both a >> b and the overflow word
+            self.emit('v = (%s << 16) >> %s' % (a, b))
+            self.store(target, 'v >> 16')
+            self.set_o('v & 0xffff')
+        elif opcode is Opcode.AND:
+            self.store(target, '%s & %s' % (a, b))
+        elif opcode is Opcode.BOR:
+            self.store(target, '%s | %s' % (a, b))
+        elif opcode is Opcode.XOR:
+            self.store(target, '%s ^ %s' % (a, b))
+
+        if target is None:
+            return False
+        if target[0] == 'pc':
+            self.exit('npc')
+            return True
+        if target[0] == 'ram':
+            # self-modifying code: leave the block once it has rewritten itself
+            static = target[2]
+            if static is not None:
+                if self.start <= static < self.end:
+                    self.exit(next_pc)
+                    return True
+            else:
+                self.emit('if %d <= %s < %d:' % (self.start, target[1], self.end))
+                self.depth += 1
+                self.exit(next_pc)
+                self.depth -= 1
+        return False
+
+    def generate(self, items, end):
+        self.collected = set()
+        for mode, pc, instruction, words, next_pc in items:
+            if mode == PLAIN:
+                if self.instruction(pc, instruction, words) is True:
+                    return
+            elif mode == IF:
+                condition = self.instruction(pc, instruction, words)
+                self.flush()
+                self.emit('if %s:' % condition)
+                self.depth += 1
+                lines = len(self.lines)
+            elif mode == CONDITIONAL:
+                if self.instruction(pc, instruction, words) is not True:
+                    self.flush()
+                if len(self.lines) == lines:
+                    self.emit('pass')
+                self.cycles = self.count = 0
+                self.depth -= 1
+                self.emit('else:')
+                self.emit('    cy += 1')
+            elif mode == TERMINAL_IF:
+                condition = self.instruction(pc, instruction, words)
+                self.flush()
+                self.emit('if %s:' % condition)
+                self.depth += 1
+                self.exit(next_pc)
+                self.depth -= 1
+                self.cycles = 1
+                self.exit(end)
+                return
+        self.exit(end)
+
+    def source(self):
+        header = ['def block(cpu, r, ram, read, write, rp, wp):', '    cy = n = 0', '    c0 = cpu.cycle']
+        header.extend('    %s = r[%d]' % (local, LOCAL_INDICES[local]) for local in sorted(self.used))
+        return '\n'.join(header + self.lines) + '\n'
+
+class BlockCompiler():
+    # Optional execution engine for a CPU.  Compiled blocks are invalidated
+    # through RAM write hooks, so code must be modified through RAM.set or
+    # RAM.poke rather than by writing to RAM.contents directly.
+    def __init__(self, cpu, max_block_length=32):
+        self.cpu = cpu
+        self.ram = cpu.ram
+        self.max_block_length = max_block_length
+        self.blocks = {}
+        self.page_blocks = {}
+
+    # blocks never wrap around the end of memory
+    def fetch(self, pc):
+        limit = min(self.ram.size, 0x10000)
+        if pc >= limit:
+            return None
+        instruction = DECODE_TABLE[self.ram.get(pc)]
+        next_pc = pc + 1 + instruction.next_words
+        if instruction.opcode is None or next_pc > limit:
+            return None
+        words = tuple(self.ram.get(address) for address in range(pc + 1, next_pc))
+        return pc, instruction, words, next_pc
+
+    # Returns (items, end, length, max_cycles) for the block starting at pc.
+    def layout(self, start):
+        items = []
+        pc = start
+        length = max_cycles = 0
+        while length < self.max_block_length:
+            fetched = self.fetch(pc)
+            if fetched is None:
+                break
+            _, instruction, words, next_pc = fetched
+            if instruction.opcode in CONDITIONS:
+                following = self.fetch(next_pc)
+                if following is None:
+                    break
+                if following[1].opcode in CONDITIONS:
+                    items.append((TERMINAL_IF,) + fetched)
+                    return items, following[3], length + 1, max_cycles + instruction.cycles + 1
+                items.append((IF,) + fetched)
+                items.append((CONDITIONAL,) + following)
+                length += 2
+                max_cycles += instruction.cycles + max(following[1].cycles, 1)
+                pc = following[3]
+                continue
+            items.append((PLAIN,) + fetched)
+            length += 1
+            max_cycles += instruction.cycles
+            pc = next_pc
+            if writes_pc(instruction):
+                break
+        return items, pc, length, max_cycles
+
+    def compile(self, start):
+        items, end, length, max_cycles = self.layout(start)
+        if not items:
+            return None
+        collector = _Generator(start, end, None)
+        collector.generate(items, end)
+        generator = _Generator(start, end, collector.collected)
+        generator.generate(items, end)
+        source = generator.source()
+        namespace = {}
+        exec(compile(source, '<dcpu block 0x%04x>' % start, 'exec'), namespace)
+
+        block = Block(start, end, length, max_cycles, namespace['block'], source)
+        self.blocks[start] = block
+        for page in pages_in_range(start, end):
+            starts = self.page_blocks.get(page)
+            if starts is None:
+                starts = self.page_blocks[page] = set()
+                self.ram.add_write_hook(self.invalidate, page << PAGE_SHIFT, (page + 1) << PAGE_SHIFT)
+            starts.add(start)
+        return block
+
+    def invalidate(self, start, stop):
+        for page in pages_in_range(start, stop):
+            for block_start in tuple(self.page_blocks.get(page, ())):
+                block = self.blocks[block_start]
+                if block.start < stop and start < block.end:
+                    self.discard(block)
+
+    def discard(self, block):
+        del self.blocks[block.start]
+        for page in pages_in_range(block.start, block.end):
+            starts = self.page_blocks[page]
+            starts.discard(block.start)
+            if not starts:
+                del self.page_blocks[page]
+                self.ram.remove_write_hook(self.invalidate, page << PAGE_SHIFT, (page + 1) << PAGE_SHIFT)
+
+    def close(self):
+        for block in list(self.blocks.values()):
+            self.discard(block)
+
+    # Runs the block at PC, or a single step() if nothing can be compiled
+    # there.  Returns the number of instructions executed.
+    def execute(self):
+        cpu = self.cpu
+        pc = cpu.reg.values[PC]
+        block = self.blocks.get(pc) or self.compile(pc)
+        if block is None:
+            cpu.step()
+            return 1
+        ram = self.ram
+        return block.function(cpu, cpu.reg.values, ram, ram.read, ram.write, ram.read_pages, ram.write_pages)
+
+    # Same limits and result as CPU.run.  Limits stay exact because a block
+    # that could overrun them, or that contains until_pc, is run one step()
+    # at a time instead; stop(cpu) is only checked between blocks.
+    def run(self, max_cycles=None, max_instructions=None, until_pc=None, stop=None):
+        cpu = self.cpu
+        values = cpu.reg.values
+        ram = self.ram
+        read, write, read_pages, write_pages = ram.read, ram.write, ram.read_pages, ram.write_pages
+        blocks = self.blocks
+        start_cycle = cpu.cycle
+        cycle_limit = start_cycle + max_cycles if max_cycles is not None else float('inf')
+        instruction_limit = max_instructions if max_instructions is not None else float('inf')
+        if until_pc is None:
+            until_pc = -1
+        executed = 0
+        loops = {}
+        try:
+            while cpu.cycle < cycle_limit and executed < instruction_limit:
+                pc = values[PC]
+                if pc == until_pc:
+                    return RunResult(executed, cpu.cycle - start_cycle, StopReason.UNTIL_PC)
+                if stop is not None and stop(cpu):
+                    return RunResult(executed, cpu.cycle - start_cycle, StopReason.STOP)
+                block = blocks.get(pc) or self.compile(pc)
+                if (block is None or cpu.cycle + block.max_cycles > cycle_limit or
+                        executed + block.length > instruction_limit or
+                        block.start < until_pc < block.end):
+                    cpu.step()
+                    executed += 1
+                else:
+                    executed += block.function(cpu, values, ram, read, write, read_pages, write_pages)
+                if values[PC] <= pc and stop is None:
+                    skipped = cpu.fast_forward(loops, pc, executed, cycle_limit, instruction_limit)
+                    if skipped is None:
+                        return RunResult(executed, cpu.cycle - start_cycle, StopReason.HALTED)
+                    executed += skipped
+        finally:
+            for loop in loops.values():
+                loop.disarm()
+        reason = StopReason.MAX_CYCLES if cpu.cycle >= cycle_limit else StopReason.MAX_INSTRUCTIONS
+        return RunResult(executed, cpu.cycle - start_cycle, reason)
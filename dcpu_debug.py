@@ -0,0 +1,126 @@
+from collections import namedtuple
+from enum import Enum
+
+from dcpu import (CONDITIONS, DECODE_TABLE, PAGE_SHIFT, PC, Opcode, StopReason, StopRun,
+                  run_steps)
+
+# Debugger: Debugger.run runs the CPU through run_steps with a checked step
+# that stops at breakpoints (a PC bitmap indexed at every dispatch) and at
+# watchpoints.  Watchpoints are RAM page hooks, so only accesses to watched
+# pages take the notify path and run callbacks.  A hit lets the instruction
+# finish and then stops the run.
+
+class Access(Enum):
+    EXECUTE = 'execute'
+    READ = 'read'
+    WRITE = 'write'
+
+# pc and word are the instruction that hit; value is the word at address
+# before a read or after a write
+Hit = namedtuple('Hit', ('pc', 'word', 'access', 'address', 'value'))
+
+class Debugger():
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.breakpoints = bytearray(0x10000)
+        # (start, stop, access) -> hook
+        self.watchpoints = {}
+        self.pending = []
+        # the hits that stopped the last run
+        self.hits = []
+        # (pc, cycle) of the breakpoint that stopped the last run
+        self.stopped_at = None
+
+    def add_breakpoint(self, pc):
+        self.breakpoints[pc] = 1
+
+    def remove_breakpoint(self, pc):
+        self.breakpoints[pc] = 0
+
+    # Read watchpoints see operand and next-word reads but not instruction
+    # fetches, the instruction a failed IFx skips, nor the unused read of
+    # SET's destination.  Use breakpoints to stop on execution.
+    def watch(self, start, stop=None, access=Access.WRITE):
+        if access is Access.EXECUTE:
+            raise ValueError('execute watchpoints are not supported; use add_breakpoint')
+        if stop is None:
+            stop = start + 1
+        key = start, stop, access
+        if key in self.watchpoints:
+            return
+        pending = self.pending
+        contents = self.cpu.ram.contents
+        if access is Access.WRITE:
+            def hook(first, last):
+                for address in range(max(first, start), min(last, stop)):
+                    pending.append((access, address, contents[address]))
+            self.cpu.ram.add_write_hook(hook, start, stop)
+        else:
+            def hook(address):
+                if start <= address < stop:
+                    pending.append((access, address, contents[address]))
+            self.cpu.ram.add_read_hook(hook, start, stop)
+        self.watchpoints[key] = hook
+
+    def unwatch(self, start, stop=None, access=Access.WRITE):
+        if stop is None:
+            stop = start + 1
+        hook = self.watchpoints.pop((start, stop, access))
+        if access is Access.WRITE:
+            self.cpu.ram.remove_write_hook(hook, start, stop)
+        else:
+            self.cpu.ram.remove_read_hook(hook, start, stop)
+
+    def close(self):
+        for start, stop, access in list(self.watchpoints):
+            self.unwatch(start, stop, access)
+
+    # Same arguments and result as CPU.run, busy-wait skipping included, and
+    # stops with StopReason.BREAKPOINT or WATCHPOINT, leaving the hits in
+    # self.hits.  A run that starts where a breakpoint stopped the last one
+    # does not stop there again, so that run() resumes from it.
+    def run(self, max_cycles=None, max_instructions=None, until_pc=None, stop=None):
+        cpu = self.cpu
+        values = cpu.reg.values
+        ram = cpu.ram
+        read, read_pages = ram.read, ram.read_pages
+        breakpoints = self.breakpoints
+        pending = self.pending
+        table = DECODE_TABLE
+        del pending[:]
+        self.hits = []
+        resuming = self.stopped_at == (values[PC], cpu.cycle)
+        self.stopped_at = None
+
+        def step(pc, cycle_limit, instructions_left):
+            nonlocal resuming
+            if breakpoints[pc] and not resuming:
+                word = ram.get(pc)
+                self.hits = [Hit(pc, word, Access.EXECUTE, pc, word)]
+                self.stopped_at = pc, cpu.cycle
+                raise StopRun(StopReason.BREAKPOINT)
+            resuming = False
+            values[PC] = (pc + 1) & 0xffff
+            # the fetch calls read hooks, but is not a watched read
+            word = (ram.peek_and_notify if read_pages[pc >> PAGE_SHIFT] else read)(pc)
+            del pending[:]
+            instruction = table[word]
+            cpu.cycle += instruction.cycles
+            a_val, addr = instruction.a_resolve(cpu)
+            # drop the read of SET's destination, which is the last read
+            # a_resolve makes, but keep its next word's
+            if pending and instruction.opcode is Opcode.SET and pending[-1][:2] == (Access.READ, addr):
+                pending.pop()
+            b_val = instruction.b_resolve(cpu)[0]
+            # and the read of the instruction a failed IFx skips
+            skipped = len(pending)
+            instruction.handler(cpu, a_val, b_val, addr)
+            if instruction.opcode in CONDITIONS:
+                del pending[skipped:]
+            if pending:
+                self.hits = [Hit(pc, word, access, address, value) for access, address, value in pending]
+                del pending[:]
+                raise StopRun(StopReason.WATCHPOINT, 1)
+            return 1
+
+        return run_steps(cpu, step, max_cycles, max_instructions, until_pc, stop)
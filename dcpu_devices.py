@@ -0,0 +1,209 @@
+from collections import deque
+from heapq import heappop, heappush
+from itertools import count
+
+from dcpu import RunResult, StopReason
+
+# Device bus: peripherals own a range of RAM and get callbacks for writes
+# (and optionally reads) inside it, through the RAM's page hooks.  Only
+# pages a device maps take the RAM's notify path: the execution engines
+# check each access against the RAM's per-page bitmaps, so accesses to the
+# rest of memory cost the same with devices attached.  Device timing
+# runs on a heap of events keyed by CPU cycle: DeviceBus.run runs the
+# engine up to the next due event, fires it and carries on, so a device
+# with nothing scheduled costs nothing.
+
+class Device():
+    # set to True to get read(pos) before the CPU reads a word in the range
+    reads = False
+
+    # the device owns the words [start, start + size)
+    def __init__(self, start, size):
+        self.start = start
+        self.stop = start + size
+        self.bus = None
+
+    @property
+    def ram(self):
+        return self.bus.cpu.ram
+
+    def attached(self):
+        pass
+
+    def detached(self):
+        pass
+
+    # called after words in [start, stop), clipped to the device's range,
+    # have been written
+    def write(self, start, stop):
+        pass
+
+    def read(self, pos):
+        pass
+
+class DeviceBus():
+    # engine is anything with CPU.run's signature, such as a BlockCompiler;
+    # it defaults to the CPU itself
+    def __init__(self, cpu, engine=None):
+        self.cpu = cpu
+        self.engine = engine if engine is not None else cpu
+        self.devices = {}
+        # heap of [cycle, sequence, callback]; cancelled events have no callback
+        self.events = []
+        self.sequence = count()
+
+    def attach(self, device):
+        def write_hook(start, stop):
+            if start < device.stop and stop > device.start:
+                device.write(max(start, device.start), min(stop, device.stop))
+        def read_hook(pos):
+            if device.start <= pos < device.stop:
+                device.read(pos)
+        ram = self.cpu.ram
+        ram.add_write_hook(write_hook, device.start, device.stop)
+        if device.reads:
+            ram.add_read_hook(read_hook, device.start, device.stop)
+        self.devices[device] = write_hook, read_hook
+        device.bus = self
+        device.attached()
+        return device
+
+    def detach(self, device):
+        write_hook, read_hook = self.devices.pop(device)
+        device.detached()
+        ram = self.cpu.ram
+        ram.remove_write_hook(write_hook, device.start, device.stop)
+        if device.reads:
+            ram.remove_read_hook(read_hook, device.start, device.stop)
+        device.bus = None
+
+    def close(self):
+        for device in list(self.devices):
+            self.detach(device)
+
+    # callback() runs at the first instruction boundary at or after cycle
+    def schedule(self, cycle, callback):
+        event = [cycle, next(self.sequence), callback]
+        heappush(self.events, event)
+        return event
+
+    def schedule_in(self, cycles, callback):
+        return self.schedule(self.cpu.cycle + cycles, callback)
+
+    def cancel(self, event):
+        event[2] = None
+
+    def next_event(self):
+        events = self.events
+        while events and events[0][2] is None:
+            heappop(events)
+        return events[0][0] if events else None
+
+    def fire_due(self):
+        events = self.events
+        while events and events[0][0] <= self.cpu.cycle:
+            callback = heappop(events)[2]
+            if callback is not None:
+                callback()
+
+    # same arguments and result as CPU.run
+    def run(self, max_cycles=None, max_instructions=None, until_pc=None, stop=None):
+        cpu = self.cpu
+        start_cycle = cpu.cycle
+        cycle_limit = start_cycle + max_cycles if max_cycles is not None else None
+        executed = 0
+        while True:
+            self.fire_due()
+            if cycle_limit is not None and cpu.cycle >= cycle_limit:
+                return RunResult(executed, cpu.cycle - start_cycle, StopReason.MAX_CYCLES)
+            if max_instructions is not None and executed >= max_instructions:
+                return RunResult(executed, cpu.cycle - start_cycle, StopReason.MAX_INSTRUCTIONS)
+            limit = self.next_event()
+            if cycle_limit is not None and (limit is None or cycle_limit < limit):
+                limit = cycle_limit
+            result = self.engine.run(
+                max_cycles=limit - cpu.cycle if limit is not None else None,
+                max_instructions=max_instructions - executed if max_instructions is not None else None,
+                until_pc=until_pc, stop=stop)
+            executed += result.instructions
+            if result.reason in (StopReason.UNTIL_PC, StopReason.STOP, StopReason.HALTED):
+                return RunResult(executed, cpu.cycle - start_cycle, result.reason)
+
+class Display(Device):
+    # one character per word, row by row; the low 7 bits are the character
+    def __init__(self, start=0x8000, columns=32, rows=12):
+        super().__init__(start, columns * rows)
+        self.columns = columns
+        self.rows = rows
+        # rows written since the caller last cleared this set
+        self.dirty = set()
+
+    def write(self, start, stop):
+        self.dirty.update(range((start - self.start) // self.columns,
+                                (stop - 1 - self.start) // self.columns + 1))
+
+    def text(self):
+        contents = self.ram.contents
+        return [''.join(chr(word & 0x7f) if word & 0x7f else ' '
+                        for word in contents[row:row + self.columns]).rstrip()
+                for row in range(self.start, self.stop, self.columns)]
+
+class Keyboard(Device):
+    # Ring buffer of key codes: the keyboard stores each key in the next slot
+    # and the program clears the slot once it has read it.  Keys typed while
+    # the next slot is still full wait until it is cleared.
+    def __init__(self, start=0x9000, size=16):
+        super().__init__(start, size)
+        self.position = 0
+        self.pending = deque()
+
+    def press(self, key):
+        self.pending.append(key)
+        self.deliver()
+
+    def deliver(self):
+        ram = self.ram
+        while self.pending:
+            address = self.start + self.position
+            if ram.get(address):
+                return
+            self.position = (self.position + 1) % (self.stop - self.start)
+            ram.set(address, self.pending.popleft())
+
+    def write(self, start, stop):
+        if self.pending:
+            self.deliver()
+
+class Timer(Device):
+    # Two words: [start] counts ticks and [start + 1] is the period in
+    # cycles.  Writing the period reprograms the timer; 0 stops it.
+    def __init__(self, start=0x9010, period=0):
+        super().__init__(start, 2)
+        self.period = period
+        self.event = None
+
+    # writing the period word reprograms the timer through write()
+    def attached(self):
+        self.ram.set(self.start + 1, self.period)
+
+    def detached(self):
+        self.reprogram(0)
+
+    def write(self, start, stop):
+        if start <= self.start + 1 < stop:
+            self.reprogram(self.ram.get(self.start + 1))
+
+    def reprogram(self, period):
+        if self.event is not None:
+            self.bus.cancel(self.event)
+            self.event = None
+        self.period = period
+        if period:
+            self.event = self.bus.schedule_in(period, self.tick)
+
+    def tick(self):
+        # the next tick is due one period after this one was due, however
+        # late this one ran
+        self.event = self.bus.schedule(self.event[0] + self.period, self.tick)
+        ram = self.ram
+        ram.set(self.start, ram.get(self.start) + 1)
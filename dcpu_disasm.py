@@ -0,0 +1,271 @@
+from collections import Counter, namedtuple
+from enum import Enum
+from functools import lru_cache
+
+import numpy as np
+
+from dcpu import CONDITIONS, DECODE_TABLE, PAGE_SHIFT, NonBasicOpcode, Opcode, pages_in_range
+
+# Disassembler and control-flow graph.  disassemble() does a linear sweep
+# over a whole word array: instruction lengths come from one numpy lookup
+# over every word and text from per-word templates built once per process,
+# so the remaining Python loop only walks instruction boundaries.
+# ControlFlowGraph follows code from entry points into basic blocks and
+# keeps them up to date through a RAM write hook, redecoding only the
+# blocks whose words were written.
+
+REGISTER_NAMES = ('A', 'B', 'C', 'X', 'Y', 'Z', 'I', 'J')
+
+# words taken by the instruction starting with each word; invalid words are
+# shown as a single DAT
+LENGTHS = np.array([1 + instruction.next_words if instruction.opcode is not None else 1
+                    for instruction in DECODE_TABLE], dtype=np.uint8)
+
+Line = namedtuple('Line', ('address', 'words', 'text'))
+
+# '{:04x}' stands for the operand's next word
+def _operand_template(code):
+    if code < 0x08:
+        return REGISTER_NAMES[code]
+    if code < 0x10:
+        return '[%s]' % REGISTER_NAMES[code - 0x08]
+    if code < 0x18:
+        return '[0x{:04x}+%s]' % REGISTER_NAMES[code - 0x10]
+    if code >= 0x20:
+        return '0x%02x' % (code - 0x20)
+    return ('POP', 'PEEK', 'PUSH', 'SP', 'PC', 'O', '[0x{:04x}]', '0x{:04x}')[code - 0x18]
+
+def _template(instruction):
+    if instruction.opcode is None:
+        return 'DAT 0x%04x' % instruction.word
+    if instruction.b is None:
+        return '%s %s' % (instruction.opcode.name, _operand_template(instruction.a))
+    return '%s %s, %s' % (instruction.opcode.name, _operand_template(instruction.a),
+                          _operand_template(instruction.b))
+
+@lru_cache(maxsize=None)
+def templates():
+    return tuple(_template(instruction) for instruction in DECODE_TABLE)
+
+# Lines for the instructions in words[start:stop], from a linear sweep
+# starting at start.  An instruction cut off by stop is shown as DAT words.
+def disassemble(words, start=0, stop=None):
+    words = np.asarray(words)
+    if stop is None:
+        stop = len(words)
+    values = words[start:stop].tolist()
+    lengths = LENGTHS[words[start:stop]].tolist()
+    texts = templates()
+    lines = []
+    offset, end = 0, stop - start
+    while offset < end:
+        length = lengths[offset]
+        if offset + length > end:
+            lines.extend(Line(start + index, (values[index],), 'DAT 0x%04x' % values[index])
+                         for index in range(offset, end))
+            break
+        instruction = tuple(values[offset:offset + length])
+        lines.append(Line(start + offset, instruction, texts[instruction[0]].format(*instruction[1:])))
+        offset += length
+    return lines
+
+def listing(words, start=0, stop=None):
+    return '\n'.join('%04x: %-16s %s' % (line.address, ' '.join('%04x' % word for word in line.words), line.text)
+                     for line in disassemble(words, start, stop))
+
+class Exit(Enum):
+    FALLTHROUGH = 'fallthrough' # runs into the block at its only successor
+    JUMP = 'jump'               # SET PC to a constant
+    CONDITION = 'condition'     # IFx: the next instruction, or the one after it
+    CALL = 'call'               # JSR; carries on after it when the call returns
+    RETURN = 'return'           # SET PC, POP
+    INDIRECT = 'indirect'       # any other write to PC
+    INVALID = 'invalid'
+
+# words is every address the block's decoding depends on, including the
+# instruction an IFx skips
+Block = namedtuple('Block', ('start', 'addresses', 'exit', 'successors', 'calls', 'words'))
+
+def _constant(code, contents, address):
+    if code == 0x1f:
+        return contents[address & 0xffff]
+    if code >= 0x20:
+        return code - 0x20
+    return None
+
+class ControlFlowGraph():
+    # Write hooks only record which words changed; blocks are redecoded the
+    # next time the graph is read, and the graph is then pruned so that it
+    # holds the same blocks a fresh one would.
+    def __init__(self, ram, entries=(0,)):
+        self.ram = ram
+        self.blocks = {}
+        # instruction address -> start of the block holding it
+        self.block_at = {}
+        # addresses that must start a block: entries and branch targets
+        self.leaders = set()
+        self.entries = set()
+        self.page_blocks = {}
+        self.pending = set()
+        for entry in entries:
+            self.add_entry(entry)
+
+    def add_entry(self, address):
+        self.entries.add(address)
+        self.explore(address)
+
+    def close(self):
+        for start in list(self.blocks):
+            self.remove(start)
+
+    def hook(self, start, stop):
+        self.pending.add((start, stop))
+
+    # applies writes recorded since the last update
+    def update(self):
+        changed = False
+        while self.pending:
+            start, stop = self.pending.pop()
+            starts = set()
+            for page in pages_in_range(start, stop):
+                starts.update(block_start for block_start in self.page_blocks.get(page, ())
+                              if any(start <= word < stop for word in self.blocks[block_start].words))
+            for block_start in starts:
+                self.remove(block_start)
+            for block_start in starts:
+                self.explore(block_start)
+            changed = changed or bool(starts)
+        if changed:
+            self.prune()
+
+    # Drops the blocks that are no longer reachable from the entries, and
+    # joins blocks that were split at a leader only the block falling
+    # through into it still leads to.
+    def prune(self):
+        while True:
+            reachable = set()
+            work = list(self.entries)
+            while work:
+                start = work.pop()
+                if start not in reachable:
+                    reachable.add(start)
+                    work.extend(self.blocks[start].successors)
+                    work.extend(self.blocks[start].calls)
+            for start in list(self.blocks):
+                if start not in reachable:
+                    self.remove(start)
+            incoming = Counter(target for block in self.blocks.values()
+                               for target in block.successors + block.calls)
+            self.leaders = self.entries | set(incoming)
+            joined = [block.start for block in self.blocks.values()
+                      if block.exit is Exit.FALLTHROUGH and block.successors[0] != block.start and
+                      incoming[block.successors[0]] == 1 and block.successors[0] not in self.entries]
+            if not joined:
+                return
+            for start in joined:
+                if start in self.blocks:
+                    target = self.blocks[start].successors[0]
+                    self.leaders.discard(target)
+                    self.remove(start)
+                    if target in self.blocks:
+                        self.remove(target)
+            for start in joined:
+                self.explore(start)
+
+    def block(self, address):
+        self.update()
+        start = self.block_at.get(address)
+        return self.blocks[start] if start is not None else None
+
+    def successors(self, address):
+        return self.block(address).successors
+
+    # addresses of JSR targets
+    def functions(self):
+        self.update()
+        return sorted({target for block in self.blocks.values() for target in block.calls})
+
+    # sorted, merged (start, stop) ranges of the words of every block
+    def regions(self):
+        self.update()
+        regions = []
+        for word in sorted({word for block in self.blocks.values() for word in block.words}):
+            if regions and regions[-1][1] == word:
+                regions[-1][1] = word + 1
+            else:
+                regions.append([word, word + 1])
+        return [tuple(region) for region in regions]
+
+    def explore(self, address):
+        work = [address]
+        while work:
+            address = work.pop()
+            self.leaders.add(address)
+            if address in self.blocks:
+                continue
+            owner = self.block_at.get(address)
+            if owner is not None:
+                # a branch into the middle of a block splits it
+                self.remove(owner)
+                work.append(owner)
+            block = self.decode(address)
+            self.add(block)
+            work.extend(block.successors)
+            work.extend(block.calls)
+
+    def decode(self, start):
+        contents = self.ram.contents
+        addresses = []
+        words = []
+        pc = start
+        while True:
+            if addresses and (pc in self.leaders or pc in self.block_at or pc == start):
+                return Block(start, tuple(addresses), Exit.FALLTHROUGH, (pc,), (), tuple(words))
+            instruction = DECODE_TABLE[contents[pc]]
+            addresses.append(pc)
+            size = 1 + instruction.next_words if instruction.opcode is not None else 1
+            words.extend((pc + offset) & 0xffff for offset in range(size))
+            next_pc = (pc + size) & 0xffff
+            opcode = instruction.opcode
+            if opcode is None:
+                return Block(start, tuple(addresses), Exit.INVALID, (), (), tuple(words))
+            if opcode in CONDITIONS:
+                # the skip steps over the next instruction's next words
+                skipped = DECODE_TABLE[contents[next_pc]]
+                words.extend((next_pc + offset) & 0xffff for offset in range(1 + skipped.next_words))
+                return Block(start, tuple(addresses), Exit.CONDITION,
+                             (next_pc, (next_pc + 1 + skipped.next_words) & 0xffff), (), tuple(words))
+            if opcode is NonBasicOpcode.JSR:
+                target = _constant(instruction.a, contents, pc + 1)
+                return Block(start, tuple(addresses), Exit.CALL, (next_pc,),
+                             (target,) if target is not None else (), tuple(words))
+            if instruction.a == 0x1c:
+                target = _constant(instruction.b, contents, pc + 1) if opcode is Opcode.SET else None
+                if target is not None:
+                    return Block(start, tuple(addresses), Exit.JUMP, (target,), (), tuple(words))
+                exit = Exit.RETURN if opcode is Opcode.SET and instruction.b == 0x18 else Exit.INDIRECT
+                return Block(start, tuple(addresses), exit, (), (), tuple(words))
+            pc = next_pc
+
+    def add(self, block):
+        self.blocks[block.start] = block
+        for address in block.addresses:
+            self.block_at[address] = block.start
+        for page in {word >> PAGE_SHIFT for word in block.words}:
+            starts = self.page_blocks.get(page)
+            if starts is None:
+                starts = self.page_blocks[page] = set()
+                self.ram.add_write_hook(self.hook, page << PAGE_SHIFT, (page + 1) << PAGE_SHIFT)
+            starts.add(block.start)
+
+    def remove(self, start):
+        block = self.blocks.pop(start)
+        for address in block.addresses:
+            if self.block_at.get(address) == start:
+                del self.block_at[address]
+        for page in {word >> PAGE_SHIFT for word in block.words}:
+            starts = self.page_blocks[page]
+            starts.discard(start)
+            if not starts:
+                del self.page_blocks[page]
+                self.ram.remove_write_hook(self.hook, page << PAGE_SHIFT, (page + 1) << PAGE_SHIFT)
@@ -0,0 +1,106 @@
+from array import array
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+import os
+import time
+import zlib
+
+from dcpu import CPU, DCPURegisterBank, RAM, StopReason
+
+# Farm runner: executes many independent programs across a process pool.
+# Jobs travel to the workers as raw word bytes plus a register tuple and the
+# final state comes back as zlib-compressed RAM bytes, so no CPU object is
+# ever pickled.  Results are yielded as soon as their chunk finishes.
+
+REGISTERS = DCPURegisterBank.all_regs
+
+# image is a sequence of words (or bytes in native 16-bit order) loaded at
+# address 0; registers is a dict like CPU's initial_registers
+Job = namedtuple('Job', ('image', 'registers', 'max_cycles'), defaults=(None, None))
+
+# reason is None when the job raised; error then holds the message
+class JobResult(namedtuple('JobResult', ('index', 'registers', 'cycle', 'ram', 'reason', 'error'))):
+    __slots__ = ()
+
+    def cpu(self):
+        ram = RAM(word_length=16, size=0x10000, initial_contents=self.ram)
+        return CPU(initial_registers=self.registers, initial_ram=ram, initial_cycle=self.cycle)
+
+def serialize_job(index, job, max_cycles):
+    if not isinstance(job, Job):
+        job = Job(*job)
+    image = job.image
+    if not isinstance(image, (bytes, bytearray)):
+        image = array('H', image).tobytes()
+    registers = job.registers or {}
+    registers = tuple(registers.get(reg, 0) for reg in REGISTERS)
+    budget = job.max_cycles if job.max_cycles is not None else max_cycles
+    return index, bytes(image), registers, budget
+
+# Runs one serialized job to its cycle budget.  The budget is consumed in
+# slices so that the wall-clock timeout is checked regularly.
+def run_serialized(job, timeout=None, slice_cycles=10000):
+    index, image, registers, budget = job
+    ram = RAM(word_length=16, size=0x10000)
+    if len(image) // 2 > ram.size:
+        raise ValueError('image of %d words does not fit in %d words of RAM' % (len(image) // 2, ram.size))
+    ram.contents[:len(image) // 2] = array('H', image)
+    cpu = CPU(initial_registers=dict(zip(REGISTERS, registers)), initial_ram=ram)
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    reason = error = None
+    try:
+        while True:
+            cycles = slice_cycles if budget is None else min(slice_cycles, budget - cpu.cycle)
+            if cycles <= 0:
+                reason = StopReason.MAX_CYCLES
+                break
+            cpu.run(max_cycles=cycles)
+            if deadline is not None and time.monotonic() >= deadline:
+                reason = StopReason.TIMEOUT
+                break
+    except ValueError as exception:
+        error = str(exception)
+    return (index, tuple(cpu.reg.values), cpu.cycle,
+            zlib.compress(ram.contents.tobytes(), 1), reason, error)
+
+def run_chunk(chunk, timeout=None, slice_cycles=10000):
+    return [run_serialized(job, timeout, slice_cycles) for job in chunk]
+
+def deserialize_result(result):
+    index, registers, cycle, ram, reason, error = result
+    return JobResult(index, dict(zip(REGISTERS, registers)), cycle,
+                     array('H', zlib.decompress(ram)), reason, error)
+
+# Runs jobs (Job instances or (image, registers, max_cycles) tuples) and
+# yields a JobResult for each in completion order; JobResult.index is the
+# job's position in jobs.  Only a bounded number of chunks is in flight at
+# a time, so jobs may be a lazy iterable.
+def run_jobs(jobs, max_cycles=None, workers=None, chunk_size=16, timeout=None,
+             slice_cycles=10000, executor=None):
+    if max_cycles is None and timeout is None:
+        raise ValueError('either max_cycles or timeout must be given')
+    workers = workers or os.cpu_count() or 1
+    serialized = (serialize_job(index, job, max_cycles) for index, job in enumerate(jobs))
+    owned = executor is None
+    if owned:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        pending = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < 2 * workers:
+                chunk = list(islice(serialized, chunk_size))
+                if not chunk:
+                    exhausted = True
+                    break
+                pending.add(executor.submit(run_chunk, chunk, timeout, slice_cycles))
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for result in future.result():
+                    yield deserialize_result(result)
+    finally:
+        if owned:
+            executor.shutdown(cancel_futures=True)
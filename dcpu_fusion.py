@@ -0,0 +1,253 @@
+from dcpu import (CONDITIONS, DECODE_TABLE, O, PAGE_SHIFT, PC, SP, Opcode,
+                  pages_in_range, run_steps)
+
+# Superinstructions: an interpreter that recognises a few common short
+# instruction sequences and runs each as one generated handler instead of
+# decoding and resolving every instruction separately:
+#
+# - compare-and-branch: IFx followed by SET PC, x or SET PC, POP
+# - increment-compare-branch: ADD or SUB on a register, then the above
+# - runs of two to four SET PUSH, x or of SET x, POP
+#
+# Handlers keep the exact cycle, O, PC and SP effects of stepping, including
+# the skipped branch's next words.  A sequence only runs fused when all of
+# it fits inside the run's limits; otherwise, and while a stop callback or
+# read hooks are installed, instructions are interpreted one at a time as in
+# CPU.run.  Cached sequences are invalidated through RAM write hooks, like
+# compiled blocks.
+
+MAX_STACK_RUN = 4
+
+class Superinstruction():
+    __slots__ = ('start', 'end', 'length', 'max_cycles', 'function', 'source')
+
+    def __init__(self, start, end, length, max_cycles, function, source):
+        self.start = start
+        self.end = end
+        self.length = length
+        self.max_cycles = max_cycles
+        self.function = function
+        self.source = source
+
+    def __repr__(self):
+        return '<Superinstruction 0x%04x-0x%04x>' % (self.start, self.end)
+
+# Expression reading address, an int or an expression, which only calls the
+# notify variant for pages with read hooks
+def _read(address):
+    page = address >> PAGE_SHIFT if isinstance(address, int) else '%s >> %d' % (address, PAGE_SHIFT)
+    return '(ram.peek_and_notify if rp[%s] else read)(%s)' % (page, address)
+
+# Expression for the value of an operand that reads without side effects,
+# or None for POP, PUSH and PC.  words yields the instruction's next words.
+def _value(code, words):
+    if code < 0x08:
+        return 'r[%d]' % code
+    if code < 0x10:
+        return _read('r[%d]' % (code - 0x08))
+    if code < 0x18:
+        return _read('((%d + r[%d]) & 0xffff)' % (next(words), code - 0x10))
+    if code == 0x19:
+        return _read('r[%d]' % SP)
+    if code == 0x1b:
+        return 'r[%d]' % SP
+    if code == 0x1d:
+        return 'r[%d]' % O
+    if code == 0x1e:
+        return _read(next(words))
+    if code == 0x1f:
+        return str(next(words))
+    if code >= 0x20:
+        return str(code - 0x20)
+    return None
+
+def _plain(code):
+    return code not in (0x18, 0x1a, 0x1c)
+
+# SET PC, x, including SET PC, POP (return)
+def _is_branch(instruction):
+    return instruction.opcode is Opcode.SET and instruction.a == 0x1c and (_plain(instruction.b) or instruction.b == 0x18)
+
+def _is_push(instruction):
+    return instruction.opcode is Opcode.SET and instruction.a == 0x1a and _plain(instruction.b)
+
+def _is_pop(instruction):
+    return instruction.opcode is Opcode.SET and instruction.b == 0x18 and (instruction.a < 0x08 or instruction.a == 0x1d)
+
+class Fuser():
+    # Execution engine for a CPU with the same run() as CPU.run.
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.ram = cpu.ram
+        # start -> Superinstruction, or None where nothing matched
+        self.fused = {}
+        # start -> end of the words looked at while matching
+        self.ends = {}
+        self.page_starts = {}
+        # end of the words fetched while matching, reset by fuse()
+        self.examined = 0
+
+    # (instruction, next words, next pc), or None for invalid words and
+    # instructions that would wrap around the end of memory
+    def fetch(self, pc):
+        limit = min(self.ram.size, 0x10000)
+        if pc >= limit:
+            return None
+        instruction = DECODE_TABLE[self.ram.get(pc)]
+        next_pc = pc + 1 + instruction.next_words
+        if instruction.opcode is None or next_pc > limit:
+            return None
+        self.examined = max(self.examined, next_pc)
+        return instruction, tuple(self.ram.get(address) for address in range(pc + 1, next_pc)), next_pc
+
+    def match(self, start):
+        first = self.fetch(start)
+        if first is None:
+            return None
+        instruction, words, next_pc = first
+        if instruction.opcode in CONDITIONS:
+            return self.branch(start, None, first)
+        if instruction.opcode in (Opcode.ADD, Opcode.SUB) and instruction.a < 0x08 and _plain(instruction.b):
+            condition = self.fetch(next_pc)
+            if condition is not None and condition[0].opcode in CONDITIONS:
+                return self.branch(start, first, condition)
+            return None
+        for kind in (_is_push, _is_pop):
+            if kind(instruction):
+                run = [first]
+                while len(run) < MAX_STACK_RUN:
+                    following = self.fetch(run[-1][2])
+                    if following is None or not kind(following[0]):
+                        break
+                    run.append(following)
+                if len(run) > 1:
+                    return self.stack(start, run, kind is _is_push)
+        return None
+
+    def branch(self, start, step, condition):
+        jump = self.fetch(condition[2])
+        if jump is None or not _is_branch(jump[0]):
+            return None
+        lines = []
+        cycles = count = 0
+        if step is not None:
+            instruction, words, _ = step
+            lines.append('v = r[%d] %s %s' % (instruction.a, '+' if instruction.opcode is Opcode.ADD else '-',
+                                              _value(instruction.b, iter(words))))
+            lines.append('r[%d] = v & 0xffff' % instruction.a)
+            lines.append('r[%d] = %s' % (O, 'v >> 16' if instruction.opcode is Opcode.ADD else '0xffff if v < 0 else 0'))
+            cycles += instruction.cycles
+            count += 1
+        instruction, words, _ = condition
+        words = iter(words)
+        a = _value(instruction.a, words)
+        b = _value(instruction.b, words)
+        if a is None or b is None:
+            return None
+        cycles += instruction.cycles
+        count += 1
+        target, words, end = jump
+        lines.append('if %s:' % CONDITIONS[instruction.opcode].format(a=a, b=b))
+        lines.append('    cpu.cycle += %d' % (cycles + target.cycles))
+        if target.b == 0x18:
+            lines.append('    sp = r[%d]' % SP)
+            lines.append('    r[%d] = (sp + 1) & 0xffff' % SP)
+            lines.append('    r[%d] = %s' % (PC, _read('sp')))
+        else:
+            lines.append('    r[%d] = %s' % (PC, _value(target.b, iter(words))))
+        lines.append('    return %d' % (count + 1))
+        lines.append('cpu.cycle += %d' % (cycles + 1))
+        lines.append('r[%d] = %d' % (PC, end & 0xffff))
+        lines.append('return %d' % count)
+        return self.build(start, end, count + 1, cycles + target.cycles, lines)
+
+    def stack(self, start, run, push):
+        lines = []
+        cycles = 0
+        end = run[-1][2]
+        for count, (instruction, words, next_pc) in enumerate(run, 1):
+            cycles += instruction.cycles
+            lines.append('cpu.cycle += %d' % instruction.cycles)
+            lines.append('r[%d] = %d' % (PC, next_pc & 0xffff))
+            if push:
+                # a is resolved before b, so b sees the decremented SP
+                lines.append('sp = r[%d] = (r[%d] - 1) & 0xffff' % (SP, SP))
+                lines.append('(ram.poke_and_notify if wp[sp >> %d] else write)(sp, %s)' % (PAGE_SHIFT, _value(instruction.b, iter(words))))
+                if count < len(run):
+                    # leave if the push overwrote the rest of the sequence
+                    lines.append('if %d <= sp < %d:' % (next_pc, end))
+                    lines.append('    return %d' % count)
+            else:
+                lines.append('sp = r[%d]' % SP)
+                lines.append('r[%d] = (sp + 1) & 0xffff' % SP)
+                lines.append('r[%d] = %s' % (instruction.a if instruction.a < 0x08 else O, _read('sp')))
+        lines.append('return %d' % len(run))
+        return self.build(start, end, len(run), cycles, lines)
+
+    def build(self, start, end, length, max_cycles, lines):
+        source = '\n'.join(['def fused(cpu, r, ram, read, write, rp, wp):'] + ['    ' + line for line in lines]) + '\n'
+        namespace = {}
+        exec(compile(source, '<dcpu superinstruction 0x%04x>' % start, 'exec'), namespace)
+        return Superinstruction(start, end, length, max_cycles, namespace['fused'], source)
+
+    # Returns the Superinstruction starting at pc, or None, and caches it.
+    def fuse(self, pc):
+        self.examined = pc + 1
+        superinstruction = self.match(pc)
+        end = self.examined
+        self.fused[pc] = superinstruction
+        self.ends[pc] = end
+        for page in pages_in_range(pc, end):
+            starts = self.page_starts.get(page)
+            if starts is None:
+                starts = self.page_starts[page] = set()
+                self.ram.add_write_hook(self.invalidate, page << PAGE_SHIFT, (page + 1) << PAGE_SHIFT)
+            starts.add(pc)
+        return superinstruction
+
+    def invalidate(self, start, stop):
+        for page in pages_in_range(start, stop):
+            for pc in tuple(self.page_starts.get(page, ())):
+                if pc < stop and start < self.ends[pc]:
+                    self.discard(pc)
+
+    def discard(self, pc):
+        del self.fused[pc]
+        for page in pages_in_range(pc, self.ends.pop(pc)):
+            starts = self.page_starts[page]
+            starts.discard(pc)
+            if not starts:
+                del self.page_starts[page]
+                self.ram.remove_write_hook(self.invalidate, page << PAGE_SHIFT, (page + 1) << PAGE_SHIFT)
+
+    def close(self):
+        for pc in list(self.fused):
+            self.discard(pc)
+
+    # same arguments and result as CPU.run
+    def run(self, max_cycles=None, max_instructions=None, until_pc=None, stop=None):
+        cpu = self.cpu
+        values = cpu.reg.values
+        ram = self.ram
+        read, write, read_pages, write_pages = ram.read, ram.write, ram.read_pages, ram.write_pages
+        table = DECODE_TABLE
+        fused = self.fused
+        fusing = stop is None and not ram.read_hooks
+        inside = -1 if until_pc is None else until_pc
+
+        def step(pc, cycle_limit, instructions_left):
+            superinstruction = fused.get(pc, False) if fusing else None
+            if superinstruction is False:
+                superinstruction = self.fuse(pc)
+            if (superinstruction is not None and cpu.cycle + superinstruction.max_cycles <= cycle_limit and
+                    superinstruction.length <= instructions_left and
+                    not superinstruction.start < inside < superinstruction.end):
+                return superinstruction.function(cpu, values, ram, read, write, read_pages, write_pages)
+            values[PC] = (pc + 1) & 0xffff
+            instruction = table[(ram.peek_and_notify if read_pages[pc >> PAGE_SHIFT] else read)(pc)]
+            cpu.cycle += instruction.cycles
+            a_val, addr = instruction.a_resolve(cpu)
+            instruction.handler(cpu, a_val, instruction.b_resolve(cpu)[0], addr)
+            return 1
+
+        return run_steps(cpu, step, max_cycles, max_instructions, until_pc, stop)
@@ -0,0 +1,185 @@
+from array import array
+from collections import namedtuple
+import random
+
+from dcpu import DECODE_TABLE, PAGE_SHIFT, PC, StopReason, StopRun, run_steps
+
+# Coverage-guided fuzzing.  Fuzzer writes inputs into a region of a CPU's
+# RAM, runs each from the same starting state to a cycle budget and keeps
+# the inputs that reach new edge coverage as a corpus to mutate further.
+#
+#     fuzzer = Fuzzer(cpu, 0x1000, 0x1010, max_cycles=2000)
+#     fuzzer.fuzz(100000)
+#     fuzzer.crashes   # crashing pc -> input
+#
+# Coverage is recorded as in AFL: every address has a fixed random 16-bit
+# id, and the transition from the instruction at prev to the one at pc
+# counts a hit for edge ids[pc] ^ (ids[prev] >> 1) in a MAP_SIZE map.
+# Transitions are between consecutively executed instructions, so IFx
+# skips and JSR calls are edges of their own.  Hit counts are bucketed
+# (1, 2, 3, 4-7, 8-15, 16-31, 32-127, 128+) and an input is new when it
+# reaches an edge or a bucket no earlier input has.
+#
+# Each run restores a snapshot taken when the Fuzzer was created, which
+# copies the RAM in one go, instead of building a new CPU.
+
+MAP_SIZE = 1 << 16
+
+_generator = random.Random('edges')
+LOCATIONS = array('H', (_generator.getrandbits(16) for _ in range(0x10000)))
+
+BUCKETS = bytes([0, 1, 2, 4] + [8] * 4 + [16] * 8 + [32] * 16 + [64] * 96 + [128])
+
+INTERESTING = (0x0000, 0x0001, 0x0002, 0x000f, 0x0010, 0x001f, 0x0020, 0x007f, 0x0080,
+               0x00ff, 0x0100, 0x7fff, 0x8000, 0xfffe, 0xffff)
+
+# result is None when the run raised; error then holds the message.  new is
+# the number of edges or hit buckets reached for the first time.
+Outcome = namedtuple('Outcome', ('result', 'new', 'error'))
+
+class Fuzzer():
+    # Inputs are sequences of up to stop - start words, written from start;
+    # the rest of the region keeps the words it had in the snapshot, which
+    # are also the first corpus entry.
+    def __init__(self, cpu, start, stop, max_cycles=10000, seed=0):
+        self.cpu = cpu
+        self.start = start
+        self.stop = stop
+        self.max_cycles = max_cycles
+        self.snapshot = cpu.snapshot()
+        self.rng = random.Random(seed)
+        # hits per edge in the current run, and the edges hit at all
+        self.trace = array('L', [0]) * MAP_SIZE
+        self.touched = []
+        # buckets seen so far per edge, one bit each
+        self.seen = bytearray(MAP_SIZE)
+        self.edges = 0
+        self.corpus = []
+        self.crashes = {}
+        self.executions = 0
+        self.timeouts = 0
+        self.add(self.snapshot.ram[start:stop])
+
+    # Runs the CPU for max_cycles, recording edges into trace.  Stops early
+    # with StopReason.HALTED on an instruction that jumps to itself.
+    def run_traced(self, max_cycles):
+        cpu = self.cpu
+        values = cpu.reg.values
+        ram = cpu.ram
+        read, read_pages = ram.read, ram.read_pages
+        table = DECODE_TABLE
+        locations = LOCATIONS
+        trace = self.trace
+        touched = self.touched
+        previous = 0
+
+        def step(pc, cycle_limit, instructions_left):
+            nonlocal previous
+            location = locations[pc]
+            edge = location ^ previous
+            count = trace[edge]
+            trace[edge] = count + 1
+            if not count:
+                touched.append(edge)
+            previous = location >> 1
+            values[PC] = (pc + 1) & 0xffff
+            instruction = table[(ram.peek_and_notify if read_pages[pc >> PAGE_SHIFT] else read)(pc)]
+            cpu.cycle += instruction.cycles
+            a_val, addr = instruction.a_resolve(cpu)
+            instruction.handler(cpu, a_val, instruction.b_resolve(cpu)[0], addr)
+            if values[PC] == pc and cpu.is_halted():
+                raise StopRun(StopReason.HALTED, 1)
+            return 1
+
+        return run_steps(cpu, step, max_cycles, skip_loops=False)
+
+    # Folds the run's trace into seen, clearing it; returns the number of
+    # new edges and buckets.
+    def collect(self):
+        trace = self.trace
+        seen = self.seen
+        new = 0
+        for edge in self.touched:
+            count = trace[edge]
+            trace[edge] = 0
+            bucket = BUCKETS[count] if count < 128 else 128
+            previous = seen[edge]
+            if not bucket & previous:
+                if not previous:
+                    self.edges += 1
+                seen[edge] = previous | bucket
+                new += 1
+        self.touched.clear()
+        return new
+
+    # Runs one input from the snapshot
+    def execute(self, words):
+        if not isinstance(words, array):
+            words = array('H', words)
+        cpu = self.cpu
+        cpu.restore(self.snapshot)
+        cpu.ram.store(self.start, words)
+        self.executions += 1
+        try:
+            result = self.run_traced(self.max_cycles)
+            error = None
+        except ValueError as exception:
+            result = None
+            error = str(exception)
+        return Outcome(result, self.collect(), error)
+
+    # Executes words and keeps them when they reached new coverage, or
+    # crashed somewhere no earlier input crashed
+    def add(self, words):
+        words = array('H', words)
+        outcome = self.execute(words)
+        if outcome.new:
+            self.corpus.append(words)
+        if outcome.error is not None:
+            pc = (self.cpu.reg.values[PC] - 1) & 0xffff
+            self.crashes.setdefault(pc, words)
+        elif outcome.result.reason is StopReason.MAX_CYCLES:
+            self.timeouts += 1
+        return outcome
+
+    # A copy of words with a stack of 1 to 8 random changes
+    def mutate(self, words):
+        rng = self.rng
+        words = array('H', words)
+        size = self.stop - self.start
+        for _ in range(1 << rng.randrange(4)):
+            choice = rng.randrange(8)
+            if not words:
+                choice = 6
+            position = rng.randrange(len(words)) if words else 0
+            if choice == 0:
+                words[position] ^= 1 << rng.randrange(16)
+            elif choice == 1:
+                words[position] = rng.choice(INTERESTING)
+            elif choice == 2:
+                words[position] = rng.randrange(0x10000)
+            elif choice == 3:
+                words[position] = (words[position] + rng.randrange(-35, 36)) & 0xffff
+            elif choice == 4:
+                # copy a block over another part of the input
+                length = rng.randrange(1, len(words) - position + 1)
+                target = rng.randrange(len(words) - length + 1)
+                words[target:target + length] = words[position:position + length]
+            elif choice == 5:
+                # splice with another corpus entry
+                other = rng.choice(self.corpus)
+                words = words[:position] + other[position:size]
+            elif choice == 6 and len(words) < size:
+                words.insert(position, rng.randrange(0x10000))
+            elif choice == 7 and len(words) > 1:
+                del words[position]
+        return words
+
+    # Runs count mutated inputs; returns the number added to the corpus
+    def fuzz(self, count):
+        rng = self.rng
+        corpus = self.corpus
+        added = len(corpus)
+        for _ in range(count):
+            self.add(self.mutate(corpus[rng.randrange(len(corpus))]))
+        return len(corpus) - added
@@ -0,0 +1,66 @@
+from array import array
+import mmap
+import os
+import sys
+
+from dcpu import RAM
+
+# Raw binary RAM images: one 16-bit word per two bytes, no header.  Most
+# DCPU-16 tools write big-endian images, so that is the default here.
+
+def words_from_bytes(data, byteorder='big'):
+    words = array('H')
+    words.frombytes(data)
+    if byteorder != sys.byteorder:
+        words.byteswap()
+    return words
+
+def words_to_bytes(words, byteorder='big'):
+    if not isinstance(words, array) or words.typecode != 'H':
+        words = array('H', words)
+    if byteorder != sys.byteorder:
+        words = array('H', words)
+        words.byteswap()
+    return words.tobytes()
+
+def load_image(path, byteorder='big'):
+    with open(path, 'rb') as image:
+        if not os.fstat(image.fileno()).st_size:
+            return array('H')
+        with mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return words_from_bytes(data, byteorder)
+
+# size pads the image with zero words, e.g. to a full 0x10000 words so that
+# it can be mapped with mapped_ram
+def save_image(path, words, byteorder='big', size=None):
+    data = words_to_bytes(words, byteorder)
+    if size is not None:
+        assert len(data) <= 2 * size
+        data += bytes(2 * size - len(data))
+    with open(path, 'wb') as image:
+        image.write(data)
+
+# Builds a RAM from an image with a single bulk copy.  Booting many machines
+# from one ROM should load it once and pass the same array to each call.
+def image_ram(words, size=0x10000):
+    return RAM(word_length=16, size=size, initial_contents=words)
+
+# RAM backed directly by a native byte order image file.  access is one of
+# mmap.ACCESS_READ (shared and read-only: writes raise TypeError),
+# mmap.ACCESS_WRITE (writes go through to the file) or mmap.ACCESS_COPY
+# (private copy-on-write pages over the shared file).  A writable file
+# shorter than size words is extended with zeros first.
+def mapped_ram(path, size=0x10000, access=mmap.ACCESS_COPY):
+    mode = 'r+b' if access == mmap.ACCESS_WRITE else 'rb'
+    with open(path, mode) as image:
+        length = os.fstat(image.fileno()).st_size
+        if length < 2 * size:
+            if access != mmap.ACCESS_WRITE:
+                raise ValueError('%s holds %d words, expected %d' % (path, length // 2, size))
+            image.truncate(2 * size)
+        data = mmap.mmap(image.fileno(), 2 * size, access=access)
+    return RAM.from_buffer(16, data)
+
+# writes a file-backed RAM's changes out to its file
+def flush(ram):
+    ram.contents.obj.flush()
@@ -0,0 +1,211 @@
+from array import array
+
+from dcpu import PAGE_SHIFT, PAGE_SIZE, RAM, pages_in_range, word_typecode
+
+# Copy-on-write paged RAM.  The words live in PAGE_SIZE-word pages; pages
+# that have never been written reference one shared zero page, and copy()
+# shares every page with the copy, so machines booted from one image hold
+# only the pages they have written.  A page is copied the first time it is
+# written, whether through set, poke or contents.
+#
+#     rom = PagedRAM.from_image(16, 0x10000, load_image('boot.bin'))
+#     cpus = [CPU(initial_ram=rom.copy()) for _ in range(10000)]
+#
+# contents is a sequence over the pages rather than a flat array: indexing,
+# slicing, len and tobytes work, at some cost, but view does not.
+
+PAGE_MASK = PAGE_SIZE - 1
+
+_zero_pages = {}
+
+def _zero_page(typecode, length):
+    key = typecode, length
+    page = _zero_pages.get(key)
+    if page is None:
+        page = _zero_pages[key] = array(typecode, [0]) * length if typecode else [0] * length
+    return page
+
+# The accessors close over the page list and ownership flags rather than the
+# RAM, which both change in place only.
+def _reader(pages):
+    def read(pos):
+        return pages[pos >> PAGE_SHIFT][pos & PAGE_MASK]
+    return read
+
+def _writer(pages, owned):
+    def write(pos, value):
+        page = pos >> PAGE_SHIFT
+        if not owned[page]:
+            pages[page] = pages[page][:]
+            owned[page] = 1
+        pages[page][pos & PAGE_MASK] = value
+    return write
+
+class PagedContents():
+    def __init__(self, ram):
+        self.ram = ram
+
+    def __len__(self):
+        return self.ram.size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            words = self.ram.snapshot()
+            return words[key]
+        return self.ram.read(key)
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.ram.size)
+            assert step == 1 and len(value) == stop - start
+            self.ram.load(start, value)
+        else:
+            self.ram.write(key, value)
+
+    def __iter__(self):
+        for page in self.ram.pages:
+            yield from page
+
+    def tobytes(self):
+        return b''.join(page.tobytes() for page in self.ram.pages)
+
+class PagedRAM(RAM):
+    # initial_contents must be a sequence of words!
+    def __init__(self, word_length, size, initial_contents=None):
+        self.word_length = word_length
+        self._size = size
+        typecode = word_typecode(word_length)
+        self.pages = [_zero_page(typecode, min(PAGE_SIZE, size - start)) for start in range(0, size, PAGE_SIZE)]
+        # 1 for pages this RAM may write in place
+        self.owned = bytearray(len(self.pages))
+        self.write_hooks = {}
+        self.read_hooks = {}
+        self.rebind()
+        if initial_contents:
+            assert len(initial_contents) <= size
+            self.load(0, initial_contents)
+
+    # RAM whose pages are copied from words and then shared: copy() it once
+    # per machine
+    @classmethod
+    def from_image(cls, word_length, size, words):
+        ram = cls(word_length, size, words)
+        ram.owned[:] = bytes(len(ram.owned))
+        return ram
+
+    @classmethod
+    def from_buffer(cls, word_length, buffer):
+        raise TypeError('PagedRAM cannot be built over a buffer')
+
+    def rebind(self, pages=None):
+        RAM.rebind(self, pages)
+        self.get = self.read
+
+    def direct(self):
+        return _reader(self.pages), _writer(self.pages, self.owned)
+
+    def __getstate__(self):
+        return {'word_length': self.word_length, 'size': self._size, 'words': self.snapshot()}
+
+    def __setstate__(self, state):
+        self.__init__(state['word_length'], state['size'])
+        self.load(0, state['words'])
+
+    @property
+    def contents(self):
+        return PagedContents(self)
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def view(self):
+        raise TypeError('PagedRAM has no flat view; use snapshot()')
+
+    # number of pages this RAM holds a private copy of
+    def resident_pages(self):
+        return sum(self.owned)
+
+    # writes words from start on without calling hooks, leaving pages that
+    # already hold the same words shared
+    def load(self, start, words):
+        typecode = word_typecode(self.word_length)
+        if typecode and not isinstance(words, array):
+            words = array(typecode, words)
+        pages = self.pages
+        offset = 0
+        for page in pages_in_range(start, start + len(words)):
+            first = max(start, page << PAGE_SHIFT)
+            stop = min(start + len(words), (page + 1) << PAGE_SHIFT)
+            chunk = words[offset:offset + stop - first]
+            offset += stop - first
+            low, high = first & PAGE_MASK, (first & PAGE_MASK) + stop - first
+            if pages[page][low:high] == chunk:
+                continue
+            if not self.owned[page]:
+                pages[page] = pages[page][:]
+                self.owned[page] = 1
+            pages[page][low:high] = chunk
+
+    def poke_and_notify(self, pos, value):
+        self.write(pos, value)
+        hooks = self.write_hooks.get(pos >> PAGE_SHIFT)
+        if hooks:
+            for hook in tuple(hooks):
+                hook(pos, pos + 1)
+
+    def peek_and_notify(self, pos):
+        hooks = self.read_hooks.get(pos >> PAGE_SHIFT)
+        if hooks:
+            for hook in tuple(hooks):
+                hook(pos)
+        return self.read(pos)
+
+    def snapshot(self):
+        typecode = word_typecode(self.word_length)
+        if typecode is None:
+            return [word for page in self.pages for word in page]
+        words = array(typecode)
+        for page in self.pages:
+            words.extend(page)
+        return words
+
+    def equals(self, words):
+        start = 0
+        for page in self.pages:
+            if page != words[start:start + len(page)]:
+                return False
+            start += len(page)
+        return True
+
+    # unchanged pages stay shared; hooks are notified once per page whose
+    # contents changed
+    def restore(self, words):
+        assert len(words) == self._size
+        typecode = word_typecode(self.word_length)
+        if typecode and not isinstance(words, array):
+            words = array(typecode, words)
+        changed = []
+        for page in range(len(self.pages)):
+            start = page << PAGE_SHIFT
+            chunk = words[start:start + len(self.pages[page])]
+            if self.pages[page] != chunk:
+                self.load(start, chunk)
+                changed.append(page)
+        for page in changed:
+            if page in self.write_hooks:
+                self.notify_write(page << PAGE_SHIFT, min((page + 1) << PAGE_SHIFT, self._size))
+
+    # shares every page with the copy; whichever writes a page first copies it
+    def copy(self):
+        ram = object.__new__(type(self))
+        ram.word_length = self.word_length
+        ram._size = self._size
+        ram.pages = list(self.pages)
+        ram.owned = bytearray(len(self.pages))
+        self.owned[:] = ram.owned
+        ram.write_hooks = {}
+        ram.read_hooks = {}
+        ram.rebind()
+        return ram
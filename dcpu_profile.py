@@ -0,0 +1,116 @@
+from array import array
+from heapq import nlargest
+
+from dcpu import (DECODE_TABLE, PAGE_SHIFT, PC, NonBasicOpcode, Opcode, Operand,
+                  run_steps)
+
+# Opt-in profiler.  Profiler.run runs the CPU through run_steps with a
+# step that counts instructions and cycles (including skip cycles) per
+# opcode, per PC and per operand addressing mode; CPU.run and step are left
+# untouched, so there is no cost while the profiler is not running.
+
+OPCODE_NAMES = ['invalid'] + [opcode.name for opcode in Opcode if opcode.value] + [NonBasicOpcode.JSR.name]
+NO_OPERAND = len(Operand) # counters bucket for the missing b of non-basic instructions
+
+def _slot(instruction):
+    if instruction.opcode is None:
+        return 0
+    if instruction.opcode is NonBasicOpcode.JSR:
+        return len(OPCODE_NAMES) - 1
+    return instruction.opcode.value
+
+# per decoded word: (opcode slot, a mode, b mode)
+SLOTS = tuple(
+    (_slot(instruction),
+     instruction.a_kind.value if instruction.a_kind is not None else NO_OPERAND,
+     instruction.b_kind.value if instruction.b_kind is not None else NO_OPERAND)
+    for instruction in DECODE_TABLE)
+
+def _counters(size):
+    return array('Q', [0]) * size
+
+class Profiler():
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.opcode_instructions = _counters(len(OPCODE_NAMES))
+        self.opcode_cycles = _counters(len(OPCODE_NAMES))
+        self.pc_instructions = _counters(0x10000)
+        self.pc_cycles = _counters(0x10000)
+        self.mode_instructions = _counters(NO_OPERAND + 1)
+        self.mode_cycles = _counters(NO_OPERAND + 1)
+
+    def reset(self):
+        for counters in (self.opcode_instructions, self.opcode_cycles, self.pc_instructions,
+                         self.pc_cycles, self.mode_instructions, self.mode_cycles):
+            counters[:] = _counters(len(counters))
+
+    # Same arguments and result as CPU.run, but every instruction is
+    # stepped and counted: busy waits are not skipped, so a run without
+    # limits only stops with StopReason.HALTED on an instruction that jumps
+    # to itself.
+    def run(self, max_cycles=None, max_instructions=None, until_pc=None, stop=None):
+        cpu = self.cpu
+        values = cpu.reg.values
+        ram = cpu.ram
+        read, read_pages = ram.read, ram.read_pages
+        table = DECODE_TABLE
+        slots = SLOTS
+        opcode_instructions, opcode_cycles = self.opcode_instructions, self.opcode_cycles
+        pc_instructions, pc_cycles = self.pc_instructions, self.pc_cycles
+        mode_instructions, mode_cycles = self.mode_instructions, self.mode_cycles
+
+        def step(pc, cycle_limit, instructions_left):
+            values[PC] = (pc + 1) & 0xffff
+            word = (ram.peek_and_notify if read_pages[pc >> PAGE_SHIFT] else read)(pc)
+            instruction = table[word]
+            before = cpu.cycle
+            cpu.cycle += instruction.cycles
+            a_val, addr = instruction.a_resolve(cpu)
+            instruction.handler(cpu, a_val, instruction.b_resolve(cpu)[0], addr)
+            spent = cpu.cycle - before
+            slot, a_mode, b_mode = slots[word]
+            opcode_instructions[slot] += 1
+            opcode_cycles[slot] += spent
+            pc_instructions[pc] += 1
+            pc_cycles[pc] += spent
+            mode_instructions[a_mode] += 1
+            mode_cycles[a_mode] += spent
+            mode_instructions[b_mode] += 1
+            mode_cycles[b_mode] += spent
+            return 1
+
+        return run_steps(cpu, step, max_cycles, max_instructions, until_pc, stop, skip_loops=False)
+
+    # (opcode name, instructions, cycles) by descending cycles
+    def flat_profile(self):
+        rows = [(name, self.opcode_instructions[slot], self.opcode_cycles[slot])
+                for slot, name in enumerate(OPCODE_NAMES) if self.opcode_instructions[slot]]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    # (Operand, instructions, cycles) by descending cycles; an instruction
+    # counts once for each operand, so both of SET A, [next] count here
+    def operand_profile(self):
+        rows = [(kind, self.mode_instructions[kind.value], self.mode_cycles[kind.value])
+                for kind in Operand if self.mode_instructions[kind.value]]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    # (pc, instructions, cycles) for the count addresses with the most cycles
+    def hot_addresses(self, count=20):
+        pc_cycles = self.pc_cycles
+        hot = nlargest(count, (pc for pc in range(0x10000) if pc_cycles[pc]), key=pc_cycles.__getitem__)
+        return [(pc, self.pc_instructions[pc], pc_cycles[pc]) for pc in hot]
+
+    def report(self, count=20):
+        total = sum(self.opcode_cycles) or 1
+        lines = ['%-8s %12s %12s %7s' % ('opcode', 'instructions', 'cycles', '%')]
+        for name, instructions, cycles in self.flat_profile():
+            lines.append('%-8s %12d %12d %6.2f%%' % (name, instructions, cycles, 100.0 * cycles / total))
+        lines.append('')
+        lines.append('%-20s %12s %12s' % ('operand', 'instructions', 'cycles'))
+        for kind, instructions, cycles in self.operand_profile():
+            lines.append('%-20s %12d %12d' % (kind.name, instructions, cycles))
+        lines.append('')
+        lines.append('%-8s %12s %12s %7s' % ('pc', 'instructions', 'cycles', '%'))
+        for pc, instructions, cycles in self.hot_addresses(count):
+            lines.append('0x%04x   %12d %12d %6.2f%%' % (pc, instructions, cycles, 100.0 * cycles / total))
+        return '\n'.join(lines)
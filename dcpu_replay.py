@@ -0,0 +1,236 @@
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+import zlib
+
+from dcpu import PC, REGISTER_BASE, RunResult, SpinCheck, StopReason, word_typecode
+
+# Record/replay.  A Recorder runs a machine while taking compressed
+# checkpoints every interval cycles and logging everything that does not
+# follow from the program itself:
+#
+# - RAM writes and register changes made between runs (keyboard presses,
+#   injected RAM.set calls, debugger edits), logged at the current cycle
+# - writes inside device ranges during runs (scheduled device events and
+#   device responses), logged at the cycle the instruction or event ended
+# - values produced by device reads inside device ranges, replayed in order
+#
+# seek(cycle) restores the nearest earlier checkpoint and re-executes with
+# CPU.run, applying logged inputs as their cycles are reached.  Recording
+# must use an engine that keeps cpu.cycle exact at every instruction (the
+# CPU itself or a DeviceBus around it), and devices should be idle while
+# seeking since replayed writes still reach their hooks.  Running after a
+# seek into the past discards the recorded future.
+
+Checkpoint = namedtuple('Checkpoint', ('cycle', 'registers', 'ram', 'inputs', 'reads'))
+
+class Recorder():
+    def __init__(self, cpu, engine=None, interval=100000):
+        self.cpu = cpu
+        self.engine = engine if engine is not None else cpu
+        self.interval = interval
+        self.checkpoints = []
+        # (cycle, target, value); targets from REGISTER_BASE up are registers
+        self.inputs = []
+        # (cycle, address, value) for each device read
+        self.reads = []
+        self.device_ranges = []
+        # None outside runs, 'record' while running, 'replay' while seeking
+        self.mode = None
+        # inputs and reads already applied, while in the past
+        self.input_cursor = self.read_cursor = None
+        self.end = cpu.cycle
+        self.checkpoint()
+        self.registers = tuple(cpu.reg.values)
+        cpu.ram.add_write_hook(self.external)
+
+    def close(self):
+        ram = self.cpu.ram
+        ram.remove_write_hook(self.external)
+        for start, stop, write_hook, read_hook in self.device_ranges:
+            ram.remove_write_hook(write_hook, start, stop)
+            if read_hook is not None:
+                ram.remove_read_hook(read_hook, start, stop)
+        self.device_ranges = []
+
+    # Logs writes (and, with reads, device reads) in [start, stop) during
+    # runs.  Read hooks must be added after the device's own read hooks so
+    # that they see the value the device produced.
+    def record_device(self, start, stop, reads=False):
+        ram = self.cpu.ram
+        contents = ram.contents
+        def write_hook(first, last):
+            if self.mode == 'record':
+                for address in range(max(first, start), min(last, stop)):
+                    self.inputs.append((self.cpu.cycle, address, contents[address]))
+        def read_hook(address):
+            if not start <= address < stop:
+                return
+            if self.mode == 'record':
+                self.reads.append((self.cpu.cycle, address, contents[address]))
+            elif self.mode == 'replay' and self.read_cursor < len(self.reads):
+                # poke rather than a contents write, so that write hooks
+                # such as a StateHash see the replayed value
+                ram.poke(address, self.reads[self.read_cursor][2])
+                self.read_cursor += 1
+        ram.add_write_hook(write_hook, start, stop)
+        if reads:
+            ram.add_read_hook(read_hook, start, stop)
+        self.device_ranges.append((start, stop, write_hook, read_hook if reads else None))
+
+    # records every device on a DeviceBus
+    def record_bus(self, bus):
+        for device in bus.devices:
+            self.record_device(device.start, device.stop, device.reads)
+
+    def external(self, start, stop):
+        if self.mode is not None:
+            return
+        self.truncate()
+        contents = self.cpu.ram.contents
+        for address in range(start, stop):
+            self.inputs.append((self.cpu.cycle, address, contents[address]))
+
+    def checkpoint(self):
+        cpu = self.cpu
+        ram = zlib.compress(cpu.ram.snapshot().tobytes(), 1)
+        self.checkpoints.append(Checkpoint(cpu.cycle, tuple(cpu.reg.values), ram,
+                                           len(self.inputs), len(self.reads)))
+
+    # forgets everything recorded after the current position in the past
+    def truncate(self):
+        if self.input_cursor is None:
+            return
+        cycle = self.cpu.cycle
+        del self.inputs[self.input_cursor:]
+        del self.reads[self.read_cursor:]
+        del self.checkpoints[bisect_right(self.checkpoints, cycle, key=lambda checkpoint: checkpoint.cycle):]
+        self.input_cursor = self.read_cursor = None
+        self.end = cycle
+
+    # same arguments and result as CPU.run
+    def run(self, max_cycles=None, max_instructions=None, until_pc=None, stop=None):
+        cpu = self.cpu
+        values = cpu.reg.values
+        self.truncate()
+        for index, (old, new) in enumerate(zip(self.registers, values)):
+            if old != new:
+                self.inputs.append((cpu.cycle, REGISTER_BASE + index, new))
+        start_cycle = cpu.cycle
+        cycle_limit = start_cycle + max_cycles if max_cycles is not None else None
+        executed = 0
+        # the engine only sees a limited run, so a run without limits looks
+        # for busy waits across its slices
+        spin = SpinCheck() if cycle_limit is None and max_instructions is None and stop is None else None
+        self.mode = 'record'
+        try:
+            while True:
+                next_checkpoint = self.checkpoints[-1].cycle + self.interval
+                if cpu.cycle >= next_checkpoint:
+                    self.checkpoint()
+                    next_checkpoint = cpu.cycle + self.interval
+                if cycle_limit is not None and cpu.cycle >= cycle_limit:
+                    return RunResult(executed, cpu.cycle - start_cycle, StopReason.MAX_CYCLES)
+                if max_instructions is not None and executed >= max_instructions:
+                    return RunResult(executed, cpu.cycle - start_cycle, StopReason.MAX_INSTRUCTIONS)
+                limit = next_checkpoint if cycle_limit is None else min(next_checkpoint, cycle_limit)
+                result = self.engine.run(
+                    max_cycles=limit - cpu.cycle,
+                    max_instructions=max_instructions - executed if max_instructions is not None else None,
+                    until_pc=until_pc, stop=stop)
+                executed += result.instructions
+                if result.reason in (StopReason.UNTIL_PC, StopReason.STOP, StopReason.HALTED):
+                    return RunResult(executed, cpu.cycle - start_cycle, result.reason)
+                if spin is not None and spin.check(cpu, self.engine):
+                    return RunResult(executed, cpu.cycle - start_cycle, StopReason.HALTED)
+        finally:
+            if spin is not None:
+                spin.close()
+            self.mode = None
+            self.end = cpu.cycle
+            self.registers = tuple(values)
+
+    def restore(self, checkpoint):
+        cpu = self.cpu
+        words = array(word_typecode(cpu.ram.word_length))
+        words.frombytes(zlib.decompress(checkpoint.ram))
+        self.mode = 'replay'
+        try:
+            cpu.restore(checkpoint._replace(ram=words))
+        finally:
+            self.mode = None
+        self.input_cursor = checkpoint.inputs
+        self.read_cursor = checkpoint.reads
+
+    # Re-executes up to the first instruction boundary at or after target,
+    # calling visit(cpu) at every boundary before it when given.
+    def forward(self, target, visit=None):
+        cpu = self.cpu
+        inputs = self.inputs
+        self.mode = 'replay'
+        try:
+            while True:
+                while self.input_cursor < len(inputs) and inputs[self.input_cursor][0] <= cpu.cycle:
+                    _, address, value = inputs[self.input_cursor]
+                    if address < REGISTER_BASE:
+                        cpu.ram.poke(address, value)
+                    else:
+                        cpu.reg.values[address - REGISTER_BASE] = value
+                    self.input_cursor += 1
+                if cpu.cycle >= target:
+                    break
+                if visit is not None:
+                    visit(cpu)
+                limit = target
+                if self.input_cursor < len(inputs):
+                    limit = min(limit, inputs[self.input_cursor][0])
+                cpu.run(max_cycles=limit - cpu.cycle, max_instructions=1 if visit is not None else None)
+        finally:
+            self.mode = None
+            self.registers = tuple(cpu.reg.values)
+
+    # index of the last checkpoint at or before cycle
+    def checkpoint_before(self, cycle):
+        return bisect_right(self.checkpoints, cycle, key=lambda checkpoint: checkpoint.cycle) - 1
+
+    # Moves to the first instruction boundary at or after cycle, which is
+    # clamped to the recorded range.
+    def seek(self, cycle):
+        cycle = max(self.checkpoints[0].cycle, min(cycle, self.end))
+        self.restore(self.checkpoints[self.checkpoint_before(cycle)])
+        self.forward(cycle)
+        if self.cpu.cycle >= self.end:
+            self.truncate()
+
+    # boundaries in [checkpoint index, stop) at which predicate(cpu) holds
+    def boundaries(self, index, stop, predicate):
+        found = []
+        self.restore(self.checkpoints[index])
+        self.forward(stop, lambda cpu: found.append(cpu.cycle) if predicate(cpu) else None)
+        return found
+
+    # Moves back to the last boundary before the current one at which
+    # predicate(cpu) holds, searching one checkpoint interval at a time.
+    # Returns False, at the start of the recording, if there is none.
+    def reverse_until(self, predicate):
+        current = self.cpu.cycle
+        index = self.checkpoint_before(current - 1)
+        stop = current
+        while index >= 0:
+            found = self.boundaries(index, stop, predicate)
+            if found:
+                self.seek(found[-1])
+                return True
+            stop = self.checkpoints[index].cycle
+            index -= 1
+        self.seek(self.checkpoints[0].cycle)
+        return False
+
+    def reverse_step(self):
+        return self.reverse_until(lambda cpu: True)
+
+    # breakpoints is a container of PCs, such as Debugger.breakpoints
+    def reverse_continue(self, breakpoints):
+        if isinstance(breakpoints, (bytes, bytearray)):
+            return self.reverse_until(lambda cpu: breakpoints[cpu.reg.values[PC]])
+        return self.reverse_until(lambda cpu: cpu.reg.values[PC] in breakpoints)
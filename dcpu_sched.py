@@ -0,0 +1,171 @@
+from enum import Enum
+import time
+
+from dcpu import SpinCheck, StopReason
+
+# Machine scheduler: runs many machines in one process in ticks.  Every tick
+# each ready machine gets one slice of up to its cycle quota, run by its
+# engine in a single run() call, so the per-machine cost is one call per
+# slice rather than per instruction.  Overshoot past a quota is taken off
+# the machine's next slice, which keeps the cycles each machine gets in
+# proportion to its quota.
+#
+# A machine that can make no progress on its own is parked: it leaves the
+# run queue, its cycle counter stops and it costs nothing until a write to
+# its RAM (through poke, set or restore) or wake() makes it ready again.
+# That covers machines on a self-jump (CPU.is_halted) and machines that
+# SpinCheck proves are spinning.
+#
+#     scheduler = Scheduler(quota=10000)
+#     machines = [scheduler.add(CPU(initial_ram=rom.copy())) for _ in range(10000)]
+#     scheduler.run()
+
+DEFAULT_QUOTA = 10000
+
+class MachineState(Enum):
+    READY = 'ready'
+    PARKED = 'parked'
+    FAILED = 'failed'   # raised ValueError; see Machine.error
+
+class Machine():
+    __slots__ = ('cpu', 'engine', 'quota', 'state', 'debt', 'ready', 'hook', 'spin',
+                 'reason', 'error', 'cycles', 'instructions', 'slices', 'wakeups', 'latency',
+                 'max_latency')
+
+    def __init__(self, cpu, engine, quota):
+        self.cpu = cpu
+        self.engine = engine
+        self.quota = quota
+        self.state = MachineState.READY
+        # cycles the last slice overshot its quota by
+        self.debt = 0
+        # clock time at which the machine last became ready to run
+        self.ready = None
+        # the write hook that wakes the machine while it is parked
+        self.hook = None
+        self.spin = SpinCheck()
+        # the last slice's StopReason, or None after an error
+        self.reason = None
+        self.error = None
+        self.cycles = 0
+        self.instructions = 0
+        self.slices = 0
+        self.wakeups = 0
+        # seconds spent ready but waiting for a slice, in total and at most
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def mean_latency(self):
+        return self.latency / self.slices if self.slices else 0.0
+
+    def __repr__(self):
+        return '<Machine %s %d cycles>' % (self.state.name.lower(), self.cycles)
+
+class Scheduler():
+    def __init__(self, quota=DEFAULT_QUOTA, clock=time.perf_counter):
+        self.quota = quota
+        self.clock = clock
+        self.machines = []
+        # ready machines in the order they run next tick
+        self.queue = []
+        self.ticks = 0
+
+    # engine is anything with CPU.run's signature; quota defaults to the
+    # scheduler's
+    def add(self, cpu, engine=None, quota=None):
+        machine = Machine(cpu, engine if engine is not None else cpu, quota if quota is not None else self.quota)
+        machine.ready = self.clock()
+        self.machines.append(machine)
+        self.queue.append(machine)
+        return machine
+
+    def remove(self, machine):
+        if machine.state is MachineState.PARKED:
+            self.unhook(machine)
+        machine.spin.close()
+        self.machines.remove(machine)
+        if machine in self.queue:
+            self.queue.remove(machine)
+
+    def ready(self):
+        return [machine for machine in self.machines if machine.state is MachineState.READY]
+
+    def parked(self):
+        return [machine for machine in self.machines if machine.state is MachineState.PARKED]
+
+    def park(self, machine):
+        machine.state = MachineState.PARKED
+        machine.spin.reset()
+        machine.hook = lambda start, stop: self.wake(machine)
+        machine.cpu.ram.add_write_hook(machine.hook)
+
+    def unhook(self, machine):
+        machine.cpu.ram.remove_write_hook(machine.hook)
+        machine.hook = None
+
+    # makes a parked machine ready from the next tick on; also needed after
+    # changing a parked machine's registers
+    def wake(self, machine):
+        if machine.state is not MachineState.PARKED:
+            return
+        self.unhook(machine)
+        machine.state = MachineState.READY
+        machine.ready = self.clock()
+        machine.wakeups += 1
+        self.queue.append(machine)
+
+    # Gives every ready machine one slice; returns the cycles run
+    def tick(self):
+        clock = self.clock
+        queue, self.queue = self.queue, []
+        total = 0
+        now = clock()
+        for machine in queue:
+            if machine.state is not MachineState.READY:
+                continue
+            latency = now - machine.ready
+            machine.latency += latency
+            if latency > machine.max_latency:
+                machine.max_latency = latency
+            machine.slices += 1
+            cycles = machine.quota - machine.debt
+            if cycles <= 0:
+                machine.debt = -cycles
+                machine.ready = now
+                self.queue.append(machine)
+                continue
+            cpu = machine.cpu
+            start_cycle = cpu.cycle
+            try:
+                result = machine.engine.run(max_cycles=cycles)
+            except ValueError as error:
+                machine.state = MachineState.FAILED
+                machine.reason = None
+                machine.error = error
+                machine.cycles += cpu.cycle - start_cycle
+                total += cpu.cycle - start_cycle
+                now = clock()
+                continue
+            machine.cycles += result.cycles
+            machine.instructions += result.instructions
+            total += result.cycles
+            machine.debt = max(result.cycles - cycles, 0)
+            machine.reason = result.reason
+            if result.reason is StopReason.HALTED or cpu.is_halted() or machine.spin.check(cpu, machine.engine):
+                machine.reason = StopReason.HALTED
+                self.park(machine)
+            else:
+                self.queue.append(machine)
+            now = machine.ready = clock()
+        self.ticks += 1
+        return total
+
+    # Runs ticks until no machine is ready, or for at most ticks ticks;
+    # returns the number of ticks run
+    def run(self, ticks=None):
+        count = 0
+        while self.queue and (ticks is None or count < ticks):
+            self.tick()
+            count += 1
+        return count
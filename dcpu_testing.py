@@ -0,0 +1,94 @@
+import dcpu
+from dcpu import Opcode, compile_word
+
+# Helpers shared by the tests and the benchmarks: a few assembler shortcuts,
+# the programs they run, and reference machines to check engines against.
+
+A, B, C, X, Y, Z, I, J = range(8)
+POP, PUSH, PC = 0x18, 0x1a, 0x1c
+NEXT = 0x1f
+
+def literal(value):
+    return 0x20 + value
+
+def op(opcode, a, b):
+    return compile_word(b, a, opcode.value)
+
+def jsr(a):
+    return compile_word(a, 0x01, 0x0)
+
+# the example program from dcpu-1-1.txt; it ends in a SET PC, crash loop
+EXAMPLE = [0x7c01, 0x0030, 0x7de1, 0x1000,
+           0x0020, 0x7803, 0x1000, 0xc00d,
+           0x7dc1, 0x001a, 0xa861, 0x7c01,
+           0x2000, 0x2161, 0x2000, 0x8463,
+           0x806d, 0x7dc1, 0x000d, 0x9031,
+           0x7c10, 0x0018, 0x7dc1, 0x001a,
+           0x9037, 0x61c1, 0x7dc1, 0x001a]
+
+ARITHMETIC = [op(Opcode.ADD, A, literal(1)),
+              op(Opcode.XOR, B, A),
+              op(Opcode.SET, C, B),
+              op(Opcode.MUL, C, A),
+              op(Opcode.ADD, X, C),
+              op(Opcode.SHR, X, literal(1)),
+              op(Opcode.SET, PC, literal(0))]
+
+# copies 0x1000 words from 0x4000 to 0x8000, then starts over
+MEMCPY = [op(Opcode.SET, I, literal(0)),
+          op(Opcode.SET, 0x10 + I, 0x10 + I), 0x8000, 0x4000,
+          op(Opcode.ADD, I, literal(1)),
+          op(Opcode.IFN, I, NEXT), 0x1000,
+          op(Opcode.SET, PC, literal(1)),
+          op(Opcode.SET, PC, literal(0))]
+
+# recurses 16 deep, pushing the argument around each call
+RECURSION = [op(Opcode.SET, A, literal(16)),
+             jsr(literal(3)),
+             op(Opcode.SET, PC, literal(0)),
+             op(Opcode.IFE, A, literal(0)),           # 3
+             op(Opcode.SET, PC, POP),
+             op(Opcode.SUB, A, literal(1)),
+             op(Opcode.SET, PUSH, A),
+             jsr(literal(3)),
+             op(Opcode.SET, A, POP),
+             op(Opcode.ADD, B, A),
+             op(Opcode.SET, PC, POP)]
+
+def machine(contents, registers=None):
+    ram = dcpu.RAM(word_length=16, size=0x10000, initial_contents=contents)
+    return dcpu.CPU(initial_registers=registers, initial_ram=ram)
+
+def state(cpu):
+    return [cpu.reg[reg] for reg in cpu.reg], cpu.cycle, list(cpu.ram.contents)
+
+# The reference run that the engines are checked against: a fresh machine
+# stepped one instruction at a time, for instructions instructions or up to
+# the first instruction boundary at or after cycles
+def stepped(contents, registers=None, cycles=None, instructions=None):
+    cpu = machine(contents, registers)
+    if instructions is not None:
+        for _ in range(instructions):
+            cpu.step()
+    else:
+        while cpu.cycle < cycles:
+            cpu.step()
+    return cpu
+
+def random_program(rng, length=48):
+    words = []
+    while len(words) < length:
+        if rng.random() < 0.1:
+            words.append(compile_word(rng.randrange(0x40), 0x01, 0x0)) # JSR
+        else:
+            words.append(compile_word(rng.randrange(0x40), rng.randrange(0x40), rng.randrange(1, 0x10)))
+        # keep next words small so that jumps and pointers stay near the code
+        words.extend(rng.randrange(length) for _ in range(2))
+    return words[:length]
+
+# random registers for a random_program, starting at its first word
+def random_registers(rng):
+    registers = {reg: rng.randrange(0x10000) for reg in dcpu.DCPURegisterBank.all_regs}
+    registers['pc'] = 0
+    registers['sp'] = rng.choice([0, rng.randrange(0x10000)])
+    return registers
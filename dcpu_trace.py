@@ -0,0 +1,211 @@
+from array import array
+from collections import namedtuple
+import queue
+import struct
+import sys
+import threading
+
+from dcpu import (CONDITIONS, DECODE_TABLE, O, PAGE_SHIFT, PC, REGISTER_BASE, SP,
+                  NonBasicOpcode, run_steps)
+
+# Execution trace.  Tracer.run runs the CPU through run_steps with a step
+# that stores one fixed-size record per executed instruction in a
+# preallocated ring buffer.  With a path, every full segment of the ring is handed to a
+# background thread that appends it to the file, so the trace can be far
+# larger than the ring.
+#
+# File format: a 16-byte header, then records, all little-endian.
+#
+#     header: 8s magic b'DCPUTRC1', H record size in words (8), H flags (0),
+#             I reserved (0)
+#     record: H pc, H instruction word, H first next word, H second next
+#             word, H write target, H written value, H O after the
+#             instruction, H info
+#
+# info holds the cycles the instruction took in bits 0-7, its number of
+# next words in bits 8-9 and what it wrote in bits 12-13: 0 nothing, 1 the
+# RAM word at target, 2 the register with index target.  Unused fields are
+# 0.
+
+MAGIC = b'DCPUTRC1'
+HEADER = struct.Struct('<8sHHI')
+RECORD_WORDS = 8
+
+NO_WRITE, RAM_WRITE, REGISTER_WRITE = range(3)
+
+TraceRecord = namedtuple('TraceRecord', ('pc', 'word', 'next_words', 'write', 'target',
+                                         'value', 'o', 'cycles'))
+
+def _writes(instruction):
+    if instruction.opcode is None or instruction.opcode in CONDITIONS:
+        return 0
+    if instruction.opcode is NonBasicOpcode.JSR:
+        return 2
+    return 1
+
+# per decoded word: 0 writes nothing, 1 writes its a operand, 2 pushes (JSR)
+WRITES = bytes(_writes(instruction) for instruction in DECODE_TABLE)
+
+def decode_record(words, offset=0):
+    info = words[offset + 7]
+    count = (info >> 8) & 3
+    return TraceRecord(words[offset], words[offset + 1], tuple(words[offset + 2:offset + 2 + count]),
+                       info >> 12, words[offset + 4], words[offset + 5], words[offset + 6], info & 0xff)
+
+class _Writer(threading.Thread):
+    def __init__(self, path, depth):
+        super().__init__(daemon=True)
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, RECORD_WORDS, 0, 0))
+        self.segments = queue.Queue(depth)
+        self.start()
+
+    def run(self):
+        while True:
+            segment = self.segments.get()
+            if segment is None:
+                break
+            if sys.byteorder != 'little':
+                segment.byteswap()
+            segment.tofile(self.file)
+        self.file.close()
+
+    def close(self):
+        self.segments.put(None)
+        self.join()
+
+class Tracer():
+    # capacity records are kept in memory; segment must divide capacity
+    def __init__(self, cpu, capacity=1 << 16, path=None, segment=1 << 12, queue_depth=8):
+        assert capacity % segment == 0
+        self.cpu = cpu
+        self.capacity = capacity
+        self.segment = segment
+        self.ring = array('H', [0]) * (capacity * RECORD_WORDS)
+        # records ever written; the newest is at (position - 1) % capacity
+        self.position = 0
+        # records already handed to the writer
+        self.flushed = 0
+        self.writer = _Writer(path, queue_depth) if path is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def flush(self, stop):
+        if self.writer is not None and stop > self.flushed:
+            first = (self.flushed % self.capacity) * RECORD_WORDS
+            self.writer.segments.put(self.ring[first:first + (stop - self.flushed) * RECORD_WORDS])
+        self.flushed = stop
+
+    # writes out any partial segment and closes the file
+    def close(self):
+        if self.writer is not None:
+            self.flush(self.position)
+            self.writer.close()
+            self.writer = None
+
+    # the records still in the ring, oldest first
+    def records(self):
+        ring = self.ring
+        for position in range(max(0, self.position - self.capacity), self.position):
+            yield decode_record(ring, (position % self.capacity) * RECORD_WORDS)
+
+    # Same arguments and result as CPU.run, but every instruction is
+    # stepped and recorded: busy waits are not skipped, so a run without
+    # limits only stops with StopReason.HALTED on an instruction that jumps
+    # to itself.
+    def run(self, max_cycles=None, max_instructions=None, until_pc=None, stop=None):
+        cpu = self.cpu
+        values = cpu.reg.values
+        ram = cpu.ram
+        read, read_pages = ram.read, ram.read_pages
+        contents = ram.contents
+        ring = self.ring
+        capacity = self.capacity
+        segment = self.segment
+        table = DECODE_TABLE
+        writes = WRITES
+        position = self.position
+
+        def step(pc, cycle_limit, instructions_left):
+            nonlocal position
+            values[PC] = (pc + 1) & 0xffff
+            word = (ram.peek_and_notify if read_pages[pc >> PAGE_SHIFT] else read)(pc)
+            instruction = table[word]
+            count = instruction.next_words
+            first = contents[(pc + 1) & 0xffff] if count else 0
+            second = contents[(pc + 2) & 0xffff] if count == 2 else 0
+            before = cpu.cycle
+            cpu.cycle += instruction.cycles
+            a_val, addr = instruction.a_resolve(cpu)
+            instruction.handler(cpu, a_val, instruction.b_resolve(cpu)[0], addr)
+
+            i = (position % capacity) * RECORD_WORDS
+            ring[i] = pc
+            ring[i + 1] = word
+            ring[i + 2] = first
+            ring[i + 3] = second
+            kind = writes[word]
+            if kind == 1 and addr is not None:
+                if addr < REGISTER_BASE:
+                    ring[i + 4] = addr
+                    ring[i + 5] = contents[addr]
+                    kind = RAM_WRITE
+                else:
+                    ring[i + 4] = addr - REGISTER_BASE
+                    ring[i + 5] = values[addr - REGISTER_BASE]
+                    kind = REGISTER_WRITE
+            elif kind == 2:
+                ring[i + 4] = values[SP]
+                ring[i + 5] = contents[values[SP]]
+                kind = RAM_WRITE
+            else:
+                ring[i + 4] = ring[i + 5] = 0
+                kind = NO_WRITE
+            ring[i + 6] = values[O]
+            ring[i + 7] = (cpu.cycle - before) | (count << 8) | (kind << 12)
+            position += 1
+            if position % segment == 0:
+                self.flush(position)
+            return 1
+
+        try:
+            return run_steps(cpu, step, max_cycles, max_instructions, until_pc, stop, skip_loops=False)
+        finally:
+            self.position = position
+
+class TraceReader():
+    # Iterates a trace file lazily, chunk_records at a time.
+    def __init__(self, path, chunk_records=1 << 16):
+        self.path = path
+        self.chunk_records = chunk_records
+        with open(path, 'rb') as trace:
+            magic, record_words, flags, reserved = HEADER.unpack(trace.read(HEADER.size))
+            if magic != MAGIC or record_words != RECORD_WORDS:
+                raise ValueError('%s is not a DCPU trace' % path)
+            trace.seek(0, 2)
+            self.length = (trace.tell() - HEADER.size) // (2 * RECORD_WORDS)
+
+    def __len__(self):
+        return self.length
+
+    def chunks(self):
+        with open(self.path, 'rb') as trace:
+            trace.seek(HEADER.size)
+            while True:
+                data = trace.read(self.chunk_records * RECORD_WORDS * 2)
+                if not data:
+                    return
+                words = array('H')
+                words.frombytes(data[:len(data) - len(data) % (2 * RECORD_WORDS)])
+                if sys.byteorder != 'little':
+                    words.byteswap()
+                yield words
+
+    def __iter__(self):
+        for words in self.chunks():
+            for offset in range(0, len(words), RECORD_WORDS):
+                yield decode_record(words, offset)
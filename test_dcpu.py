@@ -2,6 +2,8 @@ import dcpu
 from dcpu import compile_word, decompile_word
 import pytest
 
+from dcpu_testing import EXAMPLE, machine, stepped
+
 @pytest.fixture
 def cpu():
     return dcpu.CPU()
@@ -32,6 +34,111 @@ def test_ram_set(ram):
     with pytest.raises(IndexError):
         ram.set(0xffffffff, 0x0000)
 
+def test_ram_storage():
+    ram = dcpu.RAM(word_length=16, size=0x10000, initial_contents=[1, 2, 3])
+    assert ram.contents.itemsize == 2
+    view = ram.view
+    assert view.nbytes == 0x20000
+    view[3] = 0x1234
+    assert ram.get(3) == 0x1234
+    ram.set(0, 0xffff)
+    assert view[0] == 0xffff
+    assert dcpu.RAM(word_length=8, size=0x10).contents.itemsize == 1
+    assert dcpu.RAM(word_length=128, size=0x10).contents == [0] * 0x10
+
+def test_ram_poke(ram):
+    ram.poke(0x10, 0xfffe)
+    assert ram.peek(0x10) == 0xfffe
+    with pytest.raises(OverflowError):
+        ram.poke(0x10, 0x10000) # poke expects masked values
+
+def test_ram_write_hooks(ram):
+    writes = []
+    hook = lambda start, stop: writes.append((start, stop))
+    ram.add_write_hook(hook, 0x100, 0x200)
+    ram.set(0x0ff, 1)
+    ram.set(0x100, 1)
+    ram.poke(0x1ff, 1)
+    assert writes == [(0x100, 0x101), (0x1ff, 0x200)]
+    ram.remove_write_hook(hook, 0x100, 0x200)
+    assert not ram.write_hooks
+    ram.set(0x100, 2)
+    assert len(writes) == 2
+
+def test_ram_read_hooks(ram):
+    reads = []
+    hook = reads.append
+    ram.add_read_hook(hook, 0x100, 0x101)
+    ram.peek(0x1ff)
+    ram.peek(0x200)
+    ram.get(0x100)
+    assert reads == [0x1ff]
+    ram.remove_read_hook(hook, 0x100, 0x101)
+    assert not ram.read_hooks
+    assert ram.peek == ram.contents.__getitem__
+
+def test_ram_dirty_tracking(ram):
+    words = ram.track_dirty(0x8000, 0x8180)
+    pages = ram.track_dirty(shift=dcpu.PAGE_SHIFT)
+    ram.set(0x8010, 1)
+    ram.set(0x8001, 2)
+    ram.set(0x8010, 3)
+    ram.set(0x8180, 4)
+    ram.set(0x7fff, 5)
+    ram.notify_write(0x817e, 0x8182)
+    assert words.take() == [0x8001, 0x8010, 0x817e, 0x817f]
+    assert words.take() == []
+    assert pages.take() == [0x7f00, 0x8000, 0x8100]
+    ram.set(0x8002, 6)
+    assert words.take() == [0x8002]
+    words.close()
+    pages.close()
+    assert not ram.write_hooks
+
+def test_ram_copy(ram):
+    import copy
+    ram.set(0x10, 0x1234)
+    ram.add_write_hook(lambda start, stop: None)
+    clone = copy.deepcopy(ram)
+    assert clone.get(0x10) == 0x1234
+    assert not clone.write_hooks
+    clone.set(0x10, 0)
+    assert ram.get(0x10) == 0x1234
+
+def test_ram_snapshot_restore(ram):
+    ram.set(0x10, 0x1234)
+    snap = ram.snapshot()
+    writes = []
+    ram.add_write_hook(lambda start, stop: writes.append((start, stop)))
+    ram.set(0x10, 0)
+    ram.set(0x300, 1)
+    del writes[:]
+    ram.restore(snap)
+    assert ram.get(0x10) == 0x1234
+    assert ram.get(0x300) == 0
+    assert sorted(writes) == [(0x000, 0x100), (0x300, 0x400)]
+    clone = ram.copy()
+    assert not clone.write_hooks
+    clone.set(0x10, 0)
+    assert ram.get(0x10) == 0x1234
+
+def test_cpu_snapshot_restore_fork(cpu):
+    cpu.ram.set(0x0000, 0x8402) # ADD A, 1
+    cpu.reg.x = 0x10
+    snap = cpu.snapshot()
+    values = cpu.reg.values
+    cpu.step()
+    cpu.ram.set(0x0100, 0xffff)
+    child = cpu.fork()
+    cpu.restore(snap)
+    assert cpu.reg.values is values
+    assert (cpu.reg.a, cpu.reg.pc, cpu.reg.x, cpu.cycle) == (0, 0, 0x10, 0)
+    assert cpu.ram.get(0x0100) == 0
+    assert (child.reg.a, child.reg.pc, child.cycle) == (1, 1, 2)
+    assert child.ram.get(0x0100) == 0xffff
+    child.ram.set(0x0000, 0)
+    assert cpu.ram.get(0x0000) == 0x8402
+
 def test_cpu_init():
     cpu = dcpu.CPU()
     for reg in cpu.reg:
@@ -104,6 +211,14 @@ def test_register_bank():
     regbank.pc += 1
     assert regbank.pc == 0x0000
 
+def test_register_indices(cpu):
+    cpu.reg.x = 0x1234
+    assert cpu.reg.values[dcpu.X] == 0x1234
+    cpu.reg.values[dcpu.SP] = 0xfffe
+    assert cpu.reg['sp'] == 0xfffe
+    assert cpu.get_by_code(0x03, return_addr=True) == (0x1234, dcpu.REGISTER_BASE + dcpu.X)
+    assert cpu.get_by_code(0x1b, return_addr=True) == (0xfffe, dcpu.REGISTER_BASE + dcpu.SP)
+
 @pytest.mark.parametrize(('set_code', 'get_code', 'reg'), [
     (0x00, 0x00, 'a'),
     (0x01, 0x01, 'b'),
@@ -225,6 +340,54 @@ def test_compile_decompile_word():
     assert compile_word(0x03, 0x01, 0x2) == 0b0000110000010010 # ADD register B to register X and put in register B
     assert decompile_word(0b0000110000010010) == (0x03, 0x01, 0x2)
 
+def test_decode_table():
+    instruction = dcpu.DECODE_TABLE[compile_word(0x22, 0x01, 0x1)] # SET B, 2
+    assert instruction.opcode == dcpu.Opcode.SET
+    assert instruction.handler is dcpu.CPU.SET
+    assert (instruction.a, instruction.b) == (0x01, 0x22)
+    assert instruction.a_kind == dcpu.Operand.REGISTER
+    assert instruction.b_kind == dcpu.Operand.LITERAL
+    assert (instruction.a_literal, instruction.b_literal) == (None, 0x02)
+    assert instruction.next_words == 0
+    assert instruction.cycles == 1
+
+    instruction = dcpu.DECODE_TABLE[0x7de1] # SET [next_word], next_word
+    assert instruction.a_kind == dcpu.Operand.NEXT_WORD_INDIRECT
+    assert instruction.b_kind == dcpu.Operand.NEXT_WORD_LITERAL
+    assert instruction.next_words == 2
+    assert instruction.cycles == 3
+
+    instruction = dcpu.DECODE_TABLE[compile_word(0x10, 0x01, 0x00)] # JSR [next_word + A]
+    assert instruction.opcode == dcpu.NonBasicOpcode.JSR
+    assert (instruction.a, instruction.b) == (0x10, None)
+    assert instruction.next_words == 1
+    assert instruction.cycles == 3
+
+    assert len(dcpu.DECODE_TABLE) == 0x10000
+    for word in (0x0000, compile_word(0x00, 0x02, 0x00)):
+        assert dcpu.DECODE_TABLE[word].opcode is None
+
+def test_invalid_instruction(cpu):
+    cpu.ram.set(0x0000, compile_word(0x00, 0x02, 0x00))
+    with pytest.raises(ValueError):
+        cpu.step()
+
+def test_literal_assignment_fails_silently(cpu):
+    cpu.ram.set(0x0000, compile_word(0x21, 0x20, 0x1)) # SET 0, 1
+    cpu.step()
+    assert cpu.cycle == 1
+    assert cpu.reg.pc == 1
+    assert all(cpu.reg[reg] == 0 for reg in cpu.reg if reg != 'pc')
+
+def test_next_word_register_operand_wraps(cpu):
+    cpu.reg.a = 0xffff
+    cpu.ram.set(0x0000, compile_word(0x25, 0x10, 0x1)) # SET [next_word + A], 5
+    cpu.ram.set(0x0001, 0x0002)
+    cpu.step()
+    assert cpu.ram.get(0x0001) == 0x0005
+    assert cpu.cycle == 2
+    assert cpu.reg.pc == 2
+
 def test_SET(cpu):
     assert cpu.reg.b == 0x0000
     cpu.ram.set(0x0000, compile_word(0x22, 0x01, 0x1)) # set reg b to literal 2
@@ -473,15 +636,7 @@ def test_a_handled_before_b(cpu):
     assert cpu.ram.get(0x0020) != 0x1000
 
 def test_example_code():
-    contents = [0x7c01, 0x0030, 0x7de1, 0x1000,
-                0x0020, 0x7803, 0x1000, 0xc00d,
-                0x7dc1, 0x001a, 0xa861, 0x7c01,
-                0x2000, 0x2161, 0x2000, 0x8463,
-                0x806d, 0x7dc1, 0x000d, 0x9031,
-                0x7c10, 0x0018, 0x7dc1, 0x001a,
-                0x9037, 0x61c1, 0x7dc1, 0x001a]
-    ram = dcpu.RAM(word_length=16, size=0x10000, initial_contents=contents)
-    cpu = dcpu.CPU(initial_ram=ram)
+    cpu = machine(EXAMPLE)
 
     cpu.step()
     assert cpu.reg.a == 0x30
@@ -556,3 +711,126 @@ def test_example_code():
     for _ in range(100): cpu.step()
     assert cpu.reg.pc == 0x001a
     assert cpu.cycle == 302
+
+def test_run_limits():
+    cpu = machine(EXAMPLE)
+
+    assert cpu.run(max_instructions=6) == (6, 14, dcpu.StopReason.MAX_INSTRUCTIONS)
+    assert cpu.reg.pc == 0x000d
+
+    assert cpu.run(until_pc=0x0013) == (39, 79, dcpu.StopReason.UNTIL_PC)
+    assert cpu.reg.i == 0
+    assert cpu.cycle == 93
+
+    assert cpu.run(stop=lambda cpu: cpu.reg.sp != 0) == (2, 4, dcpu.StopReason.STOP)
+    assert cpu.reg.pc == 0x0018
+
+    result = cpu.run(max_cycles=205)
+    assert result.reason == dcpu.StopReason.MAX_CYCLES
+    assert cpu.cycle == 302
+    assert cpu.reg.pc == 0x001a
+
+    assert cpu.run(max_cycles=0) == (0, 0, dcpu.StopReason.MAX_CYCLES)
+
+def test_run_fast_forward_is_exact():
+    for cycles in (300, 301, 302, 303, 317, 1000, 1001):
+        reference = stepped(EXAMPLE, cycles=cycles)
+        cpu = machine(EXAMPLE)
+        result = cpu.run(max_cycles=cycles)
+        assert result.cycles == cpu.cycle == reference.cycle
+        assert cpu.reg.values == reference.reg.values
+    for instructions in (150, 151, 500, 501):
+        reference = stepped(EXAMPLE, instructions=instructions)
+        cpu = machine(EXAMPLE)
+        assert cpu.run(max_cycles=5000, max_instructions=instructions) == (
+            instructions, reference.cycle, dcpu.StopReason.MAX_INSTRUCTIONS)
+        assert cpu.reg.values == reference.reg.values
+
+    cpu = machine(EXAMPLE)
+    assert cpu.run(max_cycles=10**9 + 1) == (150 + (10**9 + 2 - 302) // 2, 10**9 + 2, dcpu.StopReason.MAX_CYCLES)
+    assert cpu.reg.pc == 0x001a
+
+def test_run_halts_without_limits():
+    cpu = machine(EXAMPLE)
+    result = cpu.run()
+    assert result.reason == dcpu.StopReason.HALTED
+    assert cpu.reg.pc == 0x001a and cpu.is_halted()
+    assert cpu.run(until_pc=0x0000).reason == dcpu.StopReason.HALTED
+
+def test_run_does_not_skip_writes():
+    # ADD [0x0100], 1; SET PC, 0 keeps its registers but not its RAM
+    cpu = dcpu.CPU(initial_ram=dcpu.RAM(word_length=16, size=0x10000, initial_contents=[
+        compile_word(0x21, 0x1e, 0x2), 0x0100, compile_word(0x20, 0x1c, 0x1)]))
+    assert cpu.run(max_cycles=4000).instructions == 2000
+    assert cpu.ram.get(0x0100) == 1000
+
+    # SET [0x0100], 0; SET PC, 0 repeats exactly, but its writes reach a hook
+    cpu = dcpu.CPU(initial_ram=dcpu.RAM(word_length=16, size=0x10000, initial_contents=[
+        compile_word(0x20, 0x1e, 0x1), 0x0100, compile_word(0x20, 0x1c, 0x1)]))
+    writes = []
+    cpu.ram.add_write_hook(lambda start, stop: writes.append(start), 0x0100, 0x0101)
+    assert cpu.run(max_cycles=3000).instructions == 2000
+    assert len(writes) == 1000
+    assert len(cpu.ram.write_hooks[0x0100 >> dcpu.PAGE_SHIFT]) == 1
+
+    # without the hook the same loop is skipped
+    cpu.ram.write_hooks.clear()
+    cpu.ram.rebind()
+    assert cpu.run().reason == dcpu.StopReason.HALTED
+
+def test_busy_wait_detection_on_wide_words():
+    # words wider than 64 bits are kept in a list rather than an array
+    def wide():
+        return dcpu.CPU(initial_ram=dcpu.RAM(word_length=128, size=0x10000, initial_contents=EXAMPLE))
+    cpu = wide()
+    assert isinstance(cpu.ram.contents, list)
+    assert cpu.run().reason == dcpu.StopReason.HALTED
+    assert cpu.reg.pc == 0x001a
+    cpu = wide()
+    assert cpu.run(max_cycles=1001).cycles == 1002
+    assert cpu.reg.values == stepped(EXAMPLE, cycles=1001).reg.values
+
+    cpu = wide()
+    spin = dcpu.SpinCheck()
+    for slices in range(1, 10):
+        cpu.run(max_cycles=1000, stop=lambda cpu: False)
+        if spin.check(cpu):
+            break
+    assert slices < 10 and cpu.reg.pc == 0x001a
+
+def test_cpu_construction_is_cheap():
+    cpu = dcpu.CPU()
+    assert not hasattr(cpu, '__dict__')
+    assert cpu.operands is dcpu.CPU().operands
+    assert cpu.reg.values == [0] * 11
+    assert cpu.address_for_operand(0x1d) == dcpu.REGISTER_BASE + dcpu.O
+    assert cpu.address_for_operand(0x1f) is None
+
+def test_state_hash():
+    cpu = machine(EXAMPLE)
+    first = cpu.state_hash()
+    assert cpu.state_hash() == first == machine(EXAMPLE).state_hash()
+    cpu.reg.a = 1
+    assert cpu.state_hash() != first
+    cpu.reg.a = 0
+    cpu.ram.set(0x1234, 5)
+    assert cpu.state_hash() != first
+    cpu.ram.set(0x1234, 0)
+    assert cpu.state_hash() == first
+
+    # kept current while running, and after restore
+    snapshot = cpu.snapshot()
+    cpu.run(max_cycles=200)
+    assert cpu.state_hash() == dcpu.CPU(dict(zip(dcpu.DCPURegisterBank.all_regs, cpu.reg.values)),
+                                        cpu.ram.copy()).state_hash()
+    cpu.restore(snapshot)
+    assert cpu.state_hash() == first
+
+def test_state_hash_finds_loops():
+    cpu = machine(EXAMPLE)
+    seen = {}
+    while cpu.state_hash() not in seen:
+        seen[cpu.state_hash()] = cpu.cycle
+        cpu.step()
+    assert cpu.reg.pc == 0x001a
+    assert seen[cpu.state_hash()] == cpu.cycle - 2
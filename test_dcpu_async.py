@@ -0,0 +1,140 @@
+import asyncio
+import time
+
+import dcpu
+from dcpu_async import AsyncMachine, run_machines
+import pytest
+
+from dcpu_testing import EXAMPLE, machine, state
+
+COUNTER = [0x8402, 0x7dc1, 0x0000] # ADD A, 1; SET PC, 0
+
+def test_halts_on_self_jump():
+    cpu = machine(EXAMPLE)
+    driver = AsyncMachine(cpu, frequency=None)
+    result = asyncio.run(driver.run())
+    assert result.reason == dcpu.StopReason.HALTED
+    assert driver.halted.is_set()
+    assert cpu.reg.pc == 0x001a and cpu.is_halted()
+    assert cpu.reg.x == 0x0040
+
+def test_is_halted():
+    assert machine([0x7dc1, 0x0000]).is_halted()  # SET PC, 0 (next word)
+    assert machine([0x81c1]).is_halted()          # SET PC, 0
+    assert machine([0x85c3]).is_halted()          # SUB PC, 1
+    assert not machine([0x7dc1, 0x0002]).is_halted()
+    assert not machine([0x85c2]).is_halted()      # ADD PC, 1
+
+def test_throttles_to_frequency():
+    cpu = machine(COUNTER)
+    driver = AsyncMachine(cpu, frequency=100000, slice_cycles=1000)
+    start = time.monotonic()
+    result = asyncio.run(driver.run(max_cycles=10000))
+    assert time.monotonic() - start >= 0.095
+    assert result == (5000, 10000, dcpu.StopReason.MAX_CYCLES)
+
+def test_machines_interleave():
+    cpus = [machine(COUNTER) for _ in range(3)]
+    progress = []
+    async def main():
+        drivers = [AsyncMachine(cpu, frequency=None, slice_cycles=100) for cpu in cpus]
+        async def sample():
+            for _ in range(3):
+                progress.append([cpu.cycle for cpu in cpus])
+                await asyncio.sleep(0)
+        return await asyncio.gather(run_machines(drivers, max_cycles=1000), sample())
+    results, _ = asyncio.run(main())
+    assert [result.cycles for result in results] == [1000] * 3
+    assert progress[1] == [100, 100, 100]
+    reference = machine(COUNTER)
+    reference.run(max_cycles=1000)
+    assert all(state(cpu) == state(reference) for cpu in cpus)
+
+def test_watch_writes_and_stop():
+    # loop: ADD [0x8000], 1; SET PC, loop
+    cpu = machine([0x85e2, 0x8000, 0x81c1])
+    async def main():
+        driver = AsyncMachine(cpu, frequency=1000000, slice_cycles=100)
+        watch = driver.watch_writes(0x8000, 0x8180)
+        task = asyncio.ensure_future(driver.run())
+        assert await watch.wait() == [0x8000]
+        driver.request_stop()
+        await driver.halted.wait()
+        watch.close()
+        return await task
+    result = asyncio.run(main())
+    assert result.reason == dcpu.StopReason.STOP
+    assert not cpu.ram.write_hooks
+
+def test_error():
+    cpu = machine([0x0000])
+    driver = AsyncMachine(cpu, frequency=None)
+    with pytest.raises(ValueError):
+        asyncio.run(driver.run())
+    assert isinstance(driver.error, ValueError)
+    assert driver.halted.is_set()
+
+def test_parks_busy_waits():
+    # loop: IFE [0x1000], 0; SET PC, loop; SET A, [0x1000]; halt: SET PC, halt
+    cpus = [machine([0x81ec, 0x1000, 0x81c1, 0x7801, 0x1000, 0x95c1]) for _ in range(200)]
+    async def main():
+        drivers = [AsyncMachine(cpu, frequency=None, slice_cycles=999) for cpu in cpus]
+        task = asyncio.ensure_future(run_machines(drivers))
+        for _ in range(20):
+            await asyncio.sleep(0)
+        assert all(driver.parked for driver in drivers)
+        cycles = [cpu.cycle for cpu in cpus]
+        for _ in range(20):
+            await asyncio.sleep(0)
+        assert [cpu.cycle for cpu in cpus] == cycles
+        for index, cpu in enumerate(cpus):
+            cpu.ram.set(0x1000, index + 1)
+        results = await task
+        assert not any(cpu.ram.write_hooks for cpu in cpus)
+        return results
+    results = asyncio.run(main())
+    assert all(result.reason == dcpu.StopReason.HALTED for result in results)
+    assert [cpu.reg.a for cpu in cpus] == list(range(1, 201))
+
+def test_stop_while_parked():
+    cpu = machine([0x81ec, 0x1000, 0x81c1])
+    async def main():
+        driver = AsyncMachine(cpu, frequency=None, slice_cycles=100)
+        task = asyncio.ensure_future(driver.run())
+        while not driver.parked:
+            await asyncio.sleep(0)
+        driver.request_stop()
+        return await task
+    assert asyncio.run(main()).reason == dcpu.StopReason.STOP
+    assert not cpu.ram.write_hooks
+
+def test_parked_machines_keep_pace_with_the_clock():
+    # loop: IFE [0x1000], 0; SET PC, loop
+    program = [0x81ec, 0x1000, 0x81c1]
+    cpu = machine(program)
+    async def main():
+        driver = AsyncMachine(cpu, frequency=100000, slice_cycles=1000)
+        task = asyncio.ensure_future(driver.run(max_cycles=20000))
+        while not driver.parked:
+            await asyncio.sleep(0)
+        return await task
+    start = time.monotonic()
+    result = asyncio.run(main())
+    assert time.monotonic() - start >= 0.19
+    reference = machine(program)
+    assert result == reference.run(max_cycles=20000)
+    assert state(cpu) == state(reference)
+
+    # woken by a write, it carries on from where the clock says it is
+    cpu = machine(program + [0x7801, 0x1000, 0x95c1]) # SET A, [0x1000]; halt: SET PC, halt
+    async def wake():
+        driver = AsyncMachine(cpu, frequency=100000, slice_cycles=1000)
+        task = asyncio.ensure_future(driver.run())
+        while not driver.parked:
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.1)
+        cpu.ram.set(0x1000, 7)
+        return await task
+    result = asyncio.run(wake())
+    assert result.reason == dcpu.StopReason.HALTED
+    assert cpu.reg.a == 7 and cpu.cycle >= 10000
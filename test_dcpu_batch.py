@@ -0,0 +1,48 @@
+import random
+
+import dcpu
+import pytest
+
+np = pytest.importorskip('numpy')
+from dcpu_batch import BatchCPU
+
+from dcpu_testing import EXAMPLE, machine, random_program, random_registers, state
+
+def random_machine(rng):
+    return machine(random_program(rng), random_registers(rng))
+
+def test_example_code():
+    batch = BatchCPU(3, initial_contents=EXAMPLE)
+    batch.run(max_cycles=302)
+    assert list(batch.cycles) == [302] * 3
+    assert list(batch.registers[:, dcpu.PC]) == [0x001a] * 3
+    assert list(batch.registers[:, dcpu.X]) == [0x0040] * 3
+
+@pytest.mark.parametrize('seed', range(10))
+def test_matches_cpu(seed):
+    rng = random.Random(seed)
+    cpus = [random_machine(rng) for _ in range(40)]
+    batch = BatchCPU.from_cpus(cpus)
+    batch.run(max_instructions=200)
+    for index, cpu in enumerate(cpus):
+        faulted = False
+        for _ in range(200):
+            try:
+                cpu.step()
+            except ValueError:
+                faulted = True
+                break
+        assert batch.faulted[index] == faulted
+        assert state(batch.cpu(index)) == state(cpu)
+
+def test_cycle_limit_matches_cpu_run():
+    rng = random.Random(1234)
+    cpus = [random_machine(rng) for _ in range(20)]
+    batch = BatchCPU.from_cpus(cpus)
+    batch.run(max_cycles=150)
+    for index, cpu in enumerate(cpus):
+        try:
+            cpu.run(max_cycles=150)
+        except ValueError:
+            assert batch.faulted[index]
+        assert state(batch.cpu(index)) == state(cpu)
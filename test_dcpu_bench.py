@@ -0,0 +1,44 @@
+import json
+
+import dcpu
+from dcpu_bench import ENGINES, WORKLOADS, BenchCPU, bench_construction, compare, main
+
+from dcpu_testing import machine
+
+def test_workloads_run():
+    for words in WORKLOADS.values():
+        cpu = machine(words)
+        assert cpu.run(max_cycles=20000).reason == dcpu.StopReason.MAX_CYCLES
+
+def test_workloads_are_not_fast_forwarded():
+    for words in WORKLOADS.values():
+        reference = machine(words)
+        expected = reference.run(max_cycles=20000, stop=lambda cpu: False).instructions
+        for engine in ENGINES.values():
+            cpu = BenchCPU(initial_ram=machine(words).ram)
+            assert engine(cpu, 20000).instructions == expected
+
+def test_compare():
+    baseline = {'results': {'loop.run': {'cycles_per_second': 100.0},
+                            'construction': {'seconds': 1.0, 'bytes': 100}}}
+    report = {'results': {'loop.run': {'cycles_per_second': 95.0},
+                          'construction': {'seconds': 1.05, 'bytes': 200},
+                          'new.run': {'cycles_per_second': 1.0}}}
+    assert compare(report, baseline, 0.1) == [('construction', 'bytes', 100, 200)]
+    assert compare(report, baseline, 0.01) == [('loop.run', 'cycles_per_second', 100.0, 95.0),
+                                               ('construction', 'seconds', 1.0, 1.05),
+                                               ('construction', 'bytes', 100, 200)]
+
+def test_construction():
+    result = bench_construction(count=50, repeat=1)
+    assert result['garbage'] == 0
+    assert result['bytes'] < 0x20000 + 0x1000
+
+def test_main(tmp_path):
+    output = tmp_path / 'bench.json'
+    assert main(['--cycles', '2000', '--repeat', '1', '--workload', 'memcpy', '--output', str(output)]) == 0
+    report = json.loads(output.read_text())
+    assert set(report['results']) == {'memcpy.run', 'memcpy.blocks', 'memcpy.fused', 'construction'}
+    report['results']['memcpy.run']['cycles_per_second'] *= 100
+    output.write_text(json.dumps(report))
+    assert main(['--cycles', '2000', '--repeat', '1', '--workload', 'memcpy', '--baseline', str(output)]) == 1
@@ -0,0 +1,102 @@
+import random
+
+import dcpu
+from dcpu_compiler import BlockCompiler
+import pytest
+
+from dcpu_testing import EXAMPLE, machine, random_program, random_registers, state, stepped
+
+def test_example_code():
+    cpu = machine(EXAMPLE)
+    engine = BlockCompiler(cpu)
+    assert engine.run(max_cycles=302) == (150, 302, dcpu.StopReason.MAX_CYCLES)
+    assert cpu.cycle == 302
+    assert cpu.reg.pc == 0x001a
+    assert cpu.reg.x == 0x0040
+    assert cpu.reg.sp == 0x0000
+    assert cpu.ram.get(0x2000 + 1) == 0x0000
+
+def test_run_limits_are_exact():
+    for instructions in range(1, 60):
+        reference = stepped(EXAMPLE, instructions=instructions)
+        cpu = machine(EXAMPLE)
+        result = BlockCompiler(cpu).run(max_instructions=instructions)
+        assert result.instructions == instructions
+        assert result.reason == dcpu.StopReason.MAX_INSTRUCTIONS
+        assert state(cpu) == state(reference)
+
+    for cycles in range(1, 120):
+        reference = stepped(EXAMPLE, cycles=cycles)
+        cpu = machine(EXAMPLE)
+        BlockCompiler(cpu).run(max_cycles=cycles)
+        assert state(cpu) == state(reference)
+
+@pytest.mark.parametrize('seed', range(200))
+def test_matches_step(seed):
+    rng = random.Random(seed)
+    program = random_program(rng)
+    registers = random_registers(rng)
+
+    reference = machine(program, registers)
+    expected_error = None
+    for executed in range(300):
+        try:
+            reference.step()
+        except ValueError as error:
+            expected_error = error
+            break
+
+    cpu = machine(program, registers)
+    engine = BlockCompiler(cpu)
+    if expected_error is None:
+        assert engine.run(max_instructions=300).instructions == 300
+    else:
+        engine.run(max_instructions=executed)
+        with pytest.raises(ValueError):
+            engine.run(max_instructions=1)
+    assert state(cpu) == state(reference)
+
+def test_run_until_pc():
+    reference = machine(EXAMPLE)
+    reference_result = reference.run(until_pc=0x0011)
+    cpu = machine(EXAMPLE)
+    result = BlockCompiler(cpu).run(until_pc=0x0011)
+    assert result == reference_result
+    assert result.reason == dcpu.StopReason.UNTIL_PC
+    assert state(cpu) == state(reference)
+
+def test_self_modifying_code():
+    # SET [0x0003], 0x7c01 overwrites the word at 3 (SET A, 1) with SET A, [next]
+    # before it runs; the block has to notice and leave early.
+    contents = [0x7de1, 0x0003, 0x7c01,
+                0x8401,          # SET A, 1
+                0x0010,
+                0x7dc1, 0x0005]  # SET PC, 5
+    reference = stepped(contents, instructions=4)
+    cpu = machine(contents)
+    engine = BlockCompiler(cpu)
+    engine.run(max_instructions=4)
+    assert state(cpu) == state(reference)
+    assert cpu.reg.a == 0x0010
+
+def test_external_write_invalidates():
+    contents = [0x8401, 0x7dc1, 0x0000] # SET A, 1; SET PC, 0
+    cpu = machine(contents)
+    engine = BlockCompiler(cpu)
+    engine.run(max_instructions=2)
+    assert cpu.reg.a == 1
+    assert 0 in engine.blocks
+    cpu.ram.set(0x0000, 0x8801) # SET A, 2
+    assert 0 not in engine.blocks
+    engine.run(max_instructions=2)
+    assert cpu.reg.a == 2
+    assert cpu.cycle == 6
+
+def test_close_removes_hooks():
+    cpu = machine(EXAMPLE)
+    engine = BlockCompiler(cpu)
+    engine.run(max_cycles=100)
+    assert cpu.ram.write_hooks
+    engine.close()
+    assert not engine.blocks
+    assert not cpu.ram.write_hooks
@@ -0,0 +1,105 @@
+import dcpu
+from dcpu import Opcode
+from dcpu_debug import Access, Debugger, Hit
+import pytest
+
+from dcpu_testing import EXAMPLE, A, B, PC, literal, machine, op, state
+
+# IFE A, 1 skips SET B, 1 at 0x0001, then SET A, [0x0001] reads it
+SKIP = [op(Opcode.IFE, A, literal(1)), op(Opcode.SET, B, literal(1)),
+        op(Opcode.SET, A, 0x1e), 0x0001, op(Opcode.SET, PC, literal(4))]
+
+def test_matches_run():
+    reference = machine(EXAMPLE)
+    reference_result = reference.run(max_cycles=302)
+    cpu = machine(EXAMPLE)
+    assert Debugger(cpu).run(max_cycles=302) == reference_result
+    assert state(cpu) == state(reference)
+
+def test_run_without_limits_returns_on_halt():
+    reference = machine(EXAMPLE)
+    cpu = machine(EXAMPLE)
+    reference_result = reference.run()
+    assert reference_result.reason == dcpu.StopReason.HALTED
+    assert Debugger(cpu).run() == reference_result
+    assert state(cpu) == state(reference)
+
+def test_read_hooks_see_fetches():
+    reads = []
+    for run in (lambda cpu: cpu.run, lambda cpu: Debugger(cpu).run):
+        cpu = machine(SKIP)
+        seen = []
+        cpu.ram.add_read_hook(seen.append, 0, 8)
+        run(cpu)(max_instructions=2)
+        reads.append(seen)
+    assert reads[0] == reads[1] == [0x0000, 0x0001, 0x0002, 0x0003, 0x0001]
+
+def test_breakpoints():
+    cpu = machine(EXAMPLE)
+    debugger = Debugger(cpu)
+    debugger.add_breakpoint(0x000d)
+    assert debugger.run().reason == dcpu.StopReason.BREAKPOINT
+    assert debugger.hits == [Hit(0x000d, 0x2161, Access.EXECUTE, 0x000d, 0x2161)]
+    assert cpu.reg.i == 10
+    result = debugger.run()
+    assert result == (4, 8, dcpu.StopReason.BREAKPOINT)
+    assert cpu.reg.i == 9
+    debugger.remove_breakpoint(0x000d)
+    assert debugger.run(max_cycles=1000).reason == dcpu.StopReason.MAX_CYCLES
+
+def test_breakpoint_at_start():
+    cpu = machine(EXAMPLE)
+    debugger = Debugger(cpu)
+    debugger.add_breakpoint(0x0000)
+    assert debugger.run() == (0, 0, dcpu.StopReason.BREAKPOINT)
+    assert debugger.run(max_instructions=1) == (1, 2, dcpu.StopReason.MAX_INSTRUCTIONS)
+    # moving back to the breakpoint is not resuming from it
+    cpu.reg.pc = 0
+    assert debugger.run().reason == dcpu.StopReason.BREAKPOINT
+
+def test_write_watchpoint():
+    cpu = machine(EXAMPLE)
+    debugger = Debugger(cpu)
+    debugger.watch(0x1000)
+    assert debugger.run() == (2, 5, dcpu.StopReason.WATCHPOINT)
+    assert debugger.hits == [Hit(0x0002, 0x7de1, Access.WRITE, 0x1000, 0x0020)]
+    assert cpu.reg.pc == 0x0005
+    debugger.unwatch(0x1000)
+    assert not cpu.ram.write_hooks
+
+def test_read_watchpoint():
+    cpu = machine(EXAMPLE)
+    debugger = Debugger(cpu)
+    debugger.watch(0x1000, access=Access.READ)
+    assert debugger.run().reason == dcpu.StopReason.WATCHPOINT
+    assert debugger.hits == [Hit(0x0005, 0x7803, Access.READ, 0x1000, 0x0020)]
+    assert cpu.reg.a == 0x0010
+    debugger.watch(0x2000, 0x2010)
+    assert debugger.run().reason == dcpu.StopReason.WATCHPOINT
+    assert debugger.hits == [Hit(0x000d, 0x2161, Access.WRITE, 0x200a, 0x0000)]
+    debugger.close()
+    assert not cpu.ram.read_hooks and not cpu.ram.write_hooks
+    assert cpu.ram.peek == cpu.ram.contents.__getitem__
+
+def test_read_watchpoint_on_next_word():
+    # SET [0x0001], 5 reads its next word at 0x0001, then its destination
+    cpu = machine([0x95e1, 0x0001, 0x81c1])
+    debugger = Debugger(cpu)
+    debugger.watch(0x0001, access=Access.READ)
+    assert debugger.run().reason == dcpu.StopReason.WATCHPOINT
+    assert debugger.hits == [Hit(0x0000, 0x95e1, Access.READ, 0x0001, 0x0001)]
+    assert cpu.ram.get(0x0001) == 5
+
+def test_read_watchpoint_on_skipped_instruction():
+    cpu = machine(SKIP)
+    debugger = Debugger(cpu)
+    debugger.watch(0x0001, access=Access.READ)
+    assert debugger.run() == (2, 5, dcpu.StopReason.WATCHPOINT)
+    assert debugger.hits == [Hit(0x0002, SKIP[2], Access.READ, 0x0001, SKIP[1])]
+    assert cpu.reg.b == 0
+
+def test_execute_watchpoints_are_refused():
+    debugger = Debugger(machine(EXAMPLE))
+    with pytest.raises(ValueError):
+        debugger.watch(0x0000, access=Access.EXECUTE)
+    assert not debugger.watchpoints
@@ -0,0 +1,132 @@
+import dcpu
+from dcpu_compiler import BlockCompiler
+from dcpu_devices import Device, DeviceBus, Display, Keyboard, Timer
+from dcpu_fusion import Fuser
+
+from dcpu_testing import machine, state
+
+LOOP = [0x81c1] # SET PC, 0
+
+def test_display():
+    # SET [0x8000], 'H'; SET [0x8021], 'i'
+    cpu = machine([0x7de1, 0x8000, 0x0048, 0x7de1, 0x8021, 0x0069] + LOOP)
+    bus = DeviceBus(cpu)
+    display = bus.attach(Display())
+    bus.run(max_instructions=2)
+    assert display.dirty == {0, 1}
+    assert display.text()[:2] == ['H', ' i']
+    cpu.ram.set(0x7fff, 1)
+    cpu.ram.set(0x8180, 1)
+    assert display.dirty == {0, 1}
+
+def test_keyboard():
+    # loop: IFE [0x9000], 0; SET PC, loop; SET A, [0x9000]; SET [0x9000], 0
+    cpu = machine([0x81ec, 0x9000, 0x81c1, 0x7801, 0x9000, 0x81e1, 0x9000] + [0x0000])
+    bus = DeviceBus(cpu)
+    keyboard = bus.attach(Keyboard(size=1))
+    keyboard.press(ord('a'))
+    keyboard.press(ord('b'))
+    assert cpu.ram.get(0x9000) == ord('a')
+    bus.run(until_pc=0x0007)
+    assert cpu.reg.a == ord('a')
+    assert cpu.ram.get(0x9000) == ord('b')
+    assert not keyboard.pending
+
+def test_timer():
+    cpu = machine(LOOP)
+    bus = DeviceBus(cpu)
+    timer = bus.attach(Timer(period=100))
+    assert bus.run(max_cycles=1000) == (1000, 1000, dcpu.StopReason.MAX_CYCLES)
+    assert cpu.ram.get(0x9010) == 10
+    cpu.ram.set(0x9011, 0)
+    bus.run(max_cycles=1000)
+    assert cpu.ram.get(0x9010) == 10
+    assert bus.next_event() is None
+    bus.detach(timer)
+    assert not cpu.ram.write_hooks
+
+def test_program_sets_period_on_compiled_engine():
+    # SET [0x9011], 10; loop: SET PC, loop
+    contents = [0xa9e1, 0x9011, 0x89c1]
+    # the period is written at cycle 3, so ticks are due at 13, 23, ...
+    for cycles, ticks in ((1000, 99), (1003, 100)):
+        results = []
+        for engine in (None, BlockCompiler):
+            cpu = machine(contents)
+            bus = DeviceBus(cpu, engine(cpu) if engine else None)
+            bus.attach(Timer())
+            bus.run(max_cycles=cycles)
+            results.append((state(cpu), bus.next_event()))
+        assert results[0] == results[1]
+        assert results[0][0][2][0x9010] == ticks
+
+def test_read_callbacks():
+    class Clock(Device):
+        reads = True
+        def read(self, pos):
+            self.ram.contents[pos] = self.bus.cpu.cycle
+    # SET A, 1; SET B, [0x9100]
+    cpu = machine([0x8401, 0x7811, 0x9100])
+    bus = DeviceBus(cpu)
+    bus.attach(Clock(0x9100, 1))
+    bus.run(max_instructions=2)
+    assert cpu.reg.b == 3
+    bus.close()
+    assert not cpu.ram.read_hooks and not cpu.ram.write_hooks
+    assert cpu.ram.peek == cpu.ram.contents.__getitem__
+
+def test_unmapped_accesses_skip_the_notify_path():
+    class Clock(Device):
+        reads = True
+    # loop: SET [0x1000], 1; SET A, [0x1000]; SET [0x8000], A; SET PC, loop
+    contents = [0x85e1, 0x1000, 0x7801, 0x1000, 0x01e1, 0x8000, 0x81c1]
+    for engine in (None, BlockCompiler, Fuser):
+        cpu = machine(contents)
+        bus = DeviceBus(cpu, engine(cpu) if engine else None)
+        bus.attach(Display())
+        bus.attach(Clock(0x9100, 1))
+        ram = cpu.ram
+        assert [page for page, hooked in enumerate(ram.write_pages) if hooked] == [0x80, 0x81, 0x91]
+        assert [page for page, hooked in enumerate(ram.read_pages) if hooked] == [0x91]
+        notified = []
+        ram.peek_and_notify = lambda pos: notified.append(pos) or ram.read(pos)
+        ram.poke_and_notify = lambda pos, value: notified.append(pos) or ram.write(pos, value)
+        bus.run(max_instructions=400)
+        assert notified == [0x8000] * 100
+        assert ram.get(0x1000) == 1 and ram.get(0x8000) == 1
+
+def test_events():
+    cpu = machine(LOOP)
+    bus = DeviceBus(cpu)
+    fired = []
+    bus.schedule(10, lambda: fired.append(cpu.cycle))
+    cancelled = bus.schedule(5, lambda: fired.append(None))
+    bus.schedule_in(20, lambda: fired.append(cpu.cycle))
+    bus.cancel(cancelled)
+    assert bus.next_event() == 10
+    bus.run(max_cycles=15)
+    assert fired == [10]
+    assert bus.run(until_pc=0x0000) == (0, 0, dcpu.StopReason.UNTIL_PC)
+    bus.run(max_cycles=15)
+    assert fired == [10, 20]
+
+def test_busy_wait_fast_forwards_to_events():
+    # loop: IFE [0x9010], 0; SET PC, loop; SET A, [0x9010]; halt: SET PC, halt
+    contents = [0x81ec, 0x9010, 0x81c1, 0x7801, 0x9010, 0x95c1]
+    results = []
+    for engine in (None, BlockCompiler):
+        for stop in (None, lambda cpu: False): # stop turns the fast-forward off
+            cpu = machine(contents)
+            bus = DeviceBus(cpu, engine(cpu) if engine else None)
+            bus.attach(Timer(period=50000))
+            result = bus.run(max_cycles=250000, stop=stop)
+            results.append((result, state(cpu)))
+    assert all(result == results[0] for result in results)
+    assert results[0][1][0][0] == 1
+    assert results[0][1][2][0x9010] == 5
+
+def test_run_without_limits_returns_on_halt():
+    cpu = machine(LOOP)
+    bus = DeviceBus(cpu)
+    bus.attach(Display())
+    assert bus.run().reason is dcpu.StopReason.HALTED
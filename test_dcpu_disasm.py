@@ -0,0 +1,90 @@
+import random
+
+import dcpu
+import pytest
+
+pytest.importorskip('numpy')
+from dcpu_disasm import ControlFlowGraph, Exit, disassemble, listing
+
+from dcpu_testing import EXAMPLE, machine, random_program
+
+def test_disassemble():
+    lines = disassemble(EXAMPLE)
+    assert [line.address for line in lines[:4]] == [0x00, 0x02, 0x05, 0x07]
+    assert lines[1].words == (0x7de1, 0x1000, 0x0020)
+    texts = [line.text for line in lines]
+    assert texts[:4] == ['SET A, 0x0030', 'SET [0x1000], 0x0020', 'SUB A, [0x1000]', 'IFN A, 0x10']
+    assert 'SET [0x2000+I], [A]' in texts
+    assert 'JSR 0x0018' in texts
+    assert 'SET PC, POP' in texts
+    assert listing(EXAMPLE, 0x18, 0x1a) == '0018: 9037             SHL X, 0x04\n0019: 61c1             SET PC, POP'
+
+def test_disassemble_edges():
+    # an invalid word, then an instruction cut off by stop
+    assert [line.text for line in disassemble([0x0000, 0x7c01, 0x0030], 0, 2)] == ['DAT 0x0000', 'DAT 0x7c01']
+    ram = dcpu.RAM(word_length=16, size=0x10000, initial_contents=EXAMPLE)
+    lines = disassemble(ram.contents)
+    assert lines[-1].address == 0xffff
+    assert sum(len(line.words) for line in lines) == 0x10000
+
+def test_graph():
+    cpu = machine(EXAMPLE)
+    graph = ControlFlowGraph(cpu.ram)
+    assert sorted(graph.blocks) == [0x00, 0x08, 0x0a, 0x0d, 0x11, 0x13, 0x16, 0x18, 0x1a]
+    assert graph.block(0x07).exit == Exit.CONDITION
+    assert graph.successors(0x00) == (0x08, 0x0a)
+    assert graph.block(0x13).exit == Exit.CALL
+    assert graph.block(0x13).successors == (0x16,)
+    assert graph.functions() == [0x18]
+    assert graph.block(0x18).exit == Exit.RETURN
+    assert graph.block(0x0a).exit == Exit.FALLTHROUGH
+    assert graph.block(0x1a).successors == (0x1a,)
+    assert graph.regions() == [(0x00, 0x1c)]
+
+def test_split():
+    graph = ControlFlowGraph(machine(EXAMPLE).ram)
+    graph.add_entry(0x0b)
+    assert graph.block(0x0a).addresses == (0x0a,)
+    assert graph.block(0x0a).successors == (0x0b,)
+    assert graph.block(0x0b).successors == (0x0d,)
+
+def test_incremental_update():
+    cpu = machine(EXAMPLE)
+    graph = ControlFlowGraph(cpu.ram)
+    before = dict(graph.blocks)
+    # SET PC, 0x001a -> SET PC, 0x0020 at 0x16
+    cpu.ram.set(0x17, 0x0020)
+    assert graph.successors(0x16) == (0x20,)
+    assert graph.block(0x20) is not None
+    for start, block in before.items():
+        if start != 0x16:
+            assert graph.blocks[start] is block
+
+    # turning the conditional jump at 0x11 into an ADD makes the loop fall through
+    cpu.ram.set(0x11, 0x7c02) # ADD A, 0x000d
+    assert graph.block(0x11).exit == Exit.FALLTHROUGH
+    assert graph.successors(0x11) == (0x13,)
+
+    # the instruction an IFx skips decides where the skip lands
+    cpu.ram.set(0x08, 0x81c1) # SET PC, 0 is one word shorter
+    assert graph.successors(0x00) == (0x08, 0x09)
+
+def test_incremental_matches_fresh():
+    rng = random.Random(7)
+    for _ in range(20):
+        program = random_program(rng, 64)
+        cpu = machine(program)
+        graph = ControlFlowGraph(cpu.ram)
+        for _ in range(10):
+            cpu.ram.set(rng.randrange(64), rng.randrange(0x10000))
+            fresh = ControlFlowGraph(cpu.ram.copy())
+            graph.update()
+            for start, block in fresh.blocks.items():
+                ours = graph.block(start)
+                assert ours.start == start
+                assert ours.addresses == block.addresses
+                assert ours.exit == block.exit
+                assert ours.successors == block.successors
+            assert graph.blocks == fresh.blocks
+        graph.close()
+        assert not cpu.ram.write_hooks
@@ -0,0 +1,53 @@
+import random
+
+import dcpu
+from dcpu_farm import Job, run_jobs, run_serialized, serialize_job
+import pytest
+
+from dcpu_testing import EXAMPLE, machine, random_program, state
+
+def test_matches_run():
+    rng = random.Random(7)
+    jobs = []
+    for _ in range(40):
+        registers = {reg: rng.randrange(0x10000) for reg in dcpu.DCPURegisterBank.all_regs}
+        registers['pc'] = 0
+        jobs.append(Job(random_program(rng), registers))
+    jobs.append(Job(EXAMPLE, max_cycles=302))
+
+    results = list(run_jobs(jobs, max_cycles=500, workers=2, chunk_size=4))
+    assert sorted(result.index for result in results) == list(range(len(jobs)))
+    for result in results:
+        job = jobs[result.index]
+        reference = machine(job.image, job.registers)
+        try:
+            reference.run(max_cycles=job.max_cycles or 500)
+        except ValueError:
+            assert result.reason is None and result.error
+        else:
+            assert result.reason == dcpu.StopReason.MAX_CYCLES
+        assert state(result.cpu()) == state(reference)
+
+def test_example_result():
+    result, = run_jobs([(EXAMPLE,)], max_cycles=302, workers=1)
+    assert result.registers['x'] == 0x0040
+    assert result.registers['pc'] == 0x001a
+    assert result.cycle == 302
+    assert result.ram[0x2001] == 0
+
+def test_timeout():
+    loop = [0x7dc1, 0x0000] # SET PC, 0
+    index, registers, cycle, ram, reason, error = run_serialized(
+        serialize_job(0, Job(loop), None), timeout=0.05, slice_cycles=1000)
+    assert reason == dcpu.StopReason.TIMEOUT
+    assert cycle > 0 and cycle % 1000 == 0
+
+def test_requires_a_limit():
+    with pytest.raises(ValueError):
+        list(run_jobs([(EXAMPLE,)]))
+
+def test_rejects_images_larger_than_ram():
+    with pytest.raises(ValueError):
+        run_serialized(serialize_job(0, Job([0] * 0x10001), 1000))
+    result = run_serialized(serialize_job(0, Job([0x7dc1, 0x0000] + [0] * 0xfffe), 1000))
+    assert result[4] == dcpu.StopReason.MAX_CYCLES
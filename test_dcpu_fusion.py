@@ -0,0 +1,106 @@
+import random
+
+import dcpu
+from dcpu import Opcode
+from dcpu_fusion import Fuser
+import pytest
+
+from dcpu_testing import (EXAMPLE, MEMCPY, RECURSION, A, B, I, POP, PUSH, PC, NEXT, literal, op,
+                          machine, random_program, random_registers, state, stepped)
+
+def test_patterns():
+    contents = [op(Opcode.IFE, A, literal(1)), op(Opcode.SET, PC, NEXT), 0x1234,  # 0
+                op(Opcode.ADD, I, literal(1)), op(Opcode.IFN, I, NEXT), 0x0010,   # 3
+                op(Opcode.SET, PC, literal(3)),
+                op(Opcode.SET, PUSH, A), op(Opcode.SET, PUSH, NEXT), 0x5555,      # 7
+                op(Opcode.SET, B, POP), op(Opcode.SET, A, POP),                   # 10
+                op(Opcode.SET, A, B)]                                             # 12
+    fuser = Fuser(machine(contents))
+    assert (fuser.fuse(0).length, fuser.fuse(0).end) == (2, 3)
+    assert (fuser.fuse(3).length, fuser.fuse(3).end) == (3, 7)
+    assert (fuser.fuse(7).length, fuser.fuse(7).end) == (2, 10)
+    assert (fuser.fuse(10).length, fuser.fuse(10).end) == (2, 12)
+    assert fuser.fuse(12) is None
+    assert fuser.fuse(4) is not None  # IFN I, 0x10; SET PC, 3
+
+    fuser = Fuser(machine([op(Opcode.IFE, A, literal(0)), op(Opcode.SET, PC, POP)]))
+    assert fuser.fuse(0).length == 2
+
+def test_match_without_fuse():
+    fuser = Fuser(machine([op(Opcode.SET, PUSH, A), op(Opcode.SET, PUSH, NEXT), 0x5555]))
+    assert fuser.fetch(0)[2] == 1
+    assert fuser.match(0).end == 3
+    assert not fuser.fused
+
+def test_branch_skips_next_words():
+    # IFE A, 1; SET PC, 0x1234; SET B, 2
+    contents = [op(Opcode.IFE, A, literal(1)), op(Opcode.SET, PC, NEXT), 0x1234, op(Opcode.SET, B, literal(2))]
+    cpu = machine(contents)
+    assert Fuser(cpu).run(max_instructions=2) == (2, 2 + 1 + 1, dcpu.StopReason.MAX_INSTRUCTIONS)
+    assert cpu.reg.pc == 4 and cpu.reg.b == 2
+    cpu = machine(contents, dict(a=1, b=0, c=0, x=0, y=0, z=0, i=0, j=0, pc=0, sp=0, o=0))
+    assert Fuser(cpu).run(max_instructions=2) == (2, 2 + 2, dcpu.StopReason.MAX_INSTRUCTIONS)
+    assert cpu.reg.pc == 0x1234
+
+@pytest.mark.parametrize('words', [EXAMPLE, MEMCPY, RECURSION])
+def test_matches_step(words):
+    for instructions in (1, 2, 3, 50, 51, 400):
+        reference = stepped(words, instructions=instructions)
+        cpu = machine(words)
+        assert Fuser(cpu).run(max_instructions=instructions).instructions == instructions
+        assert state(cpu) == state(reference)
+    for cycles in (1, 2, 3, 4, 5, 97, 98, 99, 1000):
+        reference = stepped(words, cycles=cycles)
+        cpu = machine(words)
+        Fuser(cpu).run(max_cycles=cycles)
+        assert state(cpu) == state(reference)
+
+@pytest.mark.parametrize('seed', range(100))
+def test_matches_step_random(seed):
+    rng = random.Random(seed)
+    program = random_program(rng)
+    registers = random_registers(rng)
+    reference = machine(program, registers)
+    cpu = machine(program, registers)
+    fuser = Fuser(cpu)
+    for _ in range(300):
+        try:
+            reference.step()
+        except ValueError:
+            with pytest.raises(ValueError):
+                fuser.run(max_instructions=300)
+            return
+    assert fuser.run(max_instructions=300).instructions == 300
+    assert state(cpu) == state(reference)
+
+def test_push_overwriting_itself():
+    # SP points just past the second push, which the first push overwrites
+    # with SET A, 7 before it can run
+    contents = [op(Opcode.SET, PUSH, NEXT), op(Opcode.SET, A, literal(7)), op(Opcode.SET, PUSH, B)]
+    registers = dict(a=0, b=0, c=0, x=0, y=0, z=0, i=0, j=0, pc=0, sp=3, o=0)
+    reference = stepped(contents, registers, instructions=2)
+    cpu = machine(contents, registers)
+    fuser = Fuser(cpu)
+    assert fuser.fuse(0).length == 2
+    assert fuser.run(max_instructions=2).instructions == 2
+    assert state(cpu) == state(reference)
+    assert cpu.reg.a == 7
+
+def test_writes_invalidate():
+    cpu = machine([op(Opcode.IFE, A, literal(0)), op(Opcode.SET, PC, literal(5))])
+    fuser = Fuser(cpu)
+    assert fuser.fuse(0) is not None
+    cpu.ram.set(1, op(Opcode.SET, B, literal(5)))
+    assert 0 not in fuser.fused
+    assert fuser.fuse(0) is None
+    fuser.close()
+    assert not cpu.ram.write_hooks
+
+def test_run_until_pc_and_stop():
+    reference = machine(MEMCPY)
+    reference_result = reference.run(until_pc=5, max_cycles=5000)
+    cpu = machine(MEMCPY)
+    assert Fuser(cpu).run(until_pc=5, max_cycles=5000) == reference_result
+    assert state(cpu) == state(reference)
+    assert Fuser(cpu).run(stop=lambda cpu: cpu.cycle > 100) == reference.run(stop=lambda cpu: cpu.cycle > 100)
+    assert state(cpu) == state(reference)
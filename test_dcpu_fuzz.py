@@ -0,0 +1,81 @@
+import dcpu
+from dcpu import Opcode
+from dcpu_fuzz import LOCATIONS, Fuzzer
+from dcpu_paged import PagedRAM
+
+from dcpu_testing import MEMCPY, NEXT, PC, literal, op, machine, state
+
+# crashes on the invalid word at 10 only for input 3, 0xffff, 0x10; every
+# other input ends up halted at 11
+NESTED = [op(Opcode.IFN, 0x1e, literal(3)), 0x1000, op(Opcode.SET, PC, literal(11)),
+          op(Opcode.IFN, 0x1e, NEXT), 0x1001, 0xffff, op(Opcode.SET, PC, literal(11)),
+          op(Opcode.IFN, 0x1e, literal(0x10)), 0x1002, op(Opcode.SET, PC, literal(11)),
+          0x0000,
+          op(Opcode.SET, PC, literal(11))]
+
+def edge(previous, pc):
+    return LOCATIONS[pc] ^ (LOCATIONS[previous] >> 1 if previous is not None else 0)
+
+def test_edges():
+    fuzzer = Fuzzer(machine(NESTED), 0x1000, 0x1004)
+    # the all-zero region is the first input: 0, 2, then halted at 11
+    assert fuzzer.corpus == [dcpu.array('H', [0] * 4)]
+    assert fuzzer.edges == 3
+    assert {index for index, bits in enumerate(fuzzer.seen) if bits} == {edge(None, 0), edge(0, 2), edge(2, 11)}
+    assert fuzzer.execute([0] * 4) == (dcpu.RunResult(3, 3 + 1 + 1, dcpu.StopReason.HALTED), 0, None)
+
+    # the IFN skip is an edge of its own
+    outcome = fuzzer.add([3])
+    assert outcome.new == 3
+    assert fuzzer.seen[edge(0, 3)] and fuzzer.seen[edge(3, 6)] and fuzzer.seen[edge(6, 11)]
+    assert len(fuzzer.corpus) == 2
+
+    outcome = fuzzer.add([3, 0xffff, 0x10])
+    assert outcome.result is None and outcome.error == 'invalid instruction 0x0000 at 0x000a'
+    assert list(fuzzer.crashes) == [0x000a]
+
+def test_hit_buckets():
+    # SET I, n; loop: SUB I, 1; IFN I, 0; SET PC, loop; then halt
+    program = [op(Opcode.SET, 6, 0x1e), 0x1000, op(Opcode.SUB, 6, literal(1)),
+               op(Opcode.IFN, 6, literal(0)), op(Opcode.SET, PC, literal(2)), op(Opcode.SET, PC, literal(5))]
+    fuzzer = Fuzzer(machine(program + [0] * (0x1000 - len(program)) + [1]), 0x1000, 0x1001)
+    assert fuzzer.add([1]).new == 0
+    assert fuzzer.add([2]).new == 3    # 3 -> 4 and 4 -> 2 are taken once
+    assert fuzzer.add([3]).new == 3    # and twice
+    assert fuzzer.add([4]).new == 3    # 2 -> 3 taken 4 times joins 4-7
+    assert fuzzer.add([5]).new == 2
+    assert fuzzer.add([7]).new == 0
+    assert fuzzer.add([8]).new == 1
+    assert len(fuzzer.corpus) == 6
+    assert not any(fuzzer.trace)
+
+def test_matches_run():
+    reference = machine(MEMCPY)
+    # without fast-forwarding
+    reference_result = reference.run(max_cycles=1000, stop=lambda cpu: False)
+    cpu = machine(MEMCPY)
+    fuzzer = Fuzzer(cpu, 0x8000, 0x8010, max_cycles=1000)
+    assert fuzzer.execute(reference.ram.contents[0x8000:0x8010]).result == reference_result
+    assert state(cpu) == state(reference)
+
+def test_paged_ram():
+    results = []
+    for ram in (dcpu.RAM(16, 0x10000, NESTED), PagedRAM.from_image(16, 0x10000, NESTED)):
+        cpu = dcpu.CPU(initial_ram=ram)
+        written = []
+        ram.add_write_hook(lambda start, stop: written.append((start, stop)), 0x1000, 0x1004)
+        fuzzer = Fuzzer(cpu, 0x1000, 0x1004, max_cycles=100, seed=1)
+        fuzzer.fuzz(200)
+        assert written[0] == (0x1000, 0x1004)
+        results.append((fuzzer.edges, fuzzer.corpus, fuzzer.crashes, state(cpu)))
+    assert results[0] == results[1]
+
+def test_finds_crash():
+    cpu = machine(NESTED)
+    fuzzer = Fuzzer(cpu, 0x1000, 0x1004, max_cycles=100, seed=1)
+    assert fuzzer.fuzz(5000) >= 2
+    assert fuzzer.executions == 5001
+    assert list(fuzzer.crashes[0x000a][:3]) == [3, 0xffff, 0x10]
+    assert all(0 < len(words) <= 4 for words in fuzzer.corpus)
+    # runs start from the snapshot every time
+    assert fuzzer.execute([]).result.cycles == 5
@@ -0,0 +1,73 @@
+import mmap
+import pickle
+import sys
+
+import dcpu
+from dcpu_image import (flush, image_ram, load_image, mapped_ram, save_image,
+                        words_from_bytes, words_to_bytes)
+import pytest
+
+from dcpu_testing import EXAMPLE, machine, state
+
+def test_byte_orders():
+    assert words_to_bytes([0x1234, 0xabcd]) == b'\x12\x34\xab\xcd'
+    assert words_to_bytes([0x1234, 0xabcd], 'little') == b'\x34\x12\xcd\xab'
+    assert list(words_from_bytes(b'\x12\x34\xab\xcd')) == [0x1234, 0xabcd]
+    assert list(words_from_bytes(b'\x34\x12\xcd\xab', 'little')) == [0x1234, 0xabcd]
+
+@pytest.mark.parametrize('byteorder', ['big', 'little'])
+def test_save_load(tmp_path, byteorder):
+    path = tmp_path / 'example.bin'
+    save_image(path, EXAMPLE, byteorder)
+    assert path.stat().st_size == 2 * len(EXAMPLE)
+    assert list(load_image(path, byteorder)) == EXAMPLE
+    save_image(path, EXAMPLE, byteorder, size=0x100)
+    assert len(load_image(path, byteorder)) == 0x100
+
+def test_image_ram():
+    words = words_from_bytes(words_to_bytes(EXAMPLE))
+    cpu = dcpu.CPU(initial_ram=image_ram(words))
+    cpu.run(max_cycles=302)
+    reference = machine(EXAMPLE)
+    reference.run(max_cycles=302)
+    assert state(cpu) == state(reference)
+    assert list(words) == EXAMPLE
+
+def test_mapped_ram(tmp_path):
+    path = tmp_path / 'example.bin'
+    save_image(path, EXAMPLE, byteorder=sys.byteorder)
+    with pytest.raises(ValueError):
+        mapped_ram(path)
+
+    ram = mapped_ram(path, access=mmap.ACCESS_WRITE)
+    assert ram.size == 0x10000
+    cpu = dcpu.CPU(initial_ram=ram)
+    cpu.run(max_cycles=302)
+    reference = machine(EXAMPLE)
+    reference.run(max_cycles=302)
+    assert state(cpu) == state(reference)
+    flush(ram)
+    assert list(load_image(path, sys.byteorder)) == list(reference.ram.contents)
+
+    private = mapped_ram(path)
+    private.set(0x1000, 0x5555)
+    assert load_image(path, sys.byteorder)[0x1000] == 0x0020
+
+    shared = mapped_ram(path, access=mmap.ACCESS_READ)
+    assert shared.get(0x1000) == 0x0020
+    with pytest.raises(TypeError):
+        shared.set(0x1000, 0)
+
+def test_mapped_ram_copies(tmp_path):
+    path = tmp_path / 'example.bin'
+    save_image(path, EXAMPLE, byteorder=sys.byteorder, size=0x10000)
+    ram = mapped_ram(path)
+    ram.set(0x10, 0x1234)
+    snap = ram.snapshot()
+    ram.set(0x10, 0)
+    ram.restore(snap)
+    assert ram.get(0x10) == 0x1234
+    for clone in (ram.copy(), pickle.loads(pickle.dumps(ram))):
+        assert list(clone.contents) == list(ram.contents)
+        clone.set(0x10, 0)
+        assert ram.get(0x10) == 0x1234
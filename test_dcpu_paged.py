@@ -0,0 +1,96 @@
+import pickle
+
+import dcpu
+from dcpu_paged import PagedRAM
+import pytest
+
+from dcpu_testing import EXAMPLE, MEMCPY, state
+
+def test_matches_ram():
+    for words in (EXAMPLE, MEMCPY):
+        reference = dcpu.CPU(initial_ram=dcpu.RAM(word_length=16, size=0x10000, initial_contents=words))
+        reference.run(max_cycles=20000)
+        cpu = dcpu.CPU(initial_ram=PagedRAM(16, 0x10000, words))
+        cpu.run(max_cycles=20000)
+        assert state(cpu) == state(reference)
+        assert cpu.ram.snapshot() == reference.ram.snapshot()
+    cpu = dcpu.CPU(initial_ram=PagedRAM(16, 0x10000, EXAMPLE))
+    assert cpu.run().reason == dcpu.StopReason.HALTED
+
+def test_set_get():
+    ram = PagedRAM(16, 0x10000)
+    assert ram.size == 0x10000 and ram.resident_pages() == 0
+    ram.set(0x1234, 0x1ffff)
+    assert ram.get(0x1234) == 0xffff
+    assert ram.contents[0x1234] == 0xffff
+    assert ram.resident_pages() == 1
+    ram.set(0x1235, -1)
+    assert ram.resident_pages() == 1
+    with pytest.raises(IndexError):
+        ram.set(0xffffffff, 0)
+    with pytest.raises(IndexError):
+        ram.get(0x10000)
+
+    assert PagedRAM(8, 0x1000).size == 0x1000
+    ram = PagedRAM(8, 0x1001)
+    ram.set(0x1000, 0x1ff)
+    assert ram.get(0x1000) == 0xff and len(ram.contents) == 0x1001
+    ram = PagedRAM(100, 0x20000)
+    ram.set(0x1ffff, 2**99)
+    assert ram.get(0x1ffff) == 2**99 and ram.size == 0x20000
+    assert ram.snapshot()[0x1ffff] == 2**99
+
+def test_copies_share_pages():
+    rom = PagedRAM.from_image(16, 0x10000, EXAMPLE)
+    assert rom.resident_pages() == 0
+    machines = [dcpu.CPU(initial_ram=rom.copy()) for _ in range(100)]
+    for cpu in machines:
+        cpu.run(max_cycles=302)
+    # the example writes to 0x1000, 0x2000 and its stack at the top of memory
+    assert all(cpu.ram.resident_pages() == 3 for cpu in machines)
+    assert machines[0].ram.pages[0] is machines[1].ram.pages[0] is rom.pages[0]
+    assert rom.get(0x1000) == 0 and machines[0].ram.get(0x1000) == 0x20
+
+    fork = machines[0].fork()
+    fork.ram.set(0x1000, 7)
+    assert machines[0].ram.get(0x1000) == 0x20
+    machines[0].ram.set(0x2000, 8)
+    assert fork.ram.get(0x2000) != 8
+
+def test_contents():
+    ram = PagedRAM(16, 0x10000, EXAMPLE)
+    contents = ram.contents
+    assert len(contents) == 0x10000
+    assert list(contents[0:4]) == EXAMPLE[:4]
+    contents[0x0ff:0x102] = [1, 2, 3]
+    assert [ram.get(address) for address in range(0x0ff, 0x102)] == [1, 2, 3]
+    assert contents.tobytes() == ram.snapshot().tobytes()
+    with pytest.raises(TypeError):
+        ram.view
+
+def test_hooks_and_restore():
+    ram = PagedRAM(16, 0x10000)
+    writes, reads = [], []
+    ram.add_write_hook(lambda start, stop: writes.append(start), 0x8000, 0x8100)
+    ram.add_read_hook(reads.append, 0x8000, 0x8100)
+    ram.set(0x8001, 5)
+    assert ram.peek(0x8001) == 5
+    assert writes == [0x8001] and reads == [0x8001]
+
+    snapshot = ram.snapshot()
+    copy = ram.copy()
+    ram.set(0x8002, 6)
+    ram.set(0x0000, 1)
+    writes.clear()
+    ram.restore(snapshot)
+    assert writes == [0x8000]
+    assert ram.get(0x8002) == 0 and ram.get(0) == 0
+    # restoring the original words left the untouched pages shared
+    assert ram.pages[0x10] is copy.pages[0x10]
+
+def test_pickle():
+    ram = PagedRAM(16, 0x10000, EXAMPLE)
+    ram.add_write_hook(lambda start, stop: None)
+    copy = pickle.loads(pickle.dumps(ram))
+    assert copy.snapshot() == ram.snapshot()
+    assert not copy.write_hooks
@@ -0,0 +1,44 @@
+from dcpu import Operand, StopReason
+from dcpu_profile import Profiler
+
+from dcpu_testing import EXAMPLE, machine, state, stepped
+
+def test_matches_run():
+    reference = machine(EXAMPLE)
+    reference_result = reference.run(max_cycles=302)
+    cpu = machine(EXAMPLE)
+    profiler = Profiler(cpu)
+    assert profiler.run(max_cycles=302) == reference_result
+    assert state(cpu) == state(reference)
+    assert sum(profiler.opcode_instructions) == reference_result.instructions
+    assert sum(profiler.opcode_cycles) == reference_result.cycles
+    assert sum(profiler.pc_cycles) == reference_result.cycles
+
+def test_run_without_limits_returns_on_halt():
+    cpu = machine(EXAMPLE)
+    profiler = Profiler(cpu)
+    result = profiler.run()
+    assert result.reason is StopReason.HALTED
+    assert cpu.is_halted()
+    assert state(cpu) == state(stepped(EXAMPLE, instructions=result.instructions))
+    assert sum(profiler.pc_cycles) == result.cycles
+    # with a limit the loop is stepped up to it
+    assert profiler.run(max_instructions=10) == (10, 20, StopReason.MAX_INSTRUCTIONS)
+
+def test_counters():
+    # SET I, 10; loop: SUB I, 1; IFN I, 0; SET PC, loop
+    cpu = machine([0xa861, 0x8463, 0x806d, 0x7dc1, 0x0001])
+    profiler = Profiler(cpu)
+    profiler.run(until_pc=0x0005)
+    flat = dict((name, (instructions, cycles)) for name, instructions, cycles in profiler.flat_profile())
+    assert flat == {'SET': (10, 1 + 9 * 2), 'SUB': (10, 20), 'IFN': (10, 20 + 1)}
+    assert profiler.hot_addresses(1) == [(0x0002, 10, 21)]
+    operands = dict((kind, instructions) for kind, instructions, cycles in profiler.operand_profile())
+    assert operands[Operand.NEXT_WORD_LITERAL] == 9
+    assert operands[Operand.REGISTER] == 21
+    assert operands[Operand.PC] == 9
+    assert 'IFN' in profiler.report()
+
+    profiler.reset()
+    assert not any(profiler.pc_cycles)
+    assert profiler.flat_profile() == []
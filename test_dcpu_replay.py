@@ -0,0 +1,105 @@
+import itertools
+
+from dcpu import StateHash, StopReason
+from dcpu_devices import Device, DeviceBus
+from dcpu_replay import Recorder
+
+from dcpu_testing import EXAMPLE, machine, state
+
+PROGRAM = [0x7802, 0x0100, 0x81c1] # loop: ADD A, [0x0100]; SET PC, loop
+
+def inject(cpu):
+    cpu.ram.set(0x0100, 3)
+    cpu.reg.b = 7
+
+def reference(cycle):
+    cpu = machine(PROGRAM)
+    cpu.run(max_cycles=min(cycle, 500))
+    if cycle >= 500:
+        inject(cpu)
+        cpu.run(max_cycles=cycle - 500)
+    return state(cpu)
+
+def recorded():
+    cpu = machine(PROGRAM)
+    recorder = Recorder(cpu, interval=64)
+    recorder.run(max_cycles=500)
+    inject(cpu)
+    recorder.run(max_cycles=500)
+    return cpu, recorder
+
+def test_seek():
+    cpu, recorder = recorded()
+    assert state(cpu) == reference(1000)
+    for cycle in (777, 0, 1, 499, 500, 501, 1000, 64, 128, 2000):
+        recorder.seek(cycle)
+        assert state(cpu) == reference(min(cycle, 1000))
+
+def test_reverse():
+    cpu, recorder = recorded()
+    assert recorder.reverse_step()
+    assert cpu.cycle == 999
+    assert state(cpu) == reference(999)
+    assert recorder.reverse_continue({0x0002})
+    assert cpu.cycle == 995 and cpu.reg.pc == 0x0002
+    assert state(cpu) == reference(995)
+    recorder.seek(130)
+    assert recorder.reverse_continue(bytearray([0, 0, 1]))
+    assert cpu.cycle == 127
+    recorder.seek(3)
+    assert recorder.reverse_step()
+    assert cpu.cycle == 0
+    assert not recorder.reverse_step()
+
+def test_run_after_seek_discards_future():
+    cpu, recorder = recorded()
+    recorder.seek(300)
+    recorder.run(max_cycles=300)
+    expected = machine(PROGRAM)
+    expected.run(max_cycles=600)
+    assert state(cpu) == state(expected)
+    assert recorder.end == 600
+    assert not recorder.inputs
+    recorder.seek(1000)
+    assert cpu.cycle == 600
+
+def test_device_reads():
+    source = itertools.count(100)
+    class Sensor(Device):
+        reads = True
+        def read(self, pos):
+            self.ram.contents[pos] = next(source)
+    cpu = machine([0x7802, 0x9000, 0x81c1]) # loop: ADD A, [0x9000]; SET PC, loop
+    bus = DeviceBus(cpu)
+    bus.attach(Sensor(0x9000, 1))
+    recorder = Recorder(cpu, bus, interval=50)
+    recorder.record_bus(bus)
+    states = {}
+    for _ in range(10):
+        recorder.run(max_cycles=40)
+        states[cpu.cycle] = state(cpu)
+    cpu.state_hash()
+    for cycle, expected in sorted(states.items(), reverse=True):
+        recorder.seek(cycle)
+        assert state(cpu) == expected
+        # replayed reads keep the hash current
+        fresh = StateHash(cpu.ram)
+        assert cpu.hasher.value == fresh.value
+        fresh.close()
+    cpu.hasher.close()
+    recorder.close()
+    bus.close()
+    assert not cpu.ram.write_hooks and not cpu.ram.read_hooks
+
+def test_run_without_limits_returns_on_busy_wait():
+    # ends in a SET PC, crash loop; then a loop waiting for [0x0100]
+    for program, pc in ((EXAMPLE, 0x001a), ([0x81ec, 0x0100, 0x81c1], 0x0000)):
+        cpu = machine(program)
+        recorder = Recorder(cpu, interval=1000)
+        assert recorder.run().reason is StopReason.HALTED
+        assert cpu.reg.pc == pc
+        assert len(recorder.checkpoints) < 10
+        cycle = cpu.cycle
+        recorder.seek(cycle // 2)
+        recorder.seek(cycle)
+        assert cpu.cycle == cycle and cpu.reg.pc == pc
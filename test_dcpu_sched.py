@@ -0,0 +1,124 @@
+from itertools import count
+
+import dcpu
+from dcpu import Opcode
+from dcpu_compiler import BlockCompiler
+from dcpu_devices import DeviceBus, Timer
+from dcpu_sched import MachineState, Scheduler
+
+from dcpu_testing import ARITHMETIC, EXAMPLE, A, PC, literal, op, machine, state
+
+# loop: IFE [address], 0; SET PC, loop; SET A, 1; halt: SET PC, halt
+def busy_wait(address):
+    return [op(Opcode.IFE, 0x1e, literal(0)), address, op(Opcode.SET, PC, literal(0)),
+            op(Opcode.SET, A, literal(1)), op(Opcode.SET, PC, literal(4))]
+
+def test_quotas():
+    scheduler = Scheduler(quota=1000)
+    small = scheduler.add(machine(ARITHMETIC))
+    large = scheduler.add(machine(ARITHMETIC), quota=3000)
+    compiled = machine(ARITHMETIC)
+    blocks = scheduler.add(compiled, BlockCompiler(compiled))
+    assert scheduler.run(ticks=10) == 10
+    assert scheduler.ticks == 10
+    # overshoot is taken off the next slice
+    for each, quota in ((small, 1000), (large, 3000), (blocks, 1000)):
+        assert each.cycles == each.cpu.cycle
+        assert quota * 10 <= each.cycles < quota * 10 + 4
+        assert each.slices == 10
+        assert each.state is MachineState.READY
+    reference = machine(ARITHMETIC)
+    reference.run(max_cycles=small.cycles)
+    assert state(small.cpu) == state(reference) == state(blocks.cpu)
+
+def test_parks_halted():
+    scheduler = Scheduler(quota=100)
+    done = scheduler.add(machine(EXAMPLE))
+    running = scheduler.add(machine(ARITHMETIC))
+    scheduler.run(ticks=10)
+    assert done.state is MachineState.PARKED and done.reason is dcpu.StopReason.HALTED
+    assert done.cpu.reg.pc == 0x1a
+    assert scheduler.parked() == [done] and scheduler.ready() == [running]
+    assert scheduler.queue == [running]
+    cycles = done.cycles
+    scheduler.run(ticks=10)
+    assert done.cycles == cycles
+
+    # any write to its RAM wakes it; SET A, 0x1f at the halt
+    done.cpu.ram.set(0x1a, op(Opcode.SET, A, literal(0x1f)))
+    assert done.state is MachineState.READY and done.wakeups == 1
+    assert not done.cpu.ram.write_hooks
+    scheduler.tick()
+    assert done.cpu.reg.a == 0x1f
+
+def test_parks_spinning():
+    # a 4-cycle loop with a quota it does not divide
+    cpu = machine(busy_wait(0x1000))
+    scheduler = Scheduler(quota=999)
+    waiting = scheduler.add(cpu)
+    assert scheduler.run(ticks=100) < 20
+    assert waiting.state is MachineState.PARKED
+    assert waiting.cycles == cpu.cycle
+    cpu.ram.set(0x1000, 1)
+    scheduler.run()
+    assert cpu.reg.a == 1 and cpu.reg.pc == 4
+    assert waiting.state is MachineState.PARKED and waiting.wakeups == 1
+
+    scheduler.wake(waiting)
+    cpu.reg.pc = 0
+    cpu.ram.set(0x1000, 0)
+    assert scheduler.run(ticks=100) < 20
+    assert scheduler.run(ticks=100) == 0
+
+def test_device_writes_keep_machines_running():
+    # loop: SET [0x8000], 1; SET PC, loop repeats its state exactly
+    cpu = machine([op(Opcode.SET, 0x1e, literal(1)), 0x8000, op(Opcode.SET, PC, literal(0))])
+    writes = []
+    hook = lambda start, stop: writes.append(start)
+    cpu.ram.add_write_hook(hook, 0x8000, 0x8001)
+    scheduler = Scheduler(quota=1000)
+    writing = scheduler.add(cpu)
+    assert scheduler.run(ticks=100) == 100
+    assert writing.state is MachineState.READY
+    assert len(writes) == (writing.instructions + 1) // 2
+
+    # once nothing watches the writes it is an ordinary busy wait
+    cpu.ram.remove_write_hook(hook, 0x8000, 0x8001)
+    assert scheduler.run(ticks=100) < 20
+    assert writing.state is MachineState.PARKED
+    scheduler.remove(writing)
+    assert not cpu.ram.write_hooks
+
+def test_pending_events_keep_machines_running():
+    cpu = machine(busy_wait(0x9010))
+    bus = DeviceBus(cpu)
+    bus.attach(Timer(period=20000))
+    scheduler = Scheduler(quota=1000)
+    waiting = scheduler.add(cpu, bus)
+    scheduler.run(ticks=19)
+    assert waiting.state is MachineState.READY
+    scheduler.run(ticks=2)
+    assert cpu.reg.a == 1
+
+def test_failed_machines_leave_the_queue():
+    scheduler = Scheduler(quota=100)
+    broken = scheduler.add(machine([0x0000]))
+    running = scheduler.add(machine(ARITHMETIC))
+    scheduler.run(ticks=3)
+    assert broken.state is MachineState.FAILED and broken.reason is None
+    assert str(broken.error) == 'invalid instruction 0x0000 at 0x0000'
+    assert running.slices == 3
+    scheduler.remove(broken)
+    assert scheduler.machines == [running]
+
+def test_latency():
+    clock = count()
+    scheduler = Scheduler(quota=100, clock=lambda: next(clock))
+    machines = [scheduler.add(machine(ARITHMETIC)) for _ in range(3)]
+    scheduler.run(ticks=4)
+    # the clock ticks once per slice and once per tick: each machine waits
+    # for the other two slices and the start of the tick
+    for each in machines:
+        assert each.slices == 4
+        assert each.latency == 4 * 3 and each.max_latency == 3
+        assert each.mean_latency == 3
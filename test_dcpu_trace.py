@@ -0,0 +1,61 @@
+import dcpu
+from dcpu_trace import RAM_WRITE, REGISTER_WRITE, NO_WRITE, TraceReader, TraceRecord, Tracer
+
+from dcpu_testing import EXAMPLE, machine, state, stepped
+
+def test_matches_run():
+    reference = machine(EXAMPLE)
+    reference_result = reference.run(max_cycles=302)
+    cpu = machine(EXAMPLE)
+    assert Tracer(cpu).run(max_cycles=302) == reference_result
+    assert state(cpu) == state(reference)
+
+def test_run_without_limits_returns_on_halt():
+    cpu = machine(EXAMPLE)
+    tracer = Tracer(cpu)
+    result = tracer.run()
+    assert result.reason == dcpu.StopReason.HALTED
+    assert state(cpu) == state(stepped(EXAMPLE, instructions=result.instructions))
+    records = list(tracer.records())
+    assert len(records) == result.instructions
+    assert records[-1].pc == cpu.reg.pc == 0x001a
+
+def test_records():
+    cpu = machine(EXAMPLE)
+    tracer = Tracer(cpu, capacity=4, segment=2)
+    tracer.run(max_instructions=3)
+    assert list(tracer.records()) == [
+        TraceRecord(0x0000, 0x7c01, (0x0030,), REGISTER_WRITE, dcpu.A, 0x0030, 0, 2),
+        TraceRecord(0x0002, 0x7de1, (0x1000, 0x0020), RAM_WRITE, 0x1000, 0x0020, 0, 3),
+        TraceRecord(0x0005, 0x7803, (0x1000,), REGISTER_WRITE, dcpu.A, 0x0010, 0, 3),
+    ]
+    tracer.run(max_instructions=3)
+    records = list(tracer.records())
+    assert [record.pc for record in records] == [0x0005, 0x0007, 0x000a, 0x000b]
+    assert records[1] == TraceRecord(0x0007, 0xc00d, (), NO_WRITE, 0, 0, 0, 3)
+
+def test_jsr_record():
+    cpu = machine([0x7c10, 0x0003, 0x0000, 0x61c1]) # JSR 3; ...; SET PC, POP
+    tracer = Tracer(cpu)
+    tracer.run(max_instructions=2)
+    assert list(tracer.records()) == [
+        TraceRecord(0x0000, 0x7c10, (0x0003,), RAM_WRITE, 0xffff, 0x0002, 0, 3),
+        TraceRecord(0x0003, 0x61c1, (), REGISTER_WRITE, dcpu.PC, 0x0002, 0, 1),
+    ]
+
+def test_file(tmp_path):
+    path = tmp_path / 'trace.bin'
+    cpu = machine(EXAMPLE)
+    with Tracer(cpu, capacity=8, path=path, segment=4) as tracer:
+        result = tracer.run(max_cycles=302)
+        in_memory = list(tracer.records())
+    reader = TraceReader(path, chunk_records=5)
+    assert len(reader) == result.instructions
+    records = list(reader)
+    assert records[-8:] == in_memory
+    assert sum(record.cycles for record in records) == result.cycles
+
+    reference = machine(EXAMPLE)
+    for record in records:
+        assert record.pc == reference.reg.pc
+        reference.step()